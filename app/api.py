@@ -16,17 +16,27 @@
 
 __author__ = "Aaron Steele, Dave Vieglais, and John Wieczorek"
 
-from datetime import datetime
-from google.appengine.api import mail, memcache, urlfetch
+from google.appengine.api import apiproxy_stub_map, datastore, memcache, taskqueue, urlfetch
 from google.appengine.ext import webapp, db
-from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
+from google.appengine.runtime import apiproxy_errors
 
-from sdl import rmg
+from sdl import gziputil, rmg
 
+# Modules used by a few handlers or formats (bloom, rankset, base64, csv, hashlib,
+# struct, taskqueue_service_pb) are imported where they are used, to keep them out
+# of the cold start of every instance.
+
+import cachepack
 import logging
+import lrucache
 import os
+import re
 import simplejson
+import StringIO
+import tierstats
+import time
+import urllib
 
 #from google.appengine.dist import use_library
 #use_library('django', '1.2')
@@ -43,14 +53,1030 @@ COUCHDB_URL = '%s:%s/%s/_design/%s/_view/%s' % \
      COUCHDB_DESIGN, 
      COUCHDB_VIEW)
 
+# View of cells keyed by [y, x], so that a run of cells in an RMG row is a key range:
+COUCHDB_ROWS_VIEW = 'rows'
+COUCHDB_ROWS_URL = '%s:%s/%s/_design/%s/_view/%s' % \
+    (COUCHDB_HOST, 
+     COUCHDB_PORT, 
+     COUCHDB_DATABASE, 
+     COUCHDB_DESIGN, 
+     COUCHDB_ROWS_VIEW)
+
+# Map of the CouchDB databases that cells are sharded across (see sdl.shardmap),
+# written by the sdl.py shardmap command. Without it, cells are queried in the one
+# database at COUCHDB_URL and COUCHDB_ROWS_URL:
+COUCHDB_SHARDS_FILE = os.path.join(os.path.dirname(__file__), 'shards.json')
+COUCHDB_SHARDS = None
+
+# Envelope index database built by the sdl.py envelope command:
+ENVELOPE_DATABASE = '%s-envelope' % COUCHDB_DATABASE
+ENVELOPE_URL = '%s:%s/%s' % (COUCHDB_HOST, COUCHDB_PORT, ENVELOPE_DATABASE)
+
+# Number of envelope index chunks fetched per CouchDB query:
+ENVELOPE_CHUNK_BATCH = 8
+
+# The envelope index bins document is cached per instance, and revalidated against 
+# its CouchDB revision at most once per ENVELOPE_CHECK_INTERVAL seconds:
+ENVELOPE_BINS_KEY = 'envelope:bins'
+ENVELOPE_CHECK_INTERVAL = 60
+
+# Cells found in CouchDB are written to the datastore by tasks on this queue,
+# each for up to BACKFILL_BATCH_KEYS cells:
+BACKFILL_QUEUE = 'backfill'
+BACKFILL_URL = '/api/admin/backfill'
+BACKFILL_BATCH_KEYS = 500
+INVALIDATE_URL = '/api/admin/invalidate'
+
+# Tasks added per call to the task queue service (its bulk add limit):
+TASKQUEUE_BATCH = 100
+
+# Cells are also cached in blocks of rmg.BLOCK_SIZE by rmg.BLOCK_SIZE cells, with one 
+# memcache entry and one CouchDbBlock entity per block, built by BackfillHandler. 
+# Blocks found not built are remembered for BLOCK_BUILD_TTL seconds, and lookups only
+# read blocks holding at least BLOCK_MIN_KEYS of their keys:
+BLOCK_CACHE = True
+BLOCK_PREFIX = 'block:'
+BLOCK_BUILD_PREFIX = 'building:'
+BLOCK_UNBUILT_PREFIX = 'unbuilt:'
+BLOCK_BUILD_TTL = 600
+BLOCK_BUILD_BATCH = 4
+BLOCK_MIN_KEYS = 16
+
+# After a request, up to PREFETCH_BLOCKS blocks adjacent to the blocks served are warmed
+# in memcache by PrefetchHandler, each queued at most once per PREFETCH_TTL seconds per 
+# instance (0 disables). Prefetch counters are added to memcache with the tier statistics:
+PREFETCH_BLOCKS = 8
+PREFETCH_QUEUE = 'prefetch'
+PREFETCH_URL = '/api/admin/prefetch'
+PREFETCH_PREFIX = 'prefetching:'
+PREFETCHED_PREFIX = 'prefetched:'
+PREFETCH_TTL = 300
+PREFETCH_STATS_PREFIX = 'stats:prefetch:'
+PREFETCH_COUNTERS = ('queued', 'warmed', 'building', 'hits', 'misses')
+PREFETCH_COUNTS = {}
+
+# Row ranges spanning more blocks than this are range scanned from CouchDB instead:
+REGION_MAX_RANGE_BLOCKS = 16
+
+# Memcache leases on keys being fetched, so requests on other instances wait on the
+# fetch rather than repeating it. Off by default, since every miss then pays an 
+# add_multi and a delete_multi, and waiters poll for up to LEASE_WAIT_TIMEOUT seconds,
+# which only pays off for hot keys missed by many instances at once:
+MEMCACHE_LEASES = False
+LEASE_PREFIX = 'lease:'
+LEASE_TTL = 10
+LEASE_POLL_INTERVAL = 0.05
+LEASE_WAIT_TIMEOUT = 2.0
+LEASE_STATS = {'waited': 0, 'refetched': 0}
+
+# Runs of at least this many consecutive missed cells in a row are range scanned,
+# up to this many runs per lookup:
+RANGE_SCAN_MIN_CELLS = 8
+RANGE_SCAN_MAX_RUNS = 10
+
+# Maximum number of cells that y:x0-x1 runs in k may expand to:
+MAX_RUN_CELLS = 100000
+
+# Region page sizes and the number of row range queries in flight at a time:
+REGION_PAGE_SIZE = 1000
+REGION_MAX_PAGE_SIZE = 10000
+REGION_RANGE_RPCS = 8
+
+# Request bodies of at least this many bytes are gzip encoded, and gzip encoded 
+# responses accepted (None disables, e.g., 1024 for a remote CouchDB):
+COUCHDB_GZIP_THRESHOLD = None
+
+# Fetches CouchDB for memcache misses while the datastore get is in flight. This
+# doubles backend load when the datastore holds the cells, so it only pays off
+# while the datastore is mostly empty (e.g., before backfill catches up):
+SPECULATIVE_COUCHDB = False
+
+# Bounds of the per-instance cell cache consulted before memcache:
+LOCAL_CACHE_ENTRIES = 50000
+LOCAL_CACHE_BYTES = 16 * 1024 * 1024
+LOCAL_CACHE_TTL = 600
+LOCAL_CACHE = lrucache.LRUCache(LOCAL_CACHE_ENTRIES, LOCAL_CACHE_BYTES, LOCAL_CACHE_TTL)
+
+# Tier statistics of 1 in STATS_SAMPLE_RATE requests (0 disables) are aggregated per 
+# instance, and added to memcache counters every STATS_FLUSH_INTERVAL seconds:
+STATS_SAMPLE_RATE = 10
+STATS_FLUSH_INTERVAL = 60
+STATS_PREFIX = 'stats:tiers:'
+STATS_TIERS = ('bloom', 'local', 'blocks', 'memcache', 'leased', 
+               'datastore', 'couchdb', 'couchdb_ranges')
+TIER_STATS = tierstats.TierStats(STATS_TIERS)
+STATS_FLUSHED = time.time()
+
+# Bloom filter of all loaded cell keys, built offline by the sdl.py bloom command:
+CELL_FILTER_FILE = os.path.join(os.path.dirname(__file__), 'cellkeys.bloom')
+CELL_FILTER = None
+
+# Cached in place of a cell confirmed missing from CouchDB, for NEGATIVE_CACHE_TTL seconds:
+MISSING = ()
+NEGATIVE_CACHE_TTL = 3600
+
+# Cached cells and blocks are namespaced by dataset version (see DatasetVersion), 
+# read from memcache at most once per VERSION_CHECK_INTERVAL seconds per instance, 
+# and cached in memcache for VERSION_CACHE_TTL seconds:
+VERSION_KEY = 'dataset-version'
+VERSION_CHECK_INTERVAL = 5
+VERSION_CACHE_TTL = 60
+DATASET_VERSION = None
+
+# Tiles of TILE_BLOCKS by TILE_BLOCKS blocks are invalidated individually:
+TILE_BLOCKS = 32
+
+# Cells are packed into memcache compressed from this many bytes (see cachepack), and 
+# packed blocks larger than a memcache entry are chunked across keys:
+CACHE_COMPRESS_THRESHOLD = 512
+CACHE_CHUNK_BYTES = memcache.MAX_VALUE_SIZE
+
+def getcellfilter():
+    """Returns the Bloom filter of loaded cell keys, loading it once per instance.
+
+    Returns None if no filter was deployed, in which case every key may exist.
+    """
+    global CELL_FILTER
+    if CELL_FILTER is None:
+        if os.path.exists(CELL_FILTER_FILE):
+            from sdl import bloom
+            t0 = time.time()
+            CELL_FILTER = bloom.BloomFilter.load(CELL_FILTER_FILE)
+            logging.info('Loaded cell filter of %s bits in %.1f ms' % \
+                (CELL_FILTER.bits, (time.time() - t0) * 1000))
+        else:
+            CELL_FILTER = False
+    return CELL_FILTER or None
+
+def getshards():
+    """Returns the ShardMap of the CouchDB cell databases, loading it once per instance.
+
+    Returns None if no map was deployed, in which case cells are in one database.
+    """
+    global COUCHDB_SHARDS
+    if COUCHDB_SHARDS is None:
+        if os.path.exists(COUCHDB_SHARDS_FILE):
+            from sdl import shardmap
+            COUCHDB_SHARDS = shardmap.ShardMap.load(COUCHDB_SHARDS_FILE)
+            logging.info('Loaded map of %s CouchDB shards by %s' % \
+                (len(COUCHDB_SHARDS.shards), COUCHDB_SHARDS.scheme))
+        else:
+            COUCHDB_SHARDS = False
+    return COUCHDB_SHARDS or None
+
+def datasetversion():
+    """Returns the (version, tiles) of the dataset (see DatasetVersion).
+
+    The version is cached per instance for VERSION_CHECK_INTERVAL seconds, 
+    and in memcache for VERSION_CACHE_TTL seconds. A version read from the 
+    datastore is only added to memcache, so that it cannot overwrite a newer
+    version set by InvalidateHandler in the meantime, and the expiry bounds 
+    how long a lost update can go unnoticed.
+    """
+    global DATASET_VERSION
+    now = time.time()
+    if DATASET_VERSION is None or now - DATASET_VERSION[0] >= VERSION_CHECK_INTERVAL:
+        config = memcache.get(VERSION_KEY)
+        if config is None:
+            entity = DatasetVersion.get_by_key_name(COUCHDB_DATABASE)
+            if entity:
+                config = entity.config()
+            else:
+                config = (1, {})
+            memcache.add(VERSION_KEY, config, time=VERSION_CACHE_TTL)
+        DATASET_VERSION = (now, config)
+    return DATASET_VERSION[1]
+
+def tilekey(key, blocks=False):
+    """Returns the key of the tile containing a cell, or a block if blocks is True.
+
+    Tiles are blocks of TILE_BLOCKS by TILE_BLOCKS blocks (see rmg.blockkey).
+    """
+    if blocks:
+        return rmg.blockkey(key, TILE_BLOCKS)
+    return rmg.blockkey(key, rmg.BLOCK_SIZE * TILE_BLOCKS)
+
+def cacheversions(keys, blocks=False):
+    """Returns a dictionary of cache version to the list of keys cached under it.
+
+    The cache version is the dataset version, such as v3, or for cells in a 
+    tile invalidated since, the version and the number of times the tile was
+    invalidated, such as v3.2. It is the memcache namespace of the keys, and
+    the version of their datastore entities.
+
+    Arguments:
+        keys - Cell keys, or block keys if blocks is True.
+    """
+    version, tiles = datasetversion()
+    namespace = 'v%s' % version
+    if not tiles:
+        return {namespace: list(keys)}
+    versions = {}
+    for key in keys:
+        tile = tiles.get(tilekey(key, blocks))
+        if tile:
+            versions.setdefault('%s.%s' % (namespace, tile), []).append(key)
+        else:
+            versions.setdefault(namespace, []).append(key)
+    return versions
+
+def cacheversion(key, blocks=False):
+    """Returns the cache version of a cell, or a block if blocks is True (see cacheversions)."""
+    return cacheversions([key], blocks).keys()[0]
+
+def cacheentries(mapping, prefix):
+    """Returns a dictionary of prefixed memcache key to value for entries of cells or blocks.
+
+    Cells, with no prefix, are packed (see cachepack.packcell), and blocks, 
+    with BLOCK_PREFIX, are chunked if larger than CACHE_CHUNK_BYTES.
+    """
+    entries = {}
+    for key, value in mapping.iteritems():
+        if not prefix:
+            entries[key] = cachepack.packcell(value, CACHE_COMPRESS_THRESHOLD)
+        elif prefix == BLOCK_PREFIX:
+            entries.update(cachepack.chunk(prefix + key, value, CACHE_CHUNK_BYTES))
+        else:
+            entries[prefix + key] = value
+    return entries
+
+def cachegetprefixes(keys, prefixes, blocks=False):
+    """Gets memcache entries under several prefixes for each key, in one RPC per cache version.
+
+    Cells are unpacked, chunked blocks are joined with one more RPC, and 
+    entries that cannot be unpacked or joined are dropped (see cacheentries).
+
+    Returns:
+        A dictionary of prefix to a dictionary of key to value.
+    """
+    found = dict([(x, {}) for x in prefixes])
+    for namespace, versioned in cacheversions(keys, blocks).iteritems():
+        values = memcache.get_multi(
+            [x + y for x in prefixes for y in versioned], namespace=namespace)
+        if BLOCK_PREFIX in prefixes:
+            headers = {}
+            for key in versioned:
+                chunk_keys = cachepack.chunkkeys(BLOCK_PREFIX + key, values.get(BLOCK_PREFIX + key))
+                if chunk_keys:
+                    headers[BLOCK_PREFIX + key] = chunk_keys
+            if headers:
+                chunks = memcache.get_multi(
+                    [x for y in headers.values() for x in y], namespace=namespace)
+                for key in headers:
+                    values[key] = cachepack.unchunk(key, values[key], chunks)
+        for prefix in prefixes:
+            for key in versioned:
+                value = values.get(prefix + key)
+                if not prefix and value is not None:
+                    if isinstance(value, str):
+                        value = cachepack.unpackcell(value)
+                    else:
+                        value = None
+                if value is not None:
+                    found[prefix][key] = value
+    return found
+
+def cacheget(keys, prefix='', blocks=False):
+    """Returns a dictionary of key to value of the memcache entries of cells or blocks."""
+    return cachegetprefixes(keys, (prefix,), blocks)[prefix]
+
+def addtasks(url, queue_name, params):
+    """Adds tasks to a queue in calls of up to TASKQUEUE_BATCH tasks.
+
+    The task queue API of this SDK has no asynchronous add, so the tasks of 
+    a request are added together rather than one call per task.
+
+    Arguments:
+        url - The URL of the task handler.
+        queue_name - The name of the queue.
+        params - A list of the params dictionary of each task.
+
+    Returns:
+        The list of the params of tasks that were not added.
+    """
+    tasks = [taskqueue.Task(url=url, params=x) for x in params]
+    failed = []
+    for i in range(0, len(tasks), TASKQUEUE_BATCH):
+        batch = tasks[i:i + TASKQUEUE_BATCH]
+        try:
+            taskqueue.Queue(queue_name).add(batch)
+        except taskqueue.Error, e:
+            missed = [params[i + j] for j, x in enumerate(batch) if not x.was_enqueued]
+            logging.warning('%s of %s tasks for %s not queued: %s' % \
+                (len(missed), len(batch), url, e))
+            failed.extend(missed)
+    return failed
+
+def addtasksasync(url, queue_name, params):
+    """Starts adding tasks to a queue in one call, and returns the RPC to wait on.
+
+    This SDK's Queue.add is synchronous, so the BulkAdd request is built here
+    from the public Task properties and sent as an asynchronous RPC. This 
+    depends on the taskqueue service protocol buffers of the SDK version, 
+    which later SDKs wrap as Queue.add_async. Errors are raised by the RPC's
+    check_success.
+
+    Arguments:
+        url - The URL of the task handler.
+        queue_name - The name of the queue.
+        params - A list of the params dictionary of each task, up to TASKQUEUE_BATCH.
+    """
+    from google.appengine.api.taskqueue import taskqueue_service_pb
+    request = taskqueue_service_pb.TaskQueueBulkAddRequest()
+    for x in params:
+        task = taskqueue.Task(url=url, params=x)
+        add = request.add_add_request()
+        add.set_queue_name(queue_name)
+        add.set_task_name('')
+        add.set_eta_usec(long(task.eta_posix * 1e6))
+        add.set_method(taskqueue_service_pb.TaskQueueAddRequest.POST)
+        add.set_url(task.url)
+        add.set_body(task.payload)
+        for key, value in task.headers.iteritems():
+            header = add.add_header()
+            header.set_key(key)
+            header.set_value(value)
+    rpc = apiproxy_stub_map.UserRPC('taskqueue')
+    rpc.make_call('BulkAdd', request, taskqueue_service_pb.TaskQueueBulkAddResponse())
+    return rpc
+
+def cacheset(mapping, prefix='', blocks=False, time=0):
+    """Sets memcache entries of cells or blocks, given a dictionary of key to value."""
+    for namespace, versioned in cacheversions(mapping.keys(), blocks).iteritems():
+        memcache.set_multi(cacheentries(dict([(x, mapping[x]) for x in versioned]), prefix), 
+            time=time, namespace=namespace)
+
+def cacheadd(mapping, prefix='', blocks=False, time=0):
+    """Adds memcache entries of cells or blocks, returning the keys that already had one."""
+    existing = []
+    for namespace, versioned in cacheversions(mapping.keys(), blocks).iteritems():
+        existing.extend(memcache.add_multi(dict([(x, mapping[x]) for x in versioned]), 
+            time=time, key_prefix=prefix, namespace=namespace))
+    return existing
+
+def cachedelete(keys, prefix='', blocks=False):
+    """Deletes memcache entries of cells or blocks."""
+    for namespace, versioned in cacheversions(keys, blocks).iteritems():
+        memcache.delete_multi(versioned, key_prefix=prefix, namespace=namespace)
+
+def localget(keys):
+    """Returns a dictionary of cell key to value of the instance cache entries of cells."""
+    found = {}
+    for namespace, versioned in cacheversions(keys).iteritems():
+        values = LOCAL_CACHE.get_multi(['%s:%s' % (namespace, x) for x in versioned])
+        for key in versioned:
+            value = values.get('%s:%s' % (namespace, key))
+            if value is not None:
+                found[key] = value
+    return found
+
+def localset(mapping, ttl=None):
+    """Sets instance cache entries of cells, given a dictionary of cell key to value."""
+    for namespace, versioned in cacheversions(mapping.keys()).iteritems():
+        LOCAL_CACHE.set_multi(
+            dict([('%s:%s' % (namespace, x), mapping[x]) for x in versioned]), ttl=ttl)
+
+def recordstats(stats, t0):
+    """Records the tier statistics of a request if sampled, given its start time.
+
+    Every STATS_FLUSH_INTERVAL seconds, the statistics aggregated on this 
+    instance are added to the memcache counters reported by StatsHandler.
+    """
+    global STATS_FLUSHED
+    stats.ms = (time.time() - t0) * 1000
+    if not stats.sampled:
+        return
+    TIER_STATS.record(stats)
+    if time.time() - STATS_FLUSHED >= STATS_FLUSH_INTERVAL:
+        flushstats()
+
+def flushstats():
+    """Adds the tier statistics and prefetch counts of this instance to the memcache counters."""
+    global STATS_FLUSHED
+    STATS_FLUSHED = time.time()
+    counters = dict([(STATS_PREFIX + x, y) for x, y in TIER_STATS.flush().iteritems()])
+    counters.update([(PREFETCH_STATS_PREFIX + x, y) for x, y in PREFETCH_COUNTS.iteritems()])
+    PREFETCH_COUNTS.clear()
+    if counters:
+        memcache.offset_multi(counters, initial_value=0)
+
+class CompletedRpc(object):
+    """An RPC whose result is already known, for gets made synchronously."""
+
+    def __init__(self, result):
+        self.result = result
+
+    def wait(self):
+        pass
+
+    def get_result(self):
+        return self.result
+
+def asyncdsget(keys, hook):
+    """Starts a datastore get of keys and returns an RPC whose result is hook(entities).
+
+    The db module of SDK 1.4 has no asynchronous get, so this uses the private
+    datastore._GetConnection().async_get (datastore_rpc), which depends on the 
+    SDK version. Where the SDK lacks it, the get is made synchronously with 
+    datastore.Get and returned as a CompletedRpc.
+
+    Arguments:
+        keys - A list of db.Key.
+        hook - A function of the list of entities (None where missing).
+    """
+    getconnection = getattr(datastore, '_GetConnection', None)
+    if getconnection is not None:
+        connection = getconnection()
+        if hasattr(connection, 'async_get'):
+            return connection.async_get(None, keys, hook)
+    return CompletedRpc(hook(datastore.Get(keys)))
+
+def couchdbrpc(url, payload=None, headers=None):
+    """Starts an asynchronous JSON POST to CouchDB and returns the urlfetch RPC.
+
+    Payloads of at least COUCHDB_GZIP_THRESHOLD bytes are sent gzip encoded and
+    gzip encoded responses are accepted. Compression ratios are logged.
+
+    Arguments:
+        url - The CouchDB URL.
+        payload - The JSON request body string, or None for a GET.
+        headers - Optional dictionary of additional request headers.
+    """
+    headers = dict(headers or {})
+    headers['Content-Type'] = 'application/json'
+    method = urlfetch.POST
+    if payload is None:
+        method = urlfetch.GET
+    if COUCHDB_GZIP_THRESHOLD is not None:
+        headers['Accept-Encoding'] = 'gzip'
+        if payload is not None and len(payload) >= COUCHDB_GZIP_THRESHOLD:
+            compressed = gziputil.gzipstring(payload)
+            logging.info('CouchDB request gzipped from %s to %s bytes (ratio %.2f)' % \
+                (len(payload), len(compressed), gziputil.ratio(len(payload), len(compressed))))
+            headers['Content-Encoding'] = 'gzip'
+            payload = compressed
+    rpc = urlfetch.create_rpc()
+    urlfetch.make_fetch_call(
+        rpc,
+        url,
+        payload=payload,
+        method=method,
+        headers=headers)
+    return rpc
+
+def couchdbresponse(rpc):
+    """Waits for a CouchDB RPC and returns its response, gunzipped in place."""
+    response = rpc.get_result()
+    if response.headers.get('Content-Encoding') == 'gzip':
+        compressed = len(response.content)
+        response.content = gziputil.gunzip(response.content)
+        logging.info('CouchDB response gunzipped from %s to %s bytes (ratio %.2f)' % \
+            (compressed, len(response.content), 
+             gziputil.ratio(len(response.content), compressed)))
+    return response
+
+def couchdbpost(url, payload):
+    """POSTs a JSON payload to CouchDB and returns the urlfetch response."""
+    return couchdbresponse(couchdbrpc(url, payload))
+
+# Responses of at least this many cells are gzipped for clients that accept it:
+GZIP_RESPONSE_CELLS = 100
+GZIP_RESPONSE_LEVEL = 6
+
+# Bytes of encoded response compressed per gzip write (see writechunks):
+RESPONSE_CHUNK_SIZE = 65536
+
+# GET responses of cell values carry an ETag (see valuesetag), and may be cached by 
+# clients and proxies for this many seconds, then revalidated with If-None-Match:
+VALUES_MAX_AGE = 86400
+
+# Header of the binary response format: magic, version, flags, variables, cells:
+BINARY_HEADER = '<4sBBHI'
+BINARY_MAGIC = 'SDLC'
+BINARY_VERSION = 1
+BINARY_NAN = float('nan')
+
+# Points annotated per batch of key computation and cell lookups:
+ANNOTATE_BATCH_POINTS = 10000
+
+# Lower case CSV column names recognized as point longitude and latitude:
+LNG_COLUMNS = ('lng', 'lon', 'long', 'longitude', 'decimallongitude', 'x')
+LAT_COLUMNS = ('lat', 'latitude', 'decimallatitude', 'y')
+
+# Whitespace between the items of a JSON list of points:
+JSON_SPACE = re.compile(r'[ \t\n\r]*')
+
+# Variable schemas of packed cell values, by schema version:
+WORLDCLIM_VARIABLES = tuple(
+    ['alt'] + 
+    ['bio%s' % i for i in range(1, 20)] + 
+    ['%s%s' % (v, i) for v in ('prec', 'tmax', 'tmean', 'tmin') for i in range(1, 13)])
+VARIABLE_SCHEMAS = {1: WORLDCLIM_VARIABLES}
+SCHEMA_VERSIONS = dict([(frozenset(names), version) \
+                            for version, names in VARIABLE_SCHEMAS.iteritems()])
+
+# Pre-encoded '"name": ' JSON fragments and value indexes by schema version:
+NAME_FRAGMENTS = dict([(version, [simplejson.dumps(x) + ': ' for x in names]) \
+                           for version, names in VARIABLE_SCHEMAS.iteritems()])
+NAME_INDEXES = dict([(version, dict([(x, i) for i, x in enumerate(names)])) \
+                         for version, names in VARIABLE_SCHEMAS.iteritems()])
+
+def packcell(rev, coords, varvals):
+    """Returns the cached form of a cell given its parsed CouchDB values.
+
+    A cached cell is a (schema, rev, coords, values) tuple. The schema is a 
+    VARIABLE_SCHEMAS version, or a tuple of variable names for cells that have 
+    no matching version. Values holds the JSON encoding of each variable value 
+    in schema order, and coords is the JSON encoding of the cell polygon, so a 
+    cell is served without any JSON parsing.
+
+    Arguments:
+        rev - The CouchDB document revision.
+        coords - The cell polygon.
+        varvals - A dictionary of variable name to value.
+    """
+    schema = SCHEMA_VERSIONS.get(frozenset(varvals.keys()))
+    if schema:
+        names = VARIABLE_SCHEMAS.get(schema)
+    else:
+        names = tuple(sorted(varvals.keys()))
+        schema = names
+    values = tuple([simplejson.dumps(varvals.get(x)) for x in names])
+    return (schema, rev, simplejson.dumps(coords), values)
+
+def countprefetch(deltas):
+    """Adds to the prefetch counts of this instance, given a dictionary of counter to delta.
+
+    The counts are added to the memcache counters with the tier statistics
+    (see flushstats), at most every STATS_FLUSH_INTERVAL seconds.
+    """
+    for name, delta in deltas.iteritems():
+        if delta:
+            PREFETCH_COUNTS[name] = PREFETCH_COUNTS.get(name, 0) + delta
+    if PREFETCH_COUNTS and time.time() - STATS_FLUSHED >= STATS_FLUSH_INTERVAL:
+        flushstats()
+
+def cellfragment(cellkey, cell, variable_names=None, c=False):
+    """Returns the JSON response object for a cached cell as a string.
+
+    Arguments:
+        cellkey - The cell key.
+        cell - The cached cell tuple (see packcell).
+        variable_names - Optional list of the variable names to include.
+        c - True to include the cell coordinates.
+    """
+    schema, rev, coords, values = cell
+    if isinstance(schema, tuple):
+        fragments = [simplejson.dumps(x) + ': ' for x in schema]
+        indexes = dict([(x, i) for i, x in enumerate(schema)])
+    else:
+        fragments = NAME_FRAGMENTS.get(schema)
+        indexes = NAME_INDEXES.get(schema)
+    if variable_names:
+        varvals = []
+        for name in variable_names:
+            i = indexes.get(name)
+            if i is None:
+                varvals.append(simplejson.dumps(name) + ': null')
+            else:
+                varvals.append(fragments[i] + values[i])
+    else:
+        varvals = [fragments[i] + values[i] for i in range(len(values))]
+    result = '{"cell-key": %s, "cell-values": {%s}' % \
+        (simplejson.dumps(cellkey), ', '.join(varvals))
+    if c:
+        result += ', "cell-coords": %s' % coords
+    return result + '}'
+
+def cellvalue(cell, name):
+    """Returns the value of a variable in a cached cell as a float, or None."""
+    schema, rev, coords, values = cell
+    if isinstance(schema, tuple):
+        i = dict([(x, i) for i, x in enumerate(schema)]).get(name)
+    else:
+        i = NAME_INDEXES.get(schema).get(name)
+    if i is None:
+        return None
+    value = simplejson.loads(values[i])
+    if value is None:
+        return None
+    return float(value)
+
+def variablenames(v):
+    """Returns the ordered, distinct variable names of a varname,varname,... string."""
+    names = []
+    if v:
+        for name in [x.strip() for x in v.split(',')]:
+            if name and name not in names:
+                names.append(name)
+    return names
+
+def parsekeys(k):
+    """Returns the set of cell keys of a k parameter string.
+
+    Items are cell keys (e.g., 9-15) or row runs y:x0-x1 (e.g., 15:9-40 for
+    the cells 9-15 through 40-15).
+
+    Raises ValueError for a malformed run (including negative indexes or x0
+    after x1), or if runs expand to more than MAX_RUN_CELLS cells.
+    """
+    cell_keys = set()
+    expanded = 0
+    for item in k.split(','):
+        item = item.strip()
+        if ':' in item:
+            y_index, x_range = item.split(':')
+            x0, x1 = [int(x) for x in x_range.split('-')]
+            y_index = int(y_index)
+            if y_index < 0 or x0 < 0 or x0 > x1:
+                raise ValueError('Bad run %s' % item)
+            if expanded + x1 - x0 + 1 > MAX_RUN_CELLS:
+                raise ValueError('Runs expand to more than %s cells' % MAX_RUN_CELLS)
+            expanded += x1 - x0 + 1
+            for x_index in xrange(x0, x1 + 1):
+                cell_keys.add('%s-%s' % (x_index, y_index))
+        elif item:
+            cell_keys.add(item)
+    return cell_keys
+
+def keyruns(cell_keys):
+    """Returns the runs of consecutive cells in a row among cell keys.
+
+    Runs are (y, x0, x1) tuples sorted by y then x0. Keys that are not of
+    the form x-y are ignored.
+    """
+    rows = {}
+    for key in cell_keys:
+        try:
+            x_index, y_index = [int(x) for x in key.split('-')]
+        except ValueError:
+            continue
+        rows.setdefault(y_index, []).append(x_index)
+    runs = []
+    for y_index in sorted(rows.keys()):
+        xs = sorted(rows[y_index])
+        start = end = xs[0]
+        for x_index in xs[1:]:
+            if x_index != end + 1:
+                runs.append((y_index, start, end))
+                start = x_index
+            end = x_index
+        runs.append((y_index, start, end))
+    return runs
+
+def cellcolumns(items):
+    """Returns the variable names of a list of (cell key, cached cell), in schema order."""
+    columns = []
+    seen = set()
+    for schema in sorted(set([x[1][0] for x in items])):
+        if isinstance(schema, tuple):
+            names = schema
+        else:
+            names = VARIABLE_SCHEMAS.get(schema)
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                columns.append(name)
+    return columns
+
+def cellrows(items, columns):
+    """Iterates over (cell key, cached cell, value fragments in column order) of cells.
+
+    Variables that a cell does not have are given as null.
+    """
+    indexes = {}
+    for cellkey, cell in items:
+        schema, rev, coords, values = cell
+        schemaindexes = indexes.get(schema)
+        if schemaindexes is None:
+            if isinstance(schema, tuple):
+                names = dict([(x, i) for i, x in enumerate(schema)])
+            else:
+                names = NAME_INDEXES.get(schema)
+            schemaindexes = indexes[schema] = [names.get(x) for x in columns]
+        yield cellkey, cell, [i is None and 'null' or values[i] for i in schemaindexes]
+
+def jsonchunks(items, variable_names, c, paged, cursor):
+    """Iterates over the JSON list response of cells (see cellfragment) in chunks."""
+    if paged:
+        yield '{"cells": ['
+    else:
+        yield '['
+    for i, (cellkey, cell) in enumerate(items):
+        if i:
+            yield ', '
+        yield cellfragment(cellkey, cell, variable_names, c)
+    if paged:
+        yield '], "cursor": %s}' % simplejson.dumps(cursor)
+    else:
+        yield ']'
+
+def columnarchunks(items, variable_names, c, paged, cursor):
+    """Iterates over the columnar JSON response of cells in chunks.
+
+    The response has a list of cell keys and a list of values per variable in
+    the same order, and a list of cell coordinates if c is True.
+    """
+    columns = variable_names or cellcolumns(items)
+    keys = []
+    coords = []
+    values = [[] for x in columns]
+    for cellkey, cell, row in cellrows(items, columns):
+        keys.append(simplejson.dumps(cellkey))
+        coords.append(cell[2])
+        for i, value in enumerate(row):
+            values[i].append(value)
+    yield '{"cell-keys": [%s], "cell-values": {' % ', '.join(keys)
+    for i, name in enumerate(columns):
+        if i:
+            yield ', '
+        yield '%s: [%s]' % (simplejson.dumps(name), ', '.join(values[i]))
+    yield '}'
+    if c:
+        yield ', "cell-coords": [%s]' % ', '.join(coords)
+    if paged:
+        yield ', "cursor": %s' % simplejson.dumps(cursor)
+    yield '}'
+
+def csvvalue(value):
+    """Returns a JSON value fragment as a CSV field."""
+    if value == 'null':
+        return ''
+    if value.startswith('"'):
+        if '\\' in value:
+            value = simplejson.loads(value)
+        else:
+            value = value[1:-1]
+        if ',' in value or '"' in value or '\n' in value:
+            return '"%s"' % value.replace('"', '""')
+    return value
+
+def csvchunks(items, variable_names, c, paged, cursor):
+    """Iterates over the CSV response of cells in chunks, a header row then a row per cell.
+
+    Cell coordinates, if c is True, are a quoted JSON list in the last column.
+    """
+    columns = variable_names or cellcolumns(items)
+    header = ['cell-key'] + columns
+    if c:
+        header.append('cell-coords')
+    yield ','.join(header) + '\r\n'
+    for cellkey, cell, row in cellrows(items, columns):
+        fields = [cellkey] + [csvvalue(x) for x in row]
+        if c:
+            fields.append('"%s"' % cell[2].replace('"', '""'))
+        yield ','.join(fields) + '\r\n'
+
+def binaryvalue(value):
+    """Returns a JSON value fragment as a float, NaN if it is null or not numeric."""
+    try:
+        return float(value.strip('"'))
+    except ValueError:
+        return BINARY_NAN
+
+def binarychunks(items, variable_names, c, paged, cursor):
+    """Iterates over the little-endian binary response of cells in chunks.
+
+    The header is BINARY_HEADER (magic, version, flags, variable count and 
+    cell count) followed by each variable name as a length-prefixed UTF-8 
+    string. Each cell is then its x and y indexes as unsigned 32-bit integers
+    and its values as 32-bit floats, NaN if missing. If flag 1 (c) is set, 
+    each cell is followed by its 5 polygon vertices as lng, lat 64-bit floats.
+    """
+    import struct
+    columns = variable_names or cellcolumns(items)
+    flags = 0
+    if c:
+        flags |= 1
+    header = [struct.pack(BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, flags, 
+                          len(columns), len(items))]
+    for name in columns:
+        name = name.encode('utf-8')
+        header.append(struct.pack('<B', len(name)) + name)
+    yield ''.join(header)
+    record = struct.Struct('<II%sf' % len(columns))
+    polygon = struct.Struct('<10d')
+    for cellkey, cell, row in cellrows(items, columns):
+        x, y = cellkey.split('-')
+        chunk = record.pack(int(x), int(y), *[binaryvalue(v) for v in row])
+        if c:
+            vertices = [float(v) for vertex in simplejson.loads(cell[2]) for v in vertex]
+            chunk += polygon.pack(*(vertices + [BINARY_NAN] * 10)[:10])
+        yield chunk
+
+# Response formats by f parameter value, to (content type, chunk encoder):
+RESPONSE_FORMATS = {
+    'json': ('application/json', jsonchunks),
+    'columnar': ('application/json', columnarchunks),
+    'csv': ('text/csv', csvchunks),
+    'binary': ('application/octet-stream', binarychunks)
+    }
+
+# Formats negotiated by Accept media type when there is no f parameter:
+ACCEPT_FORMATS = [
+    ('text/csv', 'csv'), 
+    ('application/octet-stream', 'binary')
+    ]
+
+def responseformat(request):
+    """Returns the RESPONSE_FORMATS name for a request, or None if f is unknown."""
+    f = request.get('f', None)
+    if f:
+        if f in RESPONSE_FORMATS:
+            return f
+        return None
+    accept = request.headers.get('Accept', '')
+    for media_type, name in ACCEPT_FORMATS:
+        if media_type in accept:
+            return name
+    return 'json'
+
+def writechunks(handler, chunks, gzipped):
+    """Writes response chunks to the response buffer, gzip compressed if gzipped.
+
+    webapp buffers the response body until the handler returns, so this bounds
+    the intermediate strings built while encoding, not the response size: gzip
+    compresses RESPONSE_CHUNK_SIZE bytes of chunks at a time.
+
+    Returns the number of bytes written.
+    """
+    out = handler.response.out
+    if not gzipped:
+        size = 0
+        for chunk in chunks:
+            out.write(chunk)
+            size += len(chunk)
+        return size
+    handler.response.headers['Content-Encoding'] = 'gzip'
+    compressor = gziputil.compressor(GZIP_RESPONSE_LEVEL)
+    size = 0
+    compressed = 0
+    buffered = []
+    buffered_size = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        buffered_size += len(chunk)
+        if buffered_size >= RESPONSE_CHUNK_SIZE:
+            data = compressor.compress(''.join(buffered))
+            out.write(data)
+            compressed += len(data)
+            size += buffered_size
+            buffered = []
+            buffered_size = 0
+    data = compressor.compress(''.join(buffered)) + compressor.flush()
+    out.write(data)
+    compressed += len(data)
+    size += buffered_size
+    logging.info('Response gzipped from %s to %s bytes (ratio %.2f)' % \
+        (size, compressed, gziputil.ratio(size, compressed)))
+    return compressed
+
+def acceptsgzip(request):
+    """Returns True if the client of a request accepts gzip encoded responses."""
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+def varyheader(request):
+    """Returns the Vary header of a cell response negotiated from the headers of a request.
+
+    The encoding depends on Accept-Encoding (see acceptsgzip), and the format 
+    on Accept when there is no f parameter (see responseformat).
+    """
+    if request.get('f', None):
+        return 'Accept-Encoding'
+    return 'Accept, Accept-Encoding'
+
+def valuesetag(cell_keys, variable_names, fmt, c):
+    """Returns the strong ETag of a response of cell values, before getting the cells.
+
+    It is a digest of the request (the sorted cell keys, variables, format
+    and c) and of the cache version of each key (see cacheversions), which
+    changes when the dataset, or the tile of a key, is invalidated after a
+    reload. The format is the one given by f or negotiated from Accept (see
+    responseformat), so each representation of a URL that varies on Accept
+    has its own ETag, as does the gzip encoded response (see gzipetag).
+    """
+    import hashlib
+    parts = [fmt, str(c), ','.join(variable_names)]
+    versions = cacheversions(cell_keys)
+    for version in sorted(versions.keys()):
+        parts.append('%s:%s' % (version, ','.join(sorted(versions[version]))))
+    return '"%s"' % hashlib.sha1('|'.join(parts)).hexdigest()
+
+def gzipetag(etag):
+    """Returns the ETag of the gzip encoded response of an ETag."""
+    return etag[:-1] + '-gzip"'
+
+def matchingetag(request, etag):
+    """Returns the ETag, in either encoding, matched by the If-None-Match header of a request, or None."""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return None
+    tags = [x.strip() for x in header.split(',')]
+    if '*' in tags or etag in tags:
+        return etag
+    if acceptsgzip(request) and gzipetag(etag) in tags:
+        return gzipetag(etag)
+    return None
+
+def cacheheaders(headers, etag, request):
+    """Sets the headers that make a response with an ETag cacheable for VALUES_MAX_AGE seconds.
+
+    Responses in a format negotiated from Accept, rather than given by the 
+    f parameter, are only cacheable by the client, since shared caches may
+    not honor Vary: Accept (see varyheader).
+    """
+    headers['ETag'] = etag
+    if request.get('f', None):
+        headers['Cache-Control'] = 'public, max-age=%s' % VALUES_MAX_AGE
+    else:
+        headers['Cache-Control'] = 'private, max-age=%s' % VALUES_MAX_AGE
+    headers['Vary'] = varyheader(request)
+
+def writecells(handler, fmt, items, variable_names, c, paged=False, cursor=None, etag=None):
+    """Writes a response of cells in a format, gzipped if large and accepted.
+
+    The encoded chunks are written to the buffered response as they are
+    produced (see writechunks), gzip compressed if the client accepts gzip
+    and there are at least GZIP_RESPONSE_CELLS cells. Paged responses carry the cursor of the next 
+    page in the X-Cursor header too, since CSV and binary bodies have no 
+    place for it.
+
+    Arguments:
+        handler - The webapp.RequestHandler.
+        fmt - The RESPONSE_FORMATS name.
+        items - A list of (cell key, cached cell) tuples.
+        variable_names - Optional list of the variable names to include.
+        c - True to include the cell coordinates.
+        paged - True if the response is a page with a cursor.
+        cursor - The cursor of the next page, or None if it is the last.
+        etag - The ETag of the response, which is then cacheable for 
+            VALUES_MAX_AGE seconds (see valuesetag), or None.
+
+    Returns:
+        The number of bytes written.
+    """
+    content_type, chunks = RESPONSE_FORMATS.get(fmt)
+    headers = handler.response.headers
+    headers['Content-Type'] = content_type
+    headers['Vary'] = varyheader(handler.request)
+    if paged and cursor:
+        headers['X-Cursor'] = cursor
+    gzipped = acceptsgzip(handler.request) and len(items) >= GZIP_RESPONSE_CELLS
+    if etag:
+        if gzipped:
+            etag = gzipetag(etag)
+        cacheheaders(headers, etag, handler.request)
+    return writechunks(handler, chunks(items, variable_names, c, paged, cursor), gzipped)
+
 class CouchDbCell(db.Model):
     """Models a CouchDB cell document.
 
     key_name - The cell key (e.g., 1-2).
+    schema - The VARIABLE_SCHEMAS version of values, or 0 if the variable 
+        names are listed in variables.
+    values - The tab separated JSON encoded variable values in schema order.
+    varvals - The JSON encoded variable values of entities stored before
+        values were packed.
+    version - The cache version the cell was stored under (see 
+        cacheversions), such as 'v1'. Entities stored before versioning 
+        have none, and are read as 'v1'.
     """
     rev = db.StringProperty(required=True, indexed=False)
     coords = db.StringProperty(required=True, indexed=False)
-    varvals = db.TextProperty(required=True)
+    schema = db.IntegerProperty(indexed=False)
+    variables = db.StringListProperty(indexed=False)
+    values = db.TextProperty()
+    varvals = db.TextProperty()
+    version = db.StringProperty(indexed=False)
+
+    @classmethod
+    def fromcell(cls, cellkey, cell, version):
+        """Returns a CouchDbCell for a cached cell tuple (see packcell) and cache version."""
+        schema, rev, coords, values = cell
+        variables = []
+        if isinstance(schema, tuple):
+            variables = list(schema)
+            schema = 0
+        return cls(
+            key_name=cellkey,
+            rev=rev,
+            coords=coords,
+            schema=schema,
+            variables=variables,
+            values=db.Text('\t'.join(values)),
+            version=version)
+
+    def tocell(self):
+        """Returns the cached cell tuple for this entity (see packcell)."""
+        if self.values is None:
+            return packcell(
+                self.rev, 
+                simplejson.loads(self.coords), 
+                simplejson.loads(self.varvals))
+        schema = self.schema
+        if not schema:
+            schema = tuple(self.variables)
+        return (schema, self.rev, self.coords, tuple(self.values.split('\t')))
 
     def __eq__(self, other):
         if isinstance(other, CouchDbCell):
@@ -69,6 +1095,40 @@ class CouchDbCell(db.Model):
     def __cmp__(self, other):
         return self.key().__cmp__(other.key())
 
+class CouchDbBlock(db.Model):
+    """Models a block of CouchDB cell documents (see rmg.blockkey).
+
+    key_name - The block key (e.g., 830-337).
+    cells - The packed dictionary of cell key to cached cell of every cell 
+        loaded in the block (see cachepack.packblock). Cells not in it are 
+        missing.
+    version - The cache version the block was built under (see 
+        cacheversions), such as 'v1'. Blocks built before versioning have
+        none, and are read as 'v1'.
+    """
+    cells = db.BlobProperty(required=True)
+    version = db.StringProperty(indexed=False)
+
+class DatasetVersion(db.Model):
+    """Models the cache version of the cells of a CouchDB database.
+
+    Bumping version moves every cached cell and block to a new memcache 
+    namespace, and makes their datastore entities stale, while the old 
+    entries age out. Bumping the version of a tile does the same for the 
+    cells in that tile only (see InvalidateHandler).
+
+    key_name - The CouchDB database name.
+    version - The dataset version.
+    tiles - The JSON encoded dictionary of tile key (see tilekey) to the 
+        number of times the tile was invalidated since version was bumped.
+    """
+    version = db.IntegerProperty(required=True, default=1)
+    tiles = db.TextProperty(default='{}')
+
+    def config(self):
+        """Returns the (version, tiles) tuple of this entity."""
+        return (self.version, simplejson.loads(self.tiles or '{}'))
+
 class Variable(db.Expando):
     """Variable metadata."""
     name = db.StringProperty()
@@ -78,197 +1138,1510 @@ class CellValuesHandler(webapp.RequestHandler):
 
     @classmethod
     def fromds(cls, cell_keys):
-        """Returns CouchDBCell entities from a datastore query on cell keys.
+        """Returns cached cells from a datastore query on cell keys.
 
         Arguments:
             cell_keys - A set of cell key strings (e.g., 9-15).
 
         Returns:
-            A dictionary of cell key to CouchDBCell.
+            A dictionary of cell key to cached cell (see packcell).
         """
-        entities = CouchDbCell.get_by_key_name(cell_keys)
-        cells = {}
-        for x in entities:
-            if x:
-                cells[x.key().name()] = x
-        return cells
+        return cls.fromdsrpc(cell_keys).get_result()
+
+    @classmethod
+    def fromdsrpc(cls, cell_keys):
+        """Starts an asynchronous datastore get on cell keys.
+
+        Entities stored under an earlier cache version are ignored (see 
+        asyncdsget for how the get is made asynchronous).
+
+        Arguments:
+            cell_keys - A set of cell key strings (e.g., 9-15).
+
+        Returns:
+            An RPC whose get_result() is a dictionary of cell key to cached cell.
+        """
+        versions = {}
+        for version, keys in cacheversions(cell_keys).iteritems():
+            versions.update(dict.fromkeys(keys, version))
+        def hook(entities):
+            cells = {}
+            for x in entities:
+                if x and x.get('version', 'v1') == versions.get(x.key().name()):
+                    cells[x.key().name()] = CouchDbCell.from_entity(x).tocell()
+            return cells
+        keys = [db.Key.from_path('CouchDbCell', x) for x in cell_keys]
+        return asyncdsget(keys, hook)
 
     @classmethod
     def fromcouchdb(cls, cell_keys):
-        """Returns CouchDBCell entities from a CouchDB query on cell keys.
+        """Returns cached cells from a CouchDB query on cell keys.
         
         Arguments:
             cell_keys - A set of cell key strings (e.g., 9-15).
 
         Returns:
-            A dictionary of cell key to CouchDBCell.
+            A dictionary of cell key to cached cell (see packcell), without 
+            the keys of shards whose query failed.
+        """
+        return cls.couchdbcells(cls.fromcouchdbrpc(cell_keys))[0]
+
+    @classmethod
+    def fromcouchdbrpc(cls, cell_keys):
+        """Starts asynchronous CouchDB view queries on cell keys.
+
+        With shards (see getshards), there is a query per shard of the keys, 
+        all in flight at once.
+
+        Returns:
+            A list of (cell keys, RPC) tuples, one per query.
+        """
+        shards = getshards()
+        if not shards:
+            return [(list(cell_keys), 
+                     couchdbrpc(COUCHDB_URL, simplejson.dumps({'keys': list(cell_keys)})))]
+        return [(y, couchdbrpc(shards.viewurl(x, COUCHDB_DESIGN, COUCHDB_VIEW), 
+                               simplejson.dumps({'keys': y}))) \
+                    for x, y in shards.route(cell_keys).iteritems()]
+
+    @classmethod
+    def couchdbcells(cls, rpcs):
+        """Returns the cells of CouchDB view RPCs started by fromcouchdbrpc.
+
+        Returns:
+            A (cells, failed) tuple, where cells is a dictionary of cell key to
+            cached cell from the queries that succeeded, and failed is a set of
+            the keys of the queries that failed.
         """
-        logging.info(COUCHDB_URL)
-        response = urlfetch.fetch(
-            url=COUCHDB_URL,
-            payload=simplejson.dumps({'keys': list(cell_keys)}),
-            method=urlfetch.POST,
-            headers={"Content-Type":"application/json"})
-        if response.status_code != 200:
-            return {}
         cells = {}        
-        for row in simplejson.loads(response.content).get('rows'):            
-            key = row.get('key')
-            value = row.get('value')
-            cells[key] = CouchDbCell(
-                key_name=key,
-                rev=value.get('rev'),
-                coords=simplejson.dumps(value.get('coords')),
-                varvals=simplejson.dumps(value.get('varvals')))
-        return cells
+        failed = set()
+        for keys, rpc in rpcs:
+            try:
+                response = couchdbresponse(rpc)
+            except urlfetch.Error, e:
+                logging.error('CouchDB query of %s keys failed: %s' % (len(keys), e))
+                failed.update(keys)
+                continue
+            if response.status_code != 200:
+                logging.error('CouchDB query of %s keys failed with status %s' % \
+                    (len(keys), response.status_code))
+                failed.update(keys)
+                continue
+            for row in simplejson.loads(response.content).get('rows'):            
+                key = row.get('key')
+                value = row.get('value')
+                cells[key] = packcell(
+                    value.get('rev'), value.get('coords'), value.get('varvals'))
+        return cells, failed
+
+    @classmethod
+    def rangerpccount(cls, row_range):
+        """Returns the number of RPCs fromcouchdbrangerpc starts for a (y, x0, x1) row range."""
+        shards = getshards()
+        if not shards:
+            return 1
+        return len(shards.rangeshards(row_range))
+
+    @classmethod
+    def fromcouchdbrangerpc(cls, row_range, limit):
+        """Starts asynchronous CouchDB rows view queries on a (y, x0, x1) row range.
+
+        Returns:
+            A list of (shard index, RPC) tuples, one per shard holding cells 
+            of the range, where the index is None without shards.
+        """
+        y_index, x0, x1 = row_range
+        query = 'startkey=%s&endkey=%s&limit=%s' % \
+            (urllib.quote(simplejson.dumps([y_index, x0])),
+             urllib.quote(simplejson.dumps([y_index, x1])),
+             limit)
+        shards = getshards()
+        if not shards:
+            return [(None, couchdbrpc('%s?%s' % (COUCHDB_ROWS_URL, query)))]
+        return [(x, couchdbrpc('%s?%s' % (shards.viewurl(x, COUCHDB_DESIGN, COUCHDB_ROWS_VIEW), query))) \
+                    for x in shards.rangeshards(row_range)]
+
+    @classmethod
+    def couchdbrows(cls, rpcs):
+        """Returns the cells of rows view RPCs started by fromcouchdbrangerpc.
+
+        Returns:
+            A (cells, failed) tuple, where cells is a list of (x index, cell 
+            key, cached cell) in x order from the queries that succeeded, and
+            failed is a list of the shard indexes of the queries that failed
+            (see shardkeys).
+        """
+        cells = []
+        failed = []
+        for index, rpc in rpcs:
+            try:
+                response = couchdbresponse(rpc)
+            except urlfetch.Error, e:
+                logging.error('CouchDB range query failed: %s' % e)
+                failed.append(index)
+                continue
+            if response.status_code != 200:
+                logging.error('CouchDB range query failed with status %s' % response.status_code)
+                failed.append(index)
+                continue
+            for row in simplejson.loads(response.content).get('rows'):
+                y_index, x_index = row.get('key')
+                value = row.get('value')
+                cells.append((x_index, '%s-%s' % (x_index, y_index), packcell(
+                    value.get('rev'), value.get('coords'), value.get('varvals'))))
+        if len(rpcs) > 1:
+            # Each shard returns its cells of the range up to the limit, in x order.
+            cells.sort()
+        return cells, failed
+
+    @classmethod
+    def shardkeys(cls, cell_keys, indexes):
+        """Returns the set of cell keys held by shards, given their indexes (see couchdbrows)."""
+        shards = getshards()
+        if not shards or None in indexes:
+            return set(cell_keys)
+        return set([x for x in cell_keys if shards.shard(x) in indexes])
+
+    @classmethod
+    def scanruns(cls, cell_keys):
+        """Returns the longest row runs of cell keys worth a range scan (see keyruns).
+
+        Runs have at least RANGE_SCAN_MIN_CELLS cells, and there are at most 
+        RANGE_SCAN_MAX_RUNS of them.
+        """
+        runs = [x for x in keyruns(cell_keys) if x[2] - x[1] + 1 >= RANGE_SCAN_MIN_CELLS]
+        runs.sort(key=lambda x: x[1] - x[2])
+        return runs[:RANGE_SCAN_MAX_RUNS]
+
+    @classmethod
+    def backfill(cls, found, requested):
+        """Queues cells found in CouchDB for the datastore, and caches the rest as MISSING.
+
+        The datastore is written behind the request: the found cell keys are 
+        queued in tasks of BACKFILL_BATCH_KEYS for BackfillHandler, which 
+        reads the cells back from memcache, so the caller caches them first 
+        (see fetchcells). With BLOCK_CACHE, blocks that fromblocks will read,
+        those holding at least BLOCK_MIN_KEYS of the requested keys, and that
+        getblocks found not built, are queued to be built instead (see 
+        queueblocks). The cells of other blocks are still backfilled one by
+        one, so lookups that fromblocks skips are served from the datastore.
+
+        Arguments:
+            found - A dictionary of cell key to cached cell found in CouchDB.
+            requested - The cell keys that CouchDB was queried for.
+        """
+        keys = found.keys()
+        if BLOCK_CACHE and keys:
+            byblock = {}
+            for key in requested:
+                block_key = rmg.blockkey(key)
+                byblock[block_key] = byblock.get(block_key, 0) + 1
+            dense = [x for x, y in byblock.iteritems() if y >= BLOCK_MIN_KEYS]
+            unbuilt = set()
+            if dense:
+                unbuilt = set(cacheget(dense, BLOCK_UNBUILT_PREFIX, True).keys())
+            cls.queueblocks(unbuilt)
+            keys = [x for x in keys if rmg.blockkey(x) not in unbuilt]
+        addtasks(BACKFILL_URL, BACKFILL_QUEUE, 
+            [{'k': ','.join(keys[i:i + BACKFILL_BATCH_KEYS])} \
+                 for i in range(0, len(keys), BACKFILL_BATCH_KEYS)])
+        confirmed = dict.fromkeys(set(requested).difference(found.keys()), MISSING)
+        if confirmed:
+            cacheset(confirmed, time=NEGATIVE_CACHE_TTL)
+            localset(confirmed, ttl=NEGATIVE_CACHE_TTL)
 
     @classmethod
-    def getcells(cls, cell_keys):
-        """Gets CouchDBCell entities corresponding to a set of cell keys.
+    def queueblocks(cls, block_keys):
+        """Queues tasks for BackfillHandler to build blocks from CouchDB.
+
+        Blocks queued within the last BLOCK_BUILD_TTL seconds are skipped. 
+        Callers only pass blocks just found not built in the datastore, so 
+        built blocks are not queued again once that has expired.
+
+        Arguments:
+            block_keys - A set of block key strings (see rmg.blockkey).
+        """
+        if not block_keys:
+            return
+        queued = cacheadd(dict.fromkeys(block_keys, 1), BLOCK_BUILD_PREFIX, True, 
+            time=BLOCK_BUILD_TTL)
+        keys = list(set(block_keys).difference(queued))
+        failed = addtasks(BACKFILL_URL, BACKFILL_QUEUE, 
+            [{'b': ','.join(keys[i:i + BLOCK_BUILD_BATCH])} \
+                 for i in range(0, len(keys), BLOCK_BUILD_BATCH)])
+        if failed:
+            cachedelete([x for params in failed for x in params['b'].split(',')], 
+                BLOCK_BUILD_PREFIX, True)
+
+    @classmethod
+    def blocksfromds(cls, block_keys):
+        """Returns a dictionary of block key to packed cells of the blocks stored in the datastore.
+
+        Blocks built under an earlier cache version are ignored.
+        """
+        versions = {}
+        for version, keys in cacheversions(block_keys, True).iteritems():
+            versions.update(dict.fromkeys(keys, version))
+        stored = {}
+        for entity in CouchDbBlock.get_by_key_name(list(block_keys)):
+            if entity and (entity.version or 'v1') == versions.get(entity.key().name()):
+                stored[entity.key().name()] = entity.cells
+        return stored
+
+    @classmethod
+    def getblocks(cls, block_keys):
+        """Gets the cells of built blocks.
+
+        Blocks are read from memcache and then the datastore, and blocks 
+        found in the datastore are cached in memcache. Blocks found in neither
+        are marked as not built in memcache for BLOCK_BUILD_TTL seconds, or 
+        until they are built, so they are not looked up again. With PREFETCH_BLOCKS,
+        blocks found in memcache that PrefetchHandler warmed are counted as 
+        prefetch hits, and blocks not in memcache as prefetch misses.
+
+        Arguments:
+            block_keys - A list of block key strings (see rmg.blockkey).
+
+        Returns:
+            A dictionary of block key to a dictionary of cell key to cached 
+            cell, for the blocks that are built.
+        """
+        prefixes = (BLOCK_PREFIX, BLOCK_UNBUILT_PREFIX)
+        if PREFETCH_BLOCKS:
+            prefixes = (BLOCK_PREFIX, BLOCK_UNBUILT_PREFIX, PREFETCHED_PREFIX)
+        found = cachegetprefixes(block_keys, prefixes, True)
+        packed = found[BLOCK_PREFIX]
+        if PREFETCH_BLOCKS:
+            hits = [x for x in packed if x in found[PREFETCHED_PREFIX]]
+            if hits:
+                cachedelete(hits, PREFETCHED_PREFIX, True)
+            countprefetch({'hits': len(hits), 'misses': len(block_keys) - len(packed)})
+        unknown = [x for x in block_keys \
+                       if x not in packed and x not in found[BLOCK_UNBUILT_PREFIX]]
+        if unknown:
+            stored = cls.blocksfromds(unknown)
+            if stored:
+                cacheset(stored, BLOCK_PREFIX, True)
+                packed.update(stored)
+            unbuilt = [x for x in unknown if x not in stored]
+            if unbuilt:
+                cacheset(dict.fromkeys(unbuilt, 1), BLOCK_UNBUILT_PREFIX, True, 
+                    time=BLOCK_BUILD_TTL)
+        blocks = {}
+        for key, value in packed.iteritems():
+            cells = cachepack.unpackblock(value)
+            if cells is not None:
+                blocks[key] = cells
+        return blocks
+
+    @classmethod
+    def prefetch(cls, block_keys):
+        """Starts queueing the blocks adjacent to served blocks to be warmed in memcache.
+
+        Blocks adjacent to the most served blocks come first, up to 
+        PREFETCH_BLOCKS, skipping blocks this instance queued within the last
+        PREFETCH_TTL seconds. PrefetchHandler does the warming behind the 
+        request. The task is added asynchronously (see addtasksasync), so 
+        callers start the prefetch before writing the response and finish it
+        after (see waitprefetch).
+
+        Arguments:
+            block_keys - The keys of the blocks served (see rmg.blockkey).
+
+        Returns:
+            A (rpc, keys) tuple for waitprefetch, or None if nothing was queued.
+        """
+        if not BLOCK_CACHE or not PREFETCH_BLOCKS or not block_keys:
+            return None
+        served = set(block_keys)
+        adjacency = {}
+        for key in served:
+            for neighbour in rmg.blockneighbours(key):
+                if neighbour not in served:
+                    adjacency[neighbour] = adjacency.get(neighbour, 0) + 1
+        candidates = sorted(adjacency.keys(), key=lambda x: (-adjacency[x], x))
+        candidates = candidates[:PREFETCH_BLOCKS]
+        queued = LOCAL_CACHE.get_multi([PREFETCH_PREFIX + x for x in candidates])
+        keys = [x for x in candidates if PREFETCH_PREFIX + x not in queued]
+        if not keys:
+            return None
+        LOCAL_CACHE.set_multi(dict([(PREFETCH_PREFIX + x, 1) for x in keys]), ttl=PREFETCH_TTL)
+        rpc = addtasksasync(PREFETCH_URL, PREFETCH_QUEUE, [{'b': ','.join(keys)}])
+        return rpc, keys
+
+    @classmethod
+    def waitprefetch(cls, prefetch):
+        """Waits for a prefetch started by prefetch, if any, logging failures."""
+        if not prefetch:
+            return
+        rpc, keys = prefetch
+        try:
+            rpc.check_success()
+            countprefetch({'queued': len(keys)})
+        except apiproxy_errors.Error, e:
+            LOCAL_CACHE.delete_multi([PREFETCH_PREFIX + x for x in keys])
+            logging.warning('Prefetch of %s blocks not queued: %s' % (len(keys), e))
+
+    @classmethod
+    def fromblocks(cls, cell_keys):
+        """Returns cached cells sliced out of the built blocks containing them.
+
+        Only blocks holding at least BLOCK_MIN_KEYS of the keys are read, 
+        since a block is read and unpacked whole, and a few scattered keys 
+        are cheaper to get from memcache one by one.
+
+        Arguments:
+            cell_keys - A set of cell key strings (e.g., 9-15).
+
+        Returns:
+            A (cells, absent) tuple, where cells is a dictionary of cell key 
+            to cached cell, and absent is a set of the keys of cells missing 
+            from their built blocks. Keys in blocks that are not built yet or
+            not read are in neither.
+        """
+        byblock = {}
+        for key in cell_keys:
+            byblock.setdefault(rmg.blockkey(key), []).append(key)
+        for block_key, keys in byblock.items():
+            if len(keys) < BLOCK_MIN_KEYS:
+                del byblock[block_key]
+        cells = {}
+        if not byblock:
+            return cells, set()
+        absent = set()
+        for block_key, block in cls.getblocks(byblock.keys()).iteritems():
+            for key in byblock[block_key]:
+                cell = block.get(key)
+                if cell is None:
+                    absent.add(key)
+                else:
+                    cells[key] = cell
+        return cells, absent
+
+    @classmethod
+    def getcells(cls, cell_keys, stats=None):
+        """Gets cached cells corresponding to a set of cell keys.
+
+        Keys that are not in the Bloom filter of loaded cells are dropped 
+        first. The instance cache, cached blocks (with BLOCK_CACHE) and then 
+        memcache are checked next, all versioned (see cacheversions), and the
+        instance cache is filled with cells found in any tier. Misses are 
+        fetched from storage (see fetchcells), coalesced with fetches of the 
+        same keys on other instances if leases are on (see coalescedfetch). 
+        Tier statistics are logged.
         
         Arguments:
             cell_keys - A set of cell key strings (e.g., 9-15).
+            stats - Optional tierstats.RequestStats to add the tiers to. Its 
+                unresolved count is set to the number of keys neither found 
+                nor confirmed missing, because a backend failed.
 
         Returns:
-            A dictionary of cell key to CouchDBCell.
+            A dictionary of cell key to cached cell (see packcell).
         """
         cells = {}
+        if stats is None:
+            stats = tierstats.RequestStats()
+        first = len(stats.tiers)
+        t0 = time.time()
+
+        # Drops keys of cells that were never loaded:
+        cellfilter = getcellfilter()
+        if cellfilter:
+            absent = set([x for x in cell_keys if x not in cellfilter])
+            cell_keys = cell_keys.difference(absent)
+            stats.add('bloom', len(absent), len(absent) + len(cell_keys), detail='absent')
+
+        # Checks the instance cache:
+        local = localget(cell_keys)
+        cell_keys = cell_keys.difference(local.keys())
+        for key, value in local.items():
+            if value == MISSING:
+                del local[key]
+        cells.update(local)
+        t1 = time.time()
+        stats.add('local', len(local), len(local) + len(cell_keys), (t1 - t0) * 1000)
+        if not cell_keys:
+            logging.info('Cell lookup: %s' % stats.summary(first))
+            return cells
+
+        # Checks cached blocks, in which cells that are not found are missing:
+        blocked = {}
+        if BLOCK_CACHE:
+            blocked, absent = cls.fromblocks(cell_keys)
+            cell_keys = cell_keys.difference(blocked.keys()).difference(absent)
+            cells.update(blocked)
+            localset(blocked)
+            if absent:
+                localset(dict.fromkeys(absent, MISSING), ttl=NEGATIVE_CACHE_TTL)
+            t0 = t1
+            t1 = time.time()
+            stats.add('blocks', len(blocked) + len(absent), 
+                len(blocked) + len(absent) + len(cell_keys), (t1 - t0) * 1000)
+            if not cell_keys:
+                logging.info('Cell lookup: %s' % stats.summary(first))
+                return cells
         
-        # Checks cache:
-        cached = memcache.get_multi(cell_keys)
-        cells.update(cached)
+        # Checks cache, ignoring entries that are not cached cell tuples:
+        cached = cacheget(cell_keys)
+        for key, value in cached.items():
+            if not isinstance(value, tuple):
+                del cached[key]
         cell_keys = cell_keys.difference(cached.keys())
+        missing = dict([(x, y) for x, y in cached.items() if y == MISSING])
+        for key in missing:
+            del cached[key]
+        cells.update(cached)
+        t0 = t1
+        t1 = time.time()
+        stats.add('memcache', len(cached) + len(missing), 
+            len(cached) + len(missing) + len(cell_keys), (t1 - t0) * 1000)
 
-        cachecells = False
+        fetched = {}
+        if len(cell_keys) > 0:
+            fetched = cls.coalescedfetch(cell_keys, stats)
+            stats.unresolved = len(cell_keys) - len(fetched)
+            for key, value in fetched.items():
+                if value == MISSING:
+                    missing[key] = value
+                    del fetched[key]
+            cells.update(fetched)
+
+        cached.update(fetched)
+        localset(cached)
+        if missing:
+            localset(missing, ttl=NEGATIVE_CACHE_TTL)
+        logging.info('Cell lookup: %s' % stats.summary(first))
+        return cells
+
+    @classmethod
+    def coalescedfetch(cls, cell_keys, stats):
+        """Fetches cells from storage, coalescing with fetches on other instances.
+
+        With MEMCACHE_LEASES, a memcache lease is taken on each key, and keys 
+        leased by another instance are polled in memcache until that instance
+        caches them. Keys whose wait times out are fetched after all.
+
+        Arguments:
+            cell_keys - A set of cell key strings missed by the caches.
+            stats - The tierstats.RequestStats to add the tiers to.
+
+        Returns:
+            A dictionary of cell key to cached cell (see packcell), or MISSING
+            for keys confirmed missing. Keys whose fetch failed are left out.
+        """
+        if not MEMCACHE_LEASES:
+            return cls.fetchcells(cell_keys, stats)
+        leased = set(cacheadd(
+            dict.fromkeys(cell_keys, os.environ.get('INSTANCE_ID', '')), 
+            LEASE_PREFIX, time=LEASE_TTL))
+        owned = cell_keys.difference(leased)
+        fetched = {}
+        if owned:
+            try:
+                fetched.update(cls.fetchcells(owned, stats))
+            finally:
+                cachedelete(owned, LEASE_PREFIX)
+        if leased:
+            t0 = time.time()
+            found, timedout = cls.waitleased(leased)
+            fetched.update(found)
+            LEASE_STATS['waited'] += len(leased)
+            LEASE_STATS['refetched'] += len(timedout)
+            stats.add('leased', len(found), len(leased), (time.time() - t0) * 1000)
+            if timedout:
+                fetched.update(cls.fetchcells(set(timedout), stats))
+        return fetched
+
+    @classmethod
+    def waitleased(cls, leased):
+        """Polls memcache for cells leased by other instances until they are cached.
+
+        Returns:
+            A (cells, unresolved) tuple, where cells is a dictionary of cell 
+            key to cached cell or MISSING, and unresolved lists keys still 
+            leased at LEASE_WAIT_TIMEOUT.
+        """
+        cells = {}
+        pending = set(leased)
+        deadline = time.time() + LEASE_WAIT_TIMEOUT
+        while pending:
+            for key, value in cacheget(pending).iteritems():
+                if isinstance(value, tuple):
+                    pending.discard(key)
+                    cells[key] = value
+            if not pending:
+                break
+            # A lease released without a cached cell means the fetch failed:
+            released = pending.difference(cacheget(pending, LEASE_PREFIX).keys())
+            if released or time.time() >= deadline:
+                break
+            time.sleep(LEASE_POLL_INTERVAL)
+        return cells, list(pending)
+
+    @classmethod
+    def fetchcells(cls, cell_keys, stats):
+        """Fetches cells from the datastore and CouchDB, and caches them in memcache.
+
+        The datastore get is asynchronous and, with SPECULATIVE_COUCHDB, the 
+        CouchDB query for the same keys runs concurrently with it. Long runs 
+        of consecutive keys are range scanned from CouchDB instead. Cells 
+        found in CouchDB are cached in memcache and then backfilled, and keys 
+        that CouchDB confirms missing are cached as MISSING.
+
+        Arguments:
+            cell_keys - A set of cell key strings missed by the caches.
+            stats - The tierstats.RequestStats to add the tiers to.
+
+        Returns:
+            A dictionary of cell key to cached cell (see packcell), or MISSING
+            for keys confirmed missing. Keys of the CouchDB queries or shards
+            that failed are left out, and not cached as MISSING.
+        """
+        t1 = time.time()
+        fetched = {}
+        found = {}
+        requested = set()
+
+        # Range scans CouchDB for long runs of consecutive cells in a row:
+        runs = cls.scanruns(cell_keys)
+        runrpcs = [cls.fromcouchdbrangerpc(x, x[2] - x[1] + 1) for x in runs]
+        run_keys = set(['%s-%s' % (x, y) for y, x0, x1 in runs for x in range(x0, x1 + 1)])
+        cell_keys = cell_keys.difference(run_keys)
 
-        # Checks datastore:
         if len(cell_keys) > 0:
-            cachecells = True
-            stored = cls.fromds(cell_keys)
-            cells.update(stored)
+            # Checks datastore, and CouchDB for the same predicted misses:
+            dsrpc = cls.fromdsrpc(cell_keys)
+            couchrpc = None
+            if SPECULATIVE_COUCHDB:
+                couchrpc = cls.fromcouchdbrpc(cell_keys)
+            stored = dsrpc.get_result()
+            fetched.update(stored)
+            t2 = time.time()
+            stats.add('datastore', len(stored), len(cell_keys), (t2 - t1) * 1000)
             cell_keys = cell_keys.difference(stored.keys())
             
-        # Checks CouchDB:
-        if len(cell_keys) > 0:
-            cachecells = True
-            couched = cls.fromcouchdb(cell_keys)
-            cells.update(couched)
-            db.put(couched.values())
-            
-        if cachecells:
-            memcache.set_multi(cells)                        
+            # Checks CouchDB:
+            if len(cell_keys) > 0:
+                if not couchrpc:
+                    couchrpc = cls.fromcouchdbrpc(cell_keys)
+                couched, failed = cls.couchdbcells(couchrpc)
+                for key in couched.keys():
+                    if key not in cell_keys:
+                        del couched[key]
+                fetched.update(couched)
+                t3 = time.time()
+                stats.add('couchdb', len(couched), len(cell_keys), (t3 - t2) * 1000)
+                found.update(couched)
+                requested.update(cell_keys.difference(failed))
+            # Otherwise the datastore answered every key, and any speculative 
+            # CouchDB queries are left unread rather than waited on.
 
-        return cells
+        if runs:
+            scanned = {}
+            for (y_index, x0, x1), rpc in zip(runs, runrpcs):
+                rows, failed = cls.couchdbrows(rpc)
+                for x_index, key, cell in rows:
+                    scanned[key] = cell
+                keys = set(['%s-%s' % (x, y_index) for x in range(x0, x1 + 1)])
+                if failed:
+                    keys.difference_update(cls.shardkeys(keys, failed))
+                requested.update(keys)
+            fetched.update(scanned)
+            stats.add('couchdb_ranges', len(scanned), len(run_keys), 
+                (time.time() - t1) * 1000, 'in %s runs' % len(runs))
+            found.update(scanned)
+
+        if fetched:
+            cacheset(fetched)
+        # Backfill tasks read the cells from memcache, so they are queued after it is set:
+        if requested:
+            cls.backfill(found, requested)
+            fetched.update(dict.fromkeys(requested.difference(found.keys()), MISSING))
+        return fetched
 
     @classmethod
     def getcellsbycoords(cls, coords):
-        """Gets CouchDBCell entities corresponding to a set of lon, lat coordinates.
+        """Gets the cell keys corresponding to a set of lon, lat coordinates.
 
         Arguments:
             coords - A set of lon, lat coordinate pair strings (e.g., -121.3,34.7).
 
         Returns:
-            A dictionary of cell key to CouchDBCell.
+            A set of cell key strings.
         """
-        cell_keys = set()
+        points = []
         for coord in coords:
             lon, lat = coord.split(',')
-            cell_key = rmg.RMGCell.key(
-                float(lon), 
-                float(lat), 
-                rmg.CELLS_PER_DEGREE, 
-                rmg.SEMI_MAJOR_AXIS, 
-                rmg.INVERSE_FLATTENING)
-            cell_keys.add(cell_key)
-        return cell_keys
+            points.append((float(lon), float(lat)))
+        return set(rmg.pointkeys(points, rmg.CELLS_PER_DEGREE))
 
     def get(self):
         return self.post()
     
-    def getcellkeys(self, coords, resolution):
-        """Returns a rectangular cell index in the form x-y
-        where x is the number of cells west of lng to lng = -180 and
-        y is the number of cells north of lat to lat = 90."""
-        keys = set()
-        for xy in coords:
-            x,y = xy.split(',')            
-            dlat = 90 - float(y)
-            dlng = float(x) + 180
-            x = int(dlng/resolution)
-            y = int(dlat/resolution)
-            keys.add('%s-%s' % (x, y))
-        logging.info('RETURNING KEYS: ' + str(keys))
-        return keys
-
     def post(self):
+        t0 = time.time()
+        stats = tierstats.RequestStats(STATS_SAMPLE_RATE)
         xy = self.request.get('xy', None) # lon,lat|lon,lat|...
-        k = self.request.get('k', None)  # cellkey,cellkey,...
+        k = self.request.get('k', None)  # cellkey,y:x0-x1,...
         v = self.request.get('v', None) # varname,varname,...
         c = 'true' == self.request.get('c')
+        fmt = responseformat(self.request) # json, columnar, csv or binary
+
+        if not fmt:
+            logging.error('Unknown response format f=%s' % self.request.get('f'))
+            self.error(400)
+            return
 
-        logging.info('hi')
         if not k and not xy:
             logging.error('No cell keys for k=%s, xy=%s' % (k, xy))
             self.error(404)
             return
         
-        if k:
-            cell_keys = set([x.strip() for x in k.split(',')])
+        if xy:
+            coords = set([x.strip() for x in xy.split('|')])
+            cell_keys = CellValuesHandler.getcellsbycoords(coords)
         else:
-            cell_keys = self.getcellkeys([x.strip() for x in xy.split('|')], .0083)
+            try:
+                cell_keys = parsekeys(k)
+            except ValueError, e:
+                logging.error('Bad cell keys k=%s: %s' % (k, e))
+                self.error(400)
+                return
 
         if not cell_keys:
             logging.error('No cell keys for k=%s, xy=%s' % (k, xy))
             self.error(404)
             return
 
-        if v:
-            variable_names = set([x.strip() for x in v.split(',')])
+        variable_names = variablenames(v)
+
+        # GET responses are answered from the ETag alone if the client has them:
+        etag = None
+        if self.request.method == 'GET':
+            etag = valuesetag(cell_keys, variable_names, fmt, c)
+            matched = matchingetag(self.request, etag)
+            if matched:
+                self.response.set_status(304)
+                cacheheaders(self.response.headers, matched, self.request)
+                logging.info('Not modified: %s cells' % len(cell_keys))
+                stats.size = 0
+                recordstats(stats, t0)
+                return
+
+        prefetch = None
+        if BLOCK_CACHE and PREFETCH_BLOCKS:
+            prefetch = CellValuesHandler.prefetch(set([rmg.blockkey(x) for x in cell_keys]))
+        cells = CellValuesHandler.getcells(cell_keys, stats)        
+        if stats.unresolved:
+            # Responses missing cells that a backend failed to return are not cached:
+            etag = None
+            self.response.headers['Cache-Control'] = 'no-store'
+        stats.size = writecells(self, fmt, cells.items(), variable_names, c, etag=etag)
+        recordstats(stats, t0)
+        CellValuesHandler.waitprefetch(prefetch)
+
+class RegionHandler(webapp.RequestHandler):
+    """Handler for cell value requests on a bounding box or polygon region.
+
+    The region is turned into RMG row ranges, and each range is fetched from 
+    the CouchDB rows view as a single key range. Cells are returned in row 
+    order a page at a time, with a cursor for the next page.
+    """
+
+    @classmethod
+    def getranges(cls, bbox=None, polygon=None):
+        """Returns the RMG row ranges of a region (see rmg.bboxranges).
+
+        Arguments:
+            bbox - A west,south,east,north bounding box string.
+            polygon - A GeoJSON Polygon or MultiPolygon geometry dictionary.
+        """
+        if bbox:
+            west, south, east, north = [float(x) for x in bbox.split(',')]
+            return rmg.bboxranges(west, south, east, north, rmg.CELLS_PER_DEGREE)
+        geometry = polygon
+        if geometry.get('type') == 'Feature':
+            geometry = geometry.get('geometry')
+        if geometry.get('type') == 'Polygon':
+            rings = geometry.get('coordinates')
+        elif geometry.get('type') == 'MultiPolygon':
+            rings = [x for y in geometry.get('coordinates') for x in y]
         else:
-            variable_names = []
-        
-        cells = CellValuesHandler.getcells(cell_keys)        
+            raise ValueError('Unsupported geometry type %s' % geometry.get('type'))
+        return rmg.polygonranges(rings, rmg.CELLS_PER_DEGREE)
+
+    @classmethod
+    def blockrows(cls, row_range, blocks):
+        """Returns the cells of a row range sliced out of the built blocks containing it.
+
+        The blocks of the range are fetched into the blocks dictionary as they
+        are first needed (see CellValuesHandler.getblocks), with None for 
+        blocks that are not built yet, which are queued to be built.
+
+        Arguments:
+            row_range - A (y, x0, x1) row range.
+            blocks - A dictionary of block key to cells, or None if not built.
+
+        Returns:
+            A list of (x index, cell key, cached cell) as for 
+            CellValuesHandler.couchdbrows, or None if the range spans more than
+            REGION_MAX_RANGE_BLOCKS blocks or any of its blocks is not built.
+        """
+        y_index, x0, x1 = row_range
+        size = rmg.BLOCK_SIZE
+        if x1 // size - x0 // size >= REGION_MAX_RANGE_BLOCKS:
+            return None
+        needed = ['%s-%s' % (i, y_index // size) for i in range(x0 // size, x1 // size + 1)]
+        unknown = [x for x in needed if x not in blocks]
+        if unknown:
+            found = CellValuesHandler.getblocks(unknown)
+            for key in unknown:
+                blocks[key] = found.get(key)
+            CellValuesHandler.queueblocks([x for x in unknown if blocks[x] is None])
+        for key in needed:
+            if blocks[key] is None:
+                return None
+        rows = []
+        for x_index in range(x0, x1 + 1):
+            key = '%s-%s' % (x_index, y_index)
+            cell = blocks['%s-%s' % (x_index // size, y_index // size)].get(key)
+            if cell is not None:
+                rows.append((x_index, key, cell))
+        return rows
+
+    @classmethod
+    def resume(cls, ranges, cursor):
+        """Returns the row ranges that remain at a cursor cell key."""
+        x, y = [int(i) for i in cursor.split('-')]
+        remaining = []
+        for y_index, x0, x1 in ranges:
+            if y_index > y:
+                remaining.append((y_index, x0, x1))
+            elif y_index == y and x1 >= x:
+                remaining.append((y_index, max(x0, x), x1))
+        return remaining
+
+    def get(self):
+        return self.post()
+
+    def post(self):
+        bbox = self.request.get('bbox', None) # west,south,east,north
+        polygon = self.request.get('polygon', None) # GeoJSON geometry
+        v = self.request.get('v', None) # varname,varname,...
+        c = 'true' == self.request.get('c')
+        cursor = self.request.get('cursor', None) # cellkey
+        limit = self.request.get('limit', None)
+        fmt = responseformat(self.request) # json, columnar, csv or binary
+
+        if not fmt:
+            logging.error('Unknown response format f=%s' % self.request.get('f'))
+            self.error(400)
+            return
+        if not bbox and not polygon and self.request.body:
+            polygon = self.request.body
+        try:
+            if polygon:
+                polygon = simplejson.loads(polygon)
+            ranges = RegionHandler.getranges(bbox, polygon)
+            if cursor:
+                ranges = RegionHandler.resume(ranges, cursor)
+            limit = min(int(limit or REGION_PAGE_SIZE), REGION_MAX_PAGE_SIZE)
+        except (ValueError, TypeError, AttributeError), e:
+            logging.error('Bad region request bbox=%s, polygon=%s, cursor=%s: %s' % \
+                (bbox, polygon, cursor, e))
+            self.error(400)
+            return
+
+        variable_names = variablenames(v)
+
+        # Slices ranges out of cached blocks, or keeps up to REGION_RANGE_RPCS range 
+        # query RPCs in flight across shards, consuming the ranges in order:
+        t0 = time.time()
+        stats = tierstats.RequestStats(STATS_SAMPLE_RATE)
+        sliced = 0
+        scanned = 0
         results = []
-        if xy:
-            coords = set([x.strip() for x in xy.split('|')])
-            if not coords:
-                self.error(404)
-                return
-            logging.info('coords: %s' % str(coords))
+        pending = []
+        in_flight = 0
+        blocks = {}
+        next_range = 0
+        last = None
+        while len(results) < limit and (pending or next_range < len(ranges)):
+            while len(pending) < REGION_RANGE_RPCS and next_range < len(ranges):
+                row_range = ranges[next_range]
+                rows = None
+                if BLOCK_CACHE:
+                    rows = RegionHandler.blockrows(row_range, blocks)
+                if rows is not None:
+                    pending.append((next_range, None, rows))
+                else:
+                    count = CellValuesHandler.rangerpccount(row_range)
+                    if pending and in_flight + count > REGION_RANGE_RPCS:
+                        break
+                    rpc = CellValuesHandler.fromcouchdbrangerpc(row_range, limit - len(results))
+                    pending.append((next_range, rpc, None))
+                    in_flight += len(rpc)
+                next_range += 1
+            index, rpc, cells = pending.pop(0)
+            if rpc:
+                in_flight -= len(rpc)
+                cells, failed = CellValuesHandler.couchdbrows(rpc)
+                if failed:
+                    # A page missing the cells of a shard would skip them for good:
+                    self.error(503)
+                    return
+            cells = cells[:limit - len(results)]
+            if rpc:
+                scanned += len(cells)
+            else:
+                sliced += len(cells)
+            for x_index, cellkey, cell in cells:
+                results.append((cellkey, cell))
+                last = (index, x_index)
 
-            cell_keys = CellValuesHandler.getcellsbycoords(coords)
-            if not cell_keys:
-                self.error(404)
-                return
-            cells = CellValuesHandler.getcells(cell_keys)
-        elif k:
-            cell_keys = set([x.strip() for x in k.split(',')])
-            if not cell_keys:
-                self.error(404)
+        # The cursor is the cell after the last one returned, if the page is full:
+        next_cursor = None
+        if len(results) == limit and last:
+            index, x_index = last
+            y_index, x0, x1 = ranges[index]
+            if x_index < x1:
+                next_cursor = '%s-%s' % (x_index + 1, y_index)
+            elif index + 1 < len(ranges):
+                y_index, x0, x1 = ranges[index + 1]
+                next_cursor = '%s-%s' % (x0, y_index)
+        logging.info('Region lookup: %s cells from %s ranges and %s blocks in %.1f ms' % \
+            (len(results), next_range, len([x for x in blocks.values() if x is not None]), 
+             (time.time() - t0) * 1000))
+        stats.add('blocks', sliced, sliced)
+        stats.add('couchdb_ranges', scanned, scanned)
+        prefetch = CellValuesHandler.prefetch([x for x, y in blocks.iteritems() if y is not None])
+        stats.size = writecells(self, fmt, results, variable_names, c, True, next_cursor)
+        recordstats(stats, t0)
+        CellValuesHandler.waitprefetch(prefetch)
+
+class EnvelopeHandler(webapp.RequestHandler):
+    """Handler for requests on cells with values in ranges, optionally within a region.
+
+    Conditions are answered from the envelope index, which holds for each 
+    variable a RankSet of the cells in each of its value bins, a chunk of 
+    cell ranks per document. Bins inside a range match exactly, and bins 
+    overlapping a range edge give candidates that are checked against the 
+    cell values. Cells are returned in rank order a page at a time, with a 
+    cursor for the next page, and chunks outside the region are never read.
+    """
+
+    @classmethod
+    def getbins(cls):
+        """Returns the envelope index bins document, cached per instance.
+
+        The cached document is keyed by its revision, and revalidated with a
+        conditional GET at most once per ENVELOPE_CHECK_INTERVAL seconds, so
+        an envelope rebuilt by the sdl.py envelope command replaces it.
+        """
+        now = time.time()
+        cached = LOCAL_CACHE.get_multi([ENVELOPE_BINS_KEY]).get(ENVELOPE_BINS_KEY)
+        if cached and now - cached[0] < ENVELOPE_CHECK_INTERVAL:
+            return cached[2]
+        headers = {}
+        if cached and cached[1]:
+            headers['If-None-Match'] = cached[1]
+        response = couchdbresponse(couchdbrpc('%s/bins' % ENVELOPE_URL, headers=headers))
+        if response.status_code == 304:
+            bins = cached[2]
+        elif response.status_code == 200:
+            bins = simplejson.loads(response.content)
+        else:
+            logging.error('Envelope bins query failed with status %s' % response.status_code)
+            return None
+        rev = response.headers.get('ETag')
+        if not rev and bins.get('_rev'):
+            rev = '"%s"' % bins.get('_rev')
+        LOCAL_CACHE.set_multi({ENVELOPE_BINS_KEY: (now, rev, bins)})
+        return bins
+
+    @classmethod
+    def getconditions(cls, e, bins):
+        """Returns a list of (name, low, high, exact bins, edge bins) for a condition string.
+
+        Arguments:
+            e - A name,low,high|name,low,high|... condition string.
+            bins - The envelope index bins document.
+        """
+        conditions = []
+        for condition in e.split('|'):
+            name, low, high = [x.strip() for x in condition.split(',')]
+            low = float(low)
+            high = float(high)
+            exact = []
+            edge = []
+            for i, (binlow, binhigh) in enumerate(bins['variables'][name]):
+                if low <= binlow and binhigh <= high:
+                    exact.append(str(i))
+                elif binhigh >= low and binlow <= high:
+                    edge.append(str(i))
+            conditions.append((name, low, high, exact, edge))
+        return conditions
+
+    @classmethod
+    def regionranks(cls, ranges):
+        """Returns a RankSet of the cells in a list of row ranges (see rmg.bboxranges)."""
+        from sdl import rankset
+        offsets = rmg.rowoffsets(rmg.CELLS_PER_DEGREE)
+        runs = [(offsets[y] + x0, offsets[y] + x1 + 1) for y, x0, x1 in ranges]
+        runs.sort()
+        ranks = rankset.RankSet()
+        for start, end in runs:
+            ranks.addrange(start, end)
+        return ranks
+
+    @classmethod
+    def fromcouchdbchunksrpc(cls, names, chunks):
+        """Starts an asynchronous CouchDB query on the index documents of variables and chunks."""
+        keys = ['%s-%08d' % (x, y) for x in names for y in chunks]
+        return couchdbrpc('%s/_all_docs?include_docs=true' % ENVELOPE_URL, 
+                          simplejson.dumps({'keys': keys}))
+
+    @classmethod
+    def couchdbchunks(cls, rpc):
+        """Returns a dictionary of index document id to its bins dictionary, or None on failure."""
+        response = couchdbresponse(rpc)
+        if response.status_code != 200:
+            logging.error('Envelope chunk query failed with status %s' % response.status_code)
+            return None
+        chunks = {}
+        for row in simplejson.loads(response.content).get('rows'):
+            doc = row.get('doc')
+            if doc:
+                chunks[row.get('key')] = doc.get('bins')
+        return chunks
+
+    @classmethod
+    def binranks(cls, bins, indexes):
+        """Returns the union of the RankSets of the bins with the given indexes."""
+        import base64
+        from sdl import rankset
+        ranks = rankset.RankSet()
+        for i in indexes:
+            if i in bins:
+                ranks = ranks | rankset.RankSet.fromstring(base64.b64decode(bins[i]))
+        return ranks
+
+    def get(self):
+        return self.post()
+
+    def post(self):
+        e = self.request.get('e', None) # name,low,high|name,low,high|...
+        bbox = self.request.get('bbox', None) # west,south,east,north
+        polygon = self.request.get('polygon', None) # GeoJSON geometry
+        v = self.request.get('v', None) # varname,varname,...
+        c = 'true' == self.request.get('c')
+        cursor = self.request.get('cursor', None) # cellkey
+        limit = self.request.get('limit', None)
+        fmt = responseformat(self.request) # json, columnar, csv or binary
+
+        if not fmt:
+            logging.error('Unknown response format f=%s' % self.request.get('f'))
+            self.error(400)
+            return
+        if not e:
+            logging.error('No conditions for e=%s' % e)
+            self.error(404)
+            return
+        bins = EnvelopeHandler.getbins()
+        if not bins:
+            self.error(503)
+            return
+        from sdl import rankset
+        offsets = rmg.rowoffsets(rmg.CELLS_PER_DEGREE)
+        try:
+            conditions = EnvelopeHandler.getconditions(e, bins)
+            if polygon:
+                polygon = simplejson.loads(polygon)
+            if bbox or polygon:
+                region = EnvelopeHandler.regionranks(RegionHandler.getranges(bbox, polygon))
+            else:
+                region = rankset.RankSet([(0, offsets[-1])])
+            if cursor:
+                region = region & rankset.RankSet([(rmg.cellrank(cursor), offsets[-1])])
+            limit = min(int(limit or REGION_PAGE_SIZE), REGION_MAX_PAGE_SIZE)
+        except (ValueError, TypeError, AttributeError, KeyError), err:
+            logging.error('Bad envelope request e=%s, bbox=%s, polygon=%s, cursor=%s: %s' % \
+                (e, bbox, polygon, cursor, err))
+            self.error(400)
+            return
+
+        variable_names = variablenames(v)
+
+        # Chunks of the region, fetched a batch at a time with the next batch in flight:
+        t0 = time.time()
+        chunk_ranks = bins['chunk_ranks']
+        chunks = []
+        for start, end in region.runs:
+            for chunk in range(start / chunk_ranks, (end - 1) / chunk_ranks + 1):
+                if not chunks or chunks[-1] != chunk:
+                    chunks.append(chunk)
+        batches = [chunks[i:i + ENVELOPE_CHUNK_BATCH] \
+                       for i in range(0, len(chunks), ENVELOPE_CHUNK_BATCH)]
+        names = [x[0] for x in conditions]
+        candidates = []
+        edges = rankset.RankSet()
+        rpc = None
+        if batches:
+            rpc = EnvelopeHandler.fromcouchdbchunksrpc(names, batches[0])
+        for b, batch in enumerate(batches):
+            docs = EnvelopeHandler.couchdbchunks(rpc)
+            if docs is None:
+                self.error(503)
                 return
-            cells = CellValuesHandler.getcells(cell_keys)
-                    
-        for cellkey in cells.keys():
-            cell = cells.get(cellkey)
-            varvals = simplejson.loads(cell.varvals)
-            requested_varvals = {}
-            varvals = simplejson.loads(cell.varvals)
-            if len(variable_names) > 0:
-                for name in variable_names:
-                    requested_varvals[name] = varvals.get(name)
+            if b + 1 < len(batches):
+                rpc = EnvelopeHandler.fromcouchdbchunksrpc(names, batches[b + 1])
+            for chunk in batch:
+                span = rankset.RankSet([(chunk * chunk_ranks, (chunk + 1) * chunk_ranks)])
+                exact = maybe = region & span
+                for name, low, high, exact_bins, edge_bins in conditions:
+                    chunkbins = docs.get('%s-%08d' % (name, chunk)) or {}
+                    full = EnvelopeHandler.binranks(chunkbins, exact_bins)
+                    exact = exact & full
+                    maybe = maybe & (full | EnvelopeHandler.binranks(chunkbins, edge_bins))
+                edges = edges | (maybe - exact)
+                for rank in maybe:
+                    candidates.append(rank)
+                    if len(candidates) == limit:
+                        break
+                if len(candidates) == limit:
+                    break
+            if len(candidates) == limit:
+                break
+
+        # Candidates in edge bins are checked against their cell values:
+        keys = [rmg.rankkey(x) for x in candidates]
+        stats = tierstats.RequestStats(STATS_SAMPLE_RATE)
+        cells = CellValuesHandler.getcells(set(keys), stats)
+        results = []
+        for rank, key in zip(candidates, keys):
+            cell = cells.get(key)
+            if cell is None:
+                continue
+            if rank in edges:
+                matched = True
+                for name, low, high, exact_bins, edge_bins in conditions:
+                    value = cellvalue(cell, name)
+                    if value is None or value < low or value > high:
+                        matched = False
+                        break
+                if not matched:
+                    continue
+            results.append((key, cell))
+
+        next_cursor = None
+        if len(candidates) == limit:
+            next_cursor = rmg.rankkey(candidates[-1] + 1)
+        logging.info('Envelope lookup: %s/%s candidates matched from %s chunks in %.1f ms' % \
+            (len(results), len(candidates), len(chunks), (time.time() - t0) * 1000))
+        stats.size = writecells(self, fmt, results, variable_names, c, True, next_cursor)
+        recordstats(stats, t0)
+
+class AnnotateHandler(webapp.RequestHandler):
+    """Handler for annotating a large set of points with the values of their cells.
+
+    The request body is CSV with a header row that names longitude and 
+    latitude columns, or a JSON list of [lng, lat] pairs. Points are read a
+    batch at a time. Their keys are computed together, each distinct cell of
+    a batch is fetched once, and a row per point is written in input order,
+    with empty values (CSV) or null (JSON) for points that are not valid.
+
+    All points are annotated in one response. webapp buffers it until the 
+    request ends, gzip compressed when accepted, so a malformed body found
+    partway through is still answered with a 400.
+    """
+
+    @classmethod
+    def lnglat(cls, lng, lat):
+        """Returns (lng, lat) as floats, or (None, None) if they are not numbers in range."""
+        try:
+            if isinstance(lng, bool) or isinstance(lat, bool):
+                return None, None
+            lng, lat = float(lng), float(lat)
+        except (TypeError, ValueError):
+            return None, None
+        # NaN fails both comparisons:
+        if -180 <= lng <= 180 and -90 <= lat <= 90:
+            return lng, lat
+        return None, None
+
+    @classmethod
+    def csvpoints(cls, body, lng_column=None, lat_column=None):
+        """Returns the header and an iterator over (row, lng, lat) of a CSV body.
+
+        The lng and lat are None in rows where they are not numbers in range.
+        """
+        import csv
+        reader = csv.reader(StringIO.StringIO(body))
+        header = reader.next()
+        names = [x.strip().lower() for x in header]
+        def column(name, candidates):
+            if name:
+                candidates = [name.lower()]
+            for candidate in candidates:
+                if candidate in names:
+                    return names.index(candidate)
+            raise ValueError('No %s column in %s' % (' or '.join(candidates), header))
+        i = column(lng_column, LNG_COLUMNS)
+        j = column(lat_column, LAT_COLUMNS)
+        def points():
+            for row in reader:
+                if len(row) > max(i, j):
+                    lng, lat = AnnotateHandler.lnglat(row[i], row[j])
+                    yield row, lng, lat
+                else:
+                    yield row, None, None
+        return header, points()
+
+    @classmethod
+    def jsonpoints(cls, body):
+        """Returns an iterator over (None, lng, lat) of the items of a JSON list body.
+
+        The list is decoded an item at a time, so that a list of a million 
+        points is never held in memory as Python objects. The lng and lat are
+        None for items that are not a [lng, lat] pair of numbers in range. A 
+        ValueError is raised if the body is not a JSON list, here if it does
+        not start as one, otherwise by the iterator where decoding fails.
+        """
+        decoder = simplejson.JSONDecoder()
+        i = JSON_SPACE.match(body).end()
+        if body[i:i + 1] != '[':
+            raise ValueError('Body is not a JSON list')
+        def points(i):
+            i = JSON_SPACE.match(body, i + 1).end()
+            if body[i:i + 1] == ']':
+                i += 1
+            else:
+                while True:
+                    item, i = decoder.raw_decode(body, idx=i)
+                    if isinstance(item, list) and len(item) == 2:
+                        lng, lat = AnnotateHandler.lnglat(item[0], item[1])
+                        yield None, lng, lat
+                    else:
+                        yield None, None, None
+                    i = JSON_SPACE.match(body, i).end()
+                    delimiter = body[i:i + 1]
+                    i = JSON_SPACE.match(body, i + 1).end()
+                    if delimiter == ']':
+                        break
+                    if delimiter != ',':
+                        raise ValueError('Expected , or ] at character %s' % i)
+            if body[i:].strip():
+                raise ValueError('Extra data after the JSON list at character %s' % i)
+        return points(i)
+
+    @classmethod
+    def batches(cls, points, size):
+        """Iterates over lists of up to size items of an iterator."""
+        batch = []
+        for point in points:
+            batch.append(point)
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @classmethod
+    def annotated(cls, points, header, variable_names, fmt, stats=None):
+        """Iterates over the response chunks for points, a batch at a time.
+
+        Tier statistics of the cell lookups are added to the optional 
+        tierstats.RequestStats.
+        """
+        import csv
+        if fmt == 'csv':
+            buf = StringIO.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow((header or ['lng', 'lat']) + ['cell-key'] + variable_names)
+            yield buf.getvalue()
+        else:
+            yield '['
+        count = 0
+        for batch in AnnotateHandler.batches(points, ANNOTATE_BATCH_POINTS):
+            located = rmg.pointkeys(
+                [(x[1], x[2]) for x in batch if x[1] is not None], rmg.CELLS_PER_DEGREE)
+            located.reverse()
+            keys = []
+            for point in batch:
+                if point[1] is None:
+                    keys.append(None)
+                else:
+                    keys.append(located.pop())
+            cells = CellValuesHandler.getcells(set([x for x in keys if x]), stats)
+            buf = StringIO.StringIO()
+            if fmt == 'csv':
+                writer = csv.writer(buf)
+                values = dict([(x, [csvvalue(v) for v in y]) \
+                                   for x, cell, y in cellrows(cells.items(), variable_names)])
+                empty = [''] * len(variable_names)
+                for point, cellkey in zip(batch, keys):
+                    row = point[0] or [repr(point[1]), repr(point[2])]
+                    writer.writerow(row + [cellkey or ''] + values.get(cellkey, empty))
+            else:
+                for cellkey in keys:
+                    if count:
+                        buf.write(', ')
+                    count += 1
+                    cell = cells.get(cellkey)
+                    if cellkey is None:
+                        buf.write('null')
+                    elif cell:
+                        buf.write(cellfragment(cellkey, cell, variable_names))
+                    else:
+                        buf.write('{"cell-key": %s, "cell-values": null}' % \
+                                      simplejson.dumps(cellkey))
+            yield buf.getvalue()
+        if fmt != 'csv':
+            yield ']'
+
+    def post(self):
+        import csv
+        v = self.request.get('v', None) # varname,varname,...
+        f = self.request.get('f', None) # json or csv
+        lng_column = self.request.get('lng', None) # CSV longitude column name
+        lat_column = self.request.get('lat', None) # CSV latitude column name
+
+        body = self.request.body
+        is_json = 'json' in self.request.headers.get('Content-Type', '')
+        try:
+            if is_json:
+                header = None
+                points = AnnotateHandler.jsonpoints(body)
+            else:
+                header, points = AnnotateHandler.csvpoints(body, lng_column, lat_column)
+        except (ValueError, StopIteration, csv.Error), e:
+            logging.error('Bad annotate request: %s' % e)
+            self.error(400)
+            return
+        fmt = f or (is_json and 'json' or 'csv')
+        if fmt not in ('json', 'csv'):
+            logging.error('Unknown annotate format f=%s' % f)
+            self.error(400)
+            return
+
+        variable_names = variablenames(v)
+        if fmt == 'csv' and not variable_names:
+            variable_names = list(VARIABLE_SCHEMAS.get(max(VARIABLE_SCHEMAS.keys())))
+        self.response.headers['Content-Type'] = RESPONSE_FORMATS.get(fmt)[0]
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        t0 = time.time()
+        stats = tierstats.RequestStats(STATS_SAMPLE_RATE)
+        try:
+            stats.size = writechunks(self, 
+                AnnotateHandler.annotated(points, header, variable_names, fmt, stats), 
+                acceptsgzip(self.request))
+        except (ValueError, csv.Error), e:
+            # Nothing has been sent yet, since the response is buffered:
+            logging.error('Bad annotate request body: %s' % e)
+            for name in ('Content-Encoding', 'Content-Type', 'Vary'):
+                if name in self.response.headers:
+                    del self.response.headers[name]
+            self.error(400)
+            return
+        logging.info('Annotated %s bytes of points in %.1f ms' % \
+            (len(body), (time.time() - t0) * 1000))
+        recordstats(stats, t0)
+
+class BackfillHandler(webapp.RequestHandler):
+    """Task handler that stores cells queued by CellValuesHandler.backfill in the datastore."""
+
+    def buildblocks(self, block_keys):
+        """Builds blocks from CouchDB range scans of their rows, and stores and caches them.
+
+        Blocks are only stored if every range scan succeeds, since cells not
+        in a block are taken as missing. Otherwise the task fails and is 
+        retried. Blocks are stored under the cache version current when the 
+        build starts, so a build overtaken by an invalidation is ignored.
+        """
+        versions = {}
+        for version, keys in cacheversions(block_keys, True).iteritems():
+            versions.update(dict.fromkeys(keys, version))
+        blocks = dict([(x, {}) for x in block_keys])
+        # Batches the range scans so that up to REGION_RANGE_RPCS RPCs are in flight:
+        batches = [[]]
+        in_flight = 0
+        for block_key in block_keys:
+            for row_range in rmg.blockranges(block_key):
+                count = CellValuesHandler.rangerpccount(row_range)
+                if batches[-1] and in_flight + count > REGION_RANGE_RPCS:
+                    batches.append([])
+                    in_flight = 0
+                batches[-1].append((block_key, row_range))
+                in_flight += count
+        for batch in batches:
+            rpcs = [(x, CellValuesHandler.fromcouchdbrangerpc(y, y[2] - y[1] + 1)) \
+                        for x, y in batch]
+            for block_key, rpc in rpcs:
+                rows, failed = CellValuesHandler.couchdbrows(rpc)
+                if failed:
+                    logging.error('Build of blocks %s failed' % ','.join(block_keys))
+                    self.error(500)
+                    return
+                for x_index, key, cell in rows:
+                    blocks[block_key][key] = cell
+        packed = dict([(x, cachepack.packblock(y)) for x, y in blocks.iteritems()])
+        db.put([CouchDbBlock(key_name=x, cells=db.Blob(y), version=versions[x]) \
+                    for x, y in packed.iteritems()])
+        cacheset(packed, BLOCK_PREFIX, True)
+        cachedelete(packed.keys(), BLOCK_UNBUILT_PREFIX, True)
+        logging.info('Built %s blocks of %s cells in %s bytes' % \
+            (len(blocks), sum([len(x) for x in blocks.values()]), 
+             sum([len(x) for x in packed.values()])))
+
+    def post(self):
+        block_keys = [x for x in self.request.get('b', '').split(',') if x]
+        if block_keys:
+            self.buildblocks(block_keys)
+            return
+        cell_keys = set([x for x in self.request.get('k', '').split(',') if x])
+        versions = {}
+        for version, keys in cacheversions(cell_keys).iteritems():
+            versions.update(dict.fromkeys(keys, version))
+        cells = cacheget(cell_keys)
+        for key, value in cells.items():
+            if not isinstance(value, tuple) or value == MISSING:
+                del cells[key]
+        evicted = cell_keys.difference(cells.keys())
+        if evicted:
+            cells.update(CellValuesHandler.fromcouchdb(evicted))
+        db.put([CouchDbCell.fromcell(x, y, versions[x]) for x, y in cells.iteritems()])
+        logging.info('Backfilled %s/%s cells, %s read from CouchDB' % \
+            (len(cells), len(cell_keys), len(evicted)))
+
+class PrefetchHandler(webapp.RequestHandler):
+    """Task handler that warms memcache with blocks queued by CellValuesHandler.prefetch.
+
+    Blocks read from the datastore are marked as prefetched, so that 
+    requests served from them count as prefetch hits (see 
+    CellValuesHandler.getblocks). Blocks that are not built yet are queued 
+    to be built, which also caches them.
+    """
+
+    def post(self):
+        block_keys = [x for x in self.request.get('b', '').split(',') if x]
+        cached = cacheget(block_keys, BLOCK_PREFIX, True)
+        unknown = [x for x in block_keys if x not in cached]
+        stored = CellValuesHandler.blocksfromds(unknown)
+        if stored:
+            cacheset(stored, BLOCK_PREFIX, True)
+            cacheset(dict.fromkeys(stored.keys(), 1), PREFETCHED_PREFIX, True, 
+                time=PREFETCH_TTL)
+        unbuilt = [x for x in unknown if x not in stored]
+        CellValuesHandler.queueblocks(unbuilt)
+        countprefetch({'warmed': len(stored), 'building': len(unbuilt)})
+        logging.info('Prefetched %s/%s blocks, %s cached and %s not built' % \
+            (len(stored), len(block_keys), len(cached), len(unbuilt)))
+
+class InvalidateHandler(webapp.RequestHandler):
+    """Handler for cache invalidation requests, made after cells are reloaded into CouchDB.
+
+    With no parameters, the dataset version is bumped. With bbox or t, only 
+    the versions of the tiles intersecting the bounding box, or listed, are 
+    bumped, and the blocks of those tiles are deleted from the datastore in 
+    the background. Cells in other tiles stay cached.
+    """
+
+    @classmethod
+    def bboxtiles(cls, bbox):
+        """Returns the set of keys of the tiles intersecting a west,south,east,north bounding box."""
+        west, south, east, north = [float(x) for x in bbox.split(',')]
+        size = rmg.BLOCK_SIZE * TILE_BLOCKS
+        tiles = set()
+        for y_index, x0, x1 in rmg.bboxranges(west, south, east, north):
+            for i in range(x0 // size, x1 // size + 1):
+                tiles.add('%s-%s' % (i, y_index // size))
+        return tiles
+
+    @classmethod
+    def bump(cls, tiles):
+        """Bumps the version of tiles, or of the dataset if tiles is empty, returning (version, tiles)."""
+        def txn():
+            entity = DatasetVersion.get_by_key_name(COUCHDB_DATABASE)
+            if entity is None:
+                entity = DatasetVersion(key_name=COUCHDB_DATABASE)
+            version, versions = entity.config()
+            if tiles:
+                for tile in tiles:
+                    versions[tile] = versions.get(tile, 0) + 1
             else:
-                requested_varvals = varvals
-            result = {'cell-key': cellkey, 
-                      'cell-values': requested_varvals}
-            if c:
-                result['cell-coords'] = simplejson.loads(cell.coords)
-            results.append(result)
-        json = simplejson.dumps(results)
+                version += 1
+                versions = {}
+            entity.version = version
+            entity.tiles = db.Text(simplejson.dumps(versions))
+            entity.put()
+            return entity.config()
+        return db.run_in_transaction(txn)
+
+    def purge(self, tile):
+        """Deletes the blocks of a tile from the datastore."""
+        i, j = [int(x) for x in tile.split('-')]
+        keys = [db.Key.from_path('CouchDbBlock', '%s-%s' % (x, y)) \
+                    for y in range(j * TILE_BLOCKS, (j + 1) * TILE_BLOCKS) \
+                    for x in range(i * TILE_BLOCKS, (i + 1) * TILE_BLOCKS)]
+        for n in range(0, len(keys), 500):
+            db.delete(keys[n:n + 500])
+        logging.info('Purged blocks of tile %s' % tile)
+
+    def post(self):
+        global DATASET_VERSION
+        purge = self.request.get('purge', None) # tilekey
+        bbox = self.request.get('bbox', None) # west,south,east,north
+        t = self.request.get('t', None) # tilekey,tilekey,...
+
+        if purge:
+            self.purge(purge)
+            return
+        try:
+            tiles = set([x for x in (t or '').split(',') if x])
+            if bbox:
+                tiles.update(InvalidateHandler.bboxtiles(bbox))
+        except ValueError, e:
+            logging.error('Bad invalidation request bbox=%s, t=%s: %s' % (bbox, t, e))
+            self.error(400)
+            return
+
+        config = InvalidateHandler.bump(tiles)
+        memcache.set(VERSION_KEY, config, time=VERSION_CACHE_TTL)
+        DATASET_VERSION = None
+        for tile in tiles:
+            try:
+                taskqueue.add(url=INVALIDATE_URL, params={'purge': tile}, 
+                    queue_name=BACKFILL_QUEUE)
+            except taskqueue.Error, e:
+                logging.warning('Purge of tile %s not queued: %s' % (tile, e))
+        logging.info('Invalidated %s' % (', '.join(sorted(tiles)) or 'dataset'))
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.out.write(simplejson.dumps({'version': config[0], 'tiles': config[1]}))
+
+class StatsHandler(webapp.RequestHandler):
+    """Handler for cache statistics requests."""
+
+    def get(self):
+        stats = {'local': LOCAL_CACHE.stats(), 'leases': LEASE_STATS}
+        flushstats()
+        prefetch = memcache.get_multi(PREFETCH_COUNTERS, key_prefix=PREFETCH_STATS_PREFIX)
+        stats['prefetch'] = dict([(x, int(prefetch.get(x, 0))) for x in PREFETCH_COUNTERS])
+        counters = memcache.get_multi(TIER_STATS.names(), key_prefix=STATS_PREFIX)
+        stats['requests'] = TIER_STATS.report(dict([(x, int(y)) for x, y in counters.iteritems()]))
+        stats['requests']['sample_rate'] = STATS_SAMPLE_RATE
         self.response.headers["Content-Type"] = "application/json"
-        self.response.out.write(json)
+        self.response.out.write(simplejson.dumps(stats))
 
 application = webapp.WSGIApplication(
-    [('/api/cells/values', CellValuesHandler),], debug=True)    
+    [('/api/cells/values', CellValuesHandler),
+     ('/api/cells/region', RegionHandler),
+     ('/api/cells/envelope', EnvelopeHandler),
+     ('/api/cells/annotate', AnnotateHandler),
+     ('/api/admin/stats', StatsHandler),
+     ('/api/admin/backfill', BackfillHandler),
+     ('/api/admin/prefetch', PrefetchHandler),
+     ('/api/admin/invalidate', InvalidateHandler),], debug=True)    
 
 def main():
     run_wsgi_app(application)
@@ -1,4 +1,5 @@
 def webapp_add_wsgi_middleware(app):
-    from google.appengine.ext.appstats import recording
-    app = recording.appstats_wsgi_middleware(app)
+    # Records a sample of requests with Appstats, see statsampler.py.
+    import statsampler
+    app = statsampler.sampled_middleware(app)
     return app
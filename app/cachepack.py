@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Copyright 2011 Jante LLC and University of Kansas
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele, Dave Vieglais, and John Wieczorek"
+
+"""
+This module packs cached cells and blocks of cells into compact strings for
+memcache, and splits strings too large for one memcache entry into chunks.
+
+A cached cell is a (schema, rev, coords, values) tuple, where schema is a
+variable schema version or a tuple of variable names, and coords and values
+hold JSON encodings (see api.packcell). The empty tuple marks a missing cell.
+Memcache stores strings as they are, so packed cells skip pickling, and cells
+packed to more than a threshold are zlib compressed.
+
+Every packed string starts with a tag byte:
+    M - a missing cell
+    C - a cell
+    Z - a zlib compressed cell
+    B - a zlib compressed block of cells
+    K - the header of a string stored in chunks
+"""
+
+import struct
+import zlib
+
+# Cells packed to at least this many bytes are compressed (None disables):
+COMPRESS_THRESHOLD = 512
+
+# Strings longer than this are stored in chunks, the memcache value size limit:
+CHUNK_BYTES = 10 ** 6
+
+CELL_HEADER = '<H'
+RECORD_HEADER = '<HI'
+
+def packcell(cell, threshold=COMPRESS_THRESHOLD):
+    """Returns a cached cell tuple, or the empty tuple, packed as a string."""
+    if not cell:
+        return 'M'
+    schema, rev, coords, values = cell
+    names = ''
+    if isinstance(schema, tuple):
+        names = '\t'.join(schema).encode('utf-8')
+        schema = 0
+    body = struct.pack(CELL_HEADER, schema) + '\n'.join(
+        [rev.encode('utf-8'), coords, names, '\t'.join(values)])
+    if threshold is not None and len(body) >= threshold:
+        return 'Z' + zlib.compress(body)
+    return 'C' + body
+
+def unpackcell(packed):
+    """Returns the cached cell tuple of a packed cell (see packcell), or None if not one."""
+    tag = packed[:1]
+    if tag == 'M':
+        return ()
+    if tag == 'Z':
+        body = zlib.decompress(packed[1:])
+    elif tag == 'C':
+        body = packed[1:]
+    else:
+        return None
+    size = struct.calcsize(CELL_HEADER)
+    schema = struct.unpack(CELL_HEADER, body[:size])[0]
+    rev, coords, names, values = body[size:].split('\n', 3)
+    if not schema:
+        schema = tuple(names.decode('utf-8').split('\t'))
+    return (schema, rev.decode('utf-8'), coords, tuple(values.split('\t')))
+
+def packblock(cells):
+    """Returns a dictionary of cell key to cached cell packed and compressed as a string."""
+    records = []
+    for key, cell in cells.iteritems():
+        packed = packcell(cell, None)
+        records.append(struct.pack(RECORD_HEADER, len(key), len(packed)))
+        records.append(key)
+        records.append(packed)
+    return 'B' + zlib.compress(''.join(records))
+
+def unpackblock(packed):
+    """Returns the dictionary of cell key to cached cell of a packed block (see packblock)."""
+    if packed[:1] != 'B':
+        return None
+    body = zlib.decompress(packed[1:])
+    size = struct.calcsize(RECORD_HEADER)
+    cells = {}
+    i = 0
+    while i < len(body):
+        key_length, cell_length = struct.unpack(RECORD_HEADER, body[i:i + size])
+        i += size
+        key = body[i:i + key_length]
+        i += key_length
+        cells[key] = unpackcell(body[i:i + cell_length])
+        i += cell_length
+    return cells
+
+def chunk(key, value, size=CHUNK_BYTES):
+    """Returns a dictionary of memcache key to value that stores a string under a key.
+
+    Strings longer than size are split into chunks stored under key#0,
+    key#1, ..., and key holds a header with the number of chunks and a
+    checksum of the string.
+    """
+    if len(value) <= size:
+        return {key: value}
+    count = (len(value) + size - 1) // size
+    entries = {key: 'K%s:%s' % (count, zlib.crc32(value) & 0xffffffff)}
+    for i in range(count):
+        entries['%s#%s' % (key, i)] = value[i * size:(i + 1) * size]
+    return entries
+
+def chunkkeys(key, value):
+    """Returns the memcache keys of the chunks of a string given its header, or None if not a header."""
+    if not isinstance(value, str) or value[:1] != 'K':
+        return None
+    count = int(value[1:].split(':')[0])
+    return ['%s#%s' % (key, i) for i in range(count)]
+
+def unchunk(key, value, chunks):
+    """Returns a string joined from its chunks, or None if a chunk is missing or corrupt.
+
+    Arguments:
+        key - The memcache key of the header.
+        value - The header (see chunk).
+        chunks - A dictionary of memcache key to value including the chunk keys.
+    """
+    count, checksum = [int(x) for x in value[1:].split(':')]
+    parts = []
+    for chunk_key in chunkkeys(key, value):
+        part = chunks.get(chunk_key)
+        if part is None:
+            return None
+        parts.append(part)
+    joined = ''.join(parts)
+    if zlib.crc32(joined) & 0xffffffff != checksum:
+        return None
+    return joined
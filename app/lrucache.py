@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Copyright 2011 Jante LLC and University of Kansas
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele, Dave Vieglais, and John Wieczorek"
+
+"""
+This module includes a size-bounded, least recently used cache with expiring
+entries, used as a per-instance cache tier ahead of memcache.
+"""
+
+import threading
+import time
+
+# Approximate per-entry overhead in bytes of the cache bookkeeping:
+ENTRY_OVERHEAD = 100
+
+def approxsize(value):
+    """Returns the approximate size in bytes of strings, numbers and containers."""
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        return 8 * len(value) + sum([approxsize(x) for x in value])
+    if isinstance(value, dict):
+        return sum([approxsize(x) + approxsize(y) for x, y in value.iteritems()])
+    return 8
+
+class LRUCache(object):
+    """A least recently used cache bounded by entry count and approximate bytes.
+
+    Entries are kept in a doubly linked list ordered by use. Each node is a
+    list of [previous, next, key, value, size, expires].
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, sizeof=approxsize):
+        """Constructs an LRUCache.
+
+        Arguments:
+            max_entries - The maximum number of entries.
+            max_bytes - The maximum approximate size in bytes of all entries.
+            ttl - The number of seconds an entry stays valid.
+            sizeof - A function returning the approximate size of a value.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Removes all entries and resets the counters."""
+        self._nodes = {}
+        self._root = [None, None, None, None, 0, 0]
+        self._root[0] = self._root
+        self._root[1] = self._root
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _unlink(self, node):
+        node[0][1] = node[1]
+        node[1][0] = node[0]
+
+    def _linkfirst(self, node):
+        root = self._root
+        node[0] = root
+        node[1] = root[1]
+        root[1][0] = node
+        root[1] = node
+
+    def _remove(self, node):
+        self._unlink(node)
+        del self._nodes[node[2]]
+        self.bytes -= node[4]
+
+    def get_multi(self, keys):
+        """Returns a dictionary of key to value for the keys found in the cache."""
+        found = {}
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for key in keys:
+                node = self._nodes.get(key)
+                if node is None:
+                    self.misses += 1
+                elif node[5] < now:
+                    self._remove(node)
+                    self.expirations += 1
+                    self.misses += 1
+                else:
+                    self._unlink(node)
+                    self._linkfirst(node)
+                    found[key] = node[3]
+                    self.hits += 1
+        finally:
+            self._lock.release()
+        return found
+
+    def set_multi(self, mapping, ttl=None):
+        """Adds or replaces the entries in a dictionary of key to value.
+
+        Arguments:
+            mapping - A dictionary of key to value.
+            ttl - Optional number of seconds the entries stay valid, if not the
+                cache ttl.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl
+        self._lock.acquire()
+        try:
+            for key, value in mapping.iteritems():
+                node = self._nodes.get(key)
+                if node is not None:
+                    self._remove(node)
+                size = self.sizeof(value) + ENTRY_OVERHEAD
+                if size > self.max_bytes:
+                    continue
+                node = [None, None, key, value, size, expires]
+                self._linkfirst(node)
+                self._nodes[key] = node
+                self.bytes += size
+            while len(self._nodes) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(self._root[0])
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def delete_multi(self, keys):
+        """Removes the entries for keys that are in the cache."""
+        self._lock.acquire()
+        try:
+            for key in keys:
+                node = self._nodes.get(key)
+                if node is not None:
+                    self._remove(node)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Returns a dictionary of the cache counters and sizes."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self._nodes),
+            'bytes': self.bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes
+            }
@@ -26,9 +26,11 @@ TODO: The Rectangular Mesh Grid design is specified here:
 http://goo.gl/0awGK
 """
 
+import bisect
 import logging
 import math
-from optparse import OptionParser
+import os
+import struct
 
 """The number of cells in a one degree of longitude at the equator."""
 CELLS_PER_DEGREE = 120
@@ -611,7 +613,307 @@ class RMGTile(object):
     def __str__(self):
         return str(self.__dict__)
 
+def rowcolumns(y_index, cells_per_degree=CELLS_PER_DEGREE, a=SEMI_MAJOR_AXIS, inverse_flattening=INVERSE_FLATTENING):
+    """Returns the number of cells in the row with the given y_index.
+
+    Arguments:
+        y_index - the zero-based index of the row measured south from the north pole
+        cells_per_degree - the desired resolution of the grid
+        a - the semi-major axis of the ellipsoid for the coordinate reference system
+        inverse_flattening - the inverse of the ellipsoid's flattening parameter
+    """
+    if y_index >= (cells_per_degree * 180) - 1:
+        return 1
+    width = RMGCell.width(y_index, cells_per_degree, a, inverse_flattening)
+    if width >= 360:
+        return 1
+    return int(math.ceil(360.0 / width))
+
+def rowspan(north, south, cells_per_degree=CELLS_PER_DEGREE):
+    """Returns the first and last y indexes of the rows intersecting a latitude band.
+
+    Arguments:
+        north - the latitude of the north edge of the band
+        south - the latitude of the south edge of the band
+        cells_per_degree - the desired resolution of the grid
+    """
+    last_row = int(cells_per_degree * 180) - 1
+    y0 = min(max(RMGCell.lat2y(north, cells_per_degree), 0), last_row)
+    y1 = min(max(RMGCell.lat2y(south, cells_per_degree), 0), last_row)
+    if y1 > y0 and RMGCell.north(y1, cells_per_degree) <= south:
+        # The band ends on the north edge of row y1.
+        y1 -= 1
+    return y0, y1
+
+def pointkeys(points, cells_per_degree=CELLS_PER_DEGREE, a=SEMI_MAJOR_AXIS, inverse_flattening=INVERSE_FLATTENING):
+    """Returns the keys of the cells containing a sequence of points, in the same order.
+
+    This gives the keys of RMGCell.key with float cells_per_degree, but the 
+    cell width of each row is computed once per call rather than per point.
+
+    Arguments:
+        points - a sequence of (lng, lat) tuples
+        cells_per_degree - the desired resolution of the grid
+        a - the semi-major axis of the ellipsoid for the coordinate reference system
+        inverse_flattening - the inverse of the ellipsoid's flattening parameter
+    """
+    last_row = int(cells_per_degree * 180) - 1
+    widths = {}
+    keys = []
+    for lng, lat in points:
+        y_index = min(max(int(math.floor((90.0 - lat) * cells_per_degree)), 0), last_row)
+        width = widths.get(y_index)
+        if width is None:
+            if y_index == last_row:
+                width = 360.0
+            else:
+                width = RMGCell.width(y_index, cells_per_degree, a, inverse_flattening)
+            widths[y_index] = width
+        if width >= 360:
+            x_index = 0
+        else:
+            x_index = int(math.floor((180.0 + lng) / width))
+        keys.append('%s-%s' % (x_index, y_index))
+    return keys
+
+"""Row rank offsets by cells per degree, loaded or computed once per process (see rowoffsets)."""
+ROW_OFFSETS = {}
+
+"""Row rank offsets precomputed at CELLS_PER_DEGREE by the rowoffsets command (see saverowoffsets)."""
+ROW_OFFSETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rowoffsets.dat')
+
+ROW_OFFSETS_HEADER = '<dI'
+
+def computerowoffsets(cells_per_degree=CELLS_PER_DEGREE):
+    """Returns the row rank offsets (see rowoffsets) computed from the row widths."""
+    offsets = [0]
+    for y_index in range(int(cells_per_degree * 180)):
+        offsets.append(offsets[-1] + rowcolumns(y_index, cells_per_degree))
+    return offsets
+
+def saverowoffsets(path, cells_per_degree=CELLS_PER_DEGREE):
+    """Writes the row rank offsets to a file, after a header of cells per degree and count."""
+    offsets = computerowoffsets(cells_per_degree)
+    f = open(path, 'wb')
+    try:
+        f.write(struct.pack(ROW_OFFSETS_HEADER, cells_per_degree, len(offsets)))
+        f.write(struct.pack('<%sI' % len(offsets), *offsets))
+    finally:
+        f.close()
+
+def loadrowoffsets(path, cells_per_degree=CELLS_PER_DEGREE):
+    """Returns the row rank offsets in a file (see saverowoffsets), or None if missing or not for cells_per_degree."""
+    try:
+        f = open(path, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except IOError:
+        return None
+    size = struct.calcsize(ROW_OFFSETS_HEADER)
+    if len(data) < size:
+        return None
+    file_cells_per_degree, count = struct.unpack(ROW_OFFSETS_HEADER, data[:size])
+    if file_cells_per_degree != cells_per_degree or \
+            count != int(cells_per_degree * 180) + 1 or len(data) != size + 4 * count:
+        return None
+    return list(struct.unpack('<%sI' % count, data[size:]))
+
+def rowoffsets(cells_per_degree=CELLS_PER_DEGREE):
+    """Returns a list of the rank of the first cell of each row, plus the total cell count.
+
+    The rank of a cell is its position in row-major order from the north pole.
+    The offsets at CELLS_PER_DEGREE are read from ROW_OFFSETS_FILE if present,
+    which takes a fraction of the time to compute them.
+
+    Arguments:
+        cells_per_degree - the desired resolution of the grid
+    """
+    offsets = ROW_OFFSETS.get(cells_per_degree)
+    if offsets is None:
+        if cells_per_degree == CELLS_PER_DEGREE:
+            offsets = loadrowoffsets(ROW_OFFSETS_FILE, cells_per_degree)
+        if offsets is None:
+            offsets = computerowoffsets(cells_per_degree)
+        ROW_OFFSETS[cells_per_degree] = offsets
+    return offsets
+
+def cellrank(key, cells_per_degree=CELLS_PER_DEGREE):
+    """Returns the rank of the cell with the given key (see rowoffsets).
+
+    Raises ValueError if the key is not that of a cell in the grid.
+    """
+    x_index, y_index = [int(x) for x in key.split('-')]
+    offsets = rowoffsets(cells_per_degree)
+    if y_index < 0 or y_index >= len(offsets) - 1 or \
+            x_index < 0 or x_index >= offsets[y_index + 1] - offsets[y_index]:
+        raise ValueError('No cell %s in the grid' % key)
+    return offsets[y_index] + x_index
+
+def rankkey(rank, cells_per_degree=CELLS_PER_DEGREE):
+    """Returns the key of the cell with the given rank (see rowoffsets)."""
+    offsets = rowoffsets(cells_per_degree)
+    y_index = bisect.bisect_right(offsets, rank) - 1
+    return '%s-%s' % (rank - offsets[y_index], y_index)
+
+"""The number of rows, and of columns in each row, of a block of cells (see blockkey)."""
+BLOCK_SIZE = 32
+
+def blockkey(key, size=BLOCK_SIZE):
+    """Returns the key of the block containing the cell with the given key.
+
+    Blocks tile the grid in index space: block i-j holds the cells with x 
+    indexes i * size through i * size + size - 1 in the rows with y indexes 
+    j * size through j * size + size - 1. Rows narrow towards the poles, so 
+    the last block of a row may hold fewer cells.
+
+    Arguments:
+        key - the cell key (e.g., 26567-10800)
+        size - the number of rows and columns in a block
+    """
+    x_index, y_index = key.split('-')
+    return '%s-%s' % (int(x_index) // size, int(y_index) // size)
+
+def blockranges(key, size=BLOCK_SIZE, cells_per_degree=CELLS_PER_DEGREE):
+    """Returns the cells of the block with the given key as a list of row ranges.
+
+    Arguments:
+        key - the block key (see blockkey)
+        size - the number of rows and columns in a block
+        cells_per_degree - the desired resolution of the grid
+
+    Returns:
+        A list of (y_index, x0, x1) tuples, one for each row of the block 
+        that has cells, where x0 and x1 are the first and last x indexes of 
+        the row in the block.
+    """
+    i, j = [int(x) for x in key.split('-')]
+    offsets = rowoffsets(cells_per_degree)
+    ranges = []
+    for y_index in range(j * size, min((j + 1) * size, len(offsets) - 1)):
+        columns = offsets[y_index + 1] - offsets[y_index]
+        if i * size < columns:
+            ranges.append((y_index, i * size, min((i + 1) * size, columns) - 1))
+    return ranges
+
+def blockneighbours(key, size=BLOCK_SIZE, cells_per_degree=CELLS_PER_DEGREE):
+    """Returns the keys of the blocks adjacent to the block with the given key.
+
+    Neighbours in the same block row wrap around at the antimeridian. Rows
+    narrow towards the poles, so the neighbours in the block rows to the 
+    north and south are the blocks nearest in longitude to the middle of 
+    the block, and its two neighbours in that row.
+
+    Arguments:
+        key - the block key (see blockkey)
+        size - the number of rows and columns in a block
+        cells_per_degree - the desired resolution of the grid
+    """
+    i, j = [int(x) for x in key.split('-')]
+    offsets = rowoffsets(cells_per_degree)
+    rows = len(offsets) - 1
+    def blockcount(j):
+        y_index = j * size
+        return (offsets[y_index + 1] - offsets[y_index] + size - 1) // size
+    count = blockcount(j)
+    middle = (i + 0.5) / count
+    neighbours = []
+    for row in (j - 1, j, j + 1):
+        if row < 0 or row * size >= rows:
+            continue
+        count = blockcount(row)
+        nearest = min(int(middle * count), count - 1)
+        for column in (nearest - 1, nearest, nearest + 1):
+            neighbour = '%s-%s' % (column % count, row)
+            if neighbour != key and neighbour not in neighbours:
+                neighbours.append(neighbour)
+    return neighbours
+
+def bboxranges(west, south, east, north, cells_per_degree=CELLS_PER_DEGREE, a=SEMI_MAJOR_AXIS, inverse_flattening=INVERSE_FLATTENING):
+    """Returns the cells intersecting a bounding box as a list of row ranges.
+
+    Each row range is a (y_index, first x_index, last x_index) tuple, and the 
+    list is sorted by y_index then x_index. A bounding box with west > east 
+    crosses lng = 180 and has two ranges per row.
+
+    Arguments:
+        west, south, east, north - the bounding box edges in degrees
+        cells_per_degree - the desired resolution of the grid
+        a - the semi-major axis of the ellipsoid for the coordinate reference system
+        inverse_flattening - the inverse of the ellipsoid's flattening parameter
+    """
+    if west > east:
+        spans = [(-180.0, east), (west, 180.0)]
+    else:
+        spans = [(west, east)]
+    ranges = []
+    y0, y1 = rowspan(north, south, cells_per_degree)
+    for y_index in range(y0, y1 + 1):
+        columns = rowcolumns(y_index, cells_per_degree, a, inverse_flattening)
+        if columns == 1:
+            ranges.append((y_index, 0, 0))
+            continue
+        width = RMGCell.width(y_index, cells_per_degree, a, inverse_flattening)
+        for w, e in spans:
+            x0 = max(int(math.floor((180.0 + w) / width)), 0)
+            x1 = int(math.ceil((180.0 + e) / width)) - 1
+            x1 = min(max(x1, x0), columns - 1)
+            ranges.append((y_index, x0, x1))
+    return ranges
+
+def polygonranges(rings, cells_per_degree=CELLS_PER_DEGREE, a=SEMI_MAJOR_AXIS, inverse_flattening=INVERSE_FLATTENING):
+    """Returns the cells whose centers are inside a polygon as a list of row ranges.
+
+    The polygon is given by its rings, lists of (lng, lat) vertices in the 
+    order of GeoJSON Polygon coordinates (an exterior ring followed by holes).
+    Rings of several polygons may be combined, and the inside is determined 
+    by the even-odd rule along the center latitude of each row. The polygon
+    must not cross lng = 180. Row ranges are as for bboxranges.
+
+    Arguments:
+        rings - a list of rings, each a list of (lng, lat) vertices
+        cells_per_degree - the desired resolution of the grid
+        a - the semi-major axis of the ellipsoid for the coordinate reference system
+        inverse_flattening - the inverse of the ellipsoid's flattening parameter
+    """
+    edges = []
+    for ring in rings:
+        for i in range(len(ring)):
+            p0 = ring[i - 1]
+            p1 = ring[i]
+            if p0[1] != p1[1]:
+                edges.append((float(p0[0]), float(p0[1]), float(p1[0]), float(p1[1])))
+    if not edges:
+        return []
+    north = max([max(x[1], x[3]) for x in edges])
+    south = min([min(x[1], x[3]) for x in edges])
+    ranges = []
+    y0, y1 = rowspan(north, south, cells_per_degree)
+    for y_index in range(y0, y1 + 1):
+        lat = (RMGCell.north(y_index, cells_per_degree) + RMGCell.south(y_index, cells_per_degree)) / 2
+        crossings = []
+        for lng0, lat0, lng1, lat1 in edges:
+            if (lat0 <= lat) != (lat1 <= lat):
+                crossings.append(lng0 + (lat - lat0) * (lng1 - lng0) / (lat1 - lat0))
+        crossings.sort()
+        columns = rowcolumns(y_index, cells_per_degree, a, inverse_flattening)
+        if columns == 1:
+            if crossings:
+                ranges.append((y_index, 0, 0))
+            continue
+        width = RMGCell.width(y_index, cells_per_degree, a, inverse_flattening)
+        for i in range(0, len(crossings) - 1, 2):
+            # Cells with centers at -180 + (x + 0.5) * width in [w, e]:
+            x0 = max(int(math.ceil((180.0 + crossings[i]) / width - 0.5)), 0)
+            x1 = min(int(math.floor((180.0 + crossings[i + 1]) / width - 0.5)), columns - 1)
+            if x0 <= x1:
+                ranges.append((y_index, x0, x1))
+    return ranges
+
 if __name__ == '__main__':
+    from optparse import OptionParser
+
     logging.basicConfig(level=logging.DEBUG)    
     
     parser = OptionParser()
@@ -719,3 +1021,7 @@ if __name__ == '__main__':
         f.flush()
         f.close()
         print tile.kml()
+    if command == 'rowoffsets':
+        cells_per_degree = float(options.cells_per_degree)
+        saverowoffsets(ROW_OFFSETS_FILE, cells_per_degree)
+        print 'Wrote row offsets at %s cells per degree to %s' % (cells_per_degree, ROW_OFFSETS_FILE)
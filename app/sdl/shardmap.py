@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# Copyright 2011 Jante LLC and University of Kansas
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele, Dave Vieglais, and John Wieczorek"
+
+"""
+This module includes the map of the CouchDB databases (shards) that cells are
+partitioned across. The loader writes each cell to its shard, and the API
+queries the shards of the cells it needs, so both route with the same map.
+
+Cells are partitioned either by contiguous bands of RMG rows, so that a row
+range lives in one shard, or by a hash of their rank, which spreads every
+region evenly across the shards. A map is saved as JSON, for example:
+
+    {"scheme": "rows", "bands": [0, 10800],
+     "shards": ["http://a:5984/worldclim-rmg-0", "http://b:5984/worldclim-rmg-1"]}
+
+where bands holds the first row of each shard.
+"""
+
+import bisect
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from rmg import CELLS_PER_DEGREE, rowoffsets
+
+"""Partitions cells by contiguous bands of rows."""
+ROWS = 'rows'
+
+"""Partitions cells by a hash of their rank."""
+RANK = 'rank'
+
+SCHEMES = (ROWS, RANK)
+
+def rowbands(count, cells_per_degree=CELLS_PER_DEGREE):
+    """Returns the first row of each of count bands of rows with about the same number of cells."""
+    offsets = rowoffsets(cells_per_degree)
+    return [bisect.bisect_left(offsets, offsets[-1] * i / count) for i in range(count)]
+
+def hashrank(rank, count):
+    """Returns the shard of a cell rank among count shards, by Knuth's multiplicative hash.
+
+    The high bits of the 32 bit hash pick the shard, so the result is stable
+    across processes and Python versions, unlike hash().
+    """
+    return (((rank * 2654435761) & 0xffffffff) * count) >> 32
+
+def splitshard(url):
+    """Returns the (server URL, database name) of a shard URL."""
+    server, database = url.rstrip('/').rsplit('/', 1)
+    return server, database
+
+class ShardMap(object):
+    """The CouchDB databases of cells, and the shard of each cell."""
+
+    def __init__(self, shards, scheme=ROWS, bands=None, cells_per_degree=CELLS_PER_DEGREE):
+        """Constructs a ShardMap.
+
+        Arguments:
+            shards - The URLs of the shard databases (e.g., http://a:5984/worldclim-rmg-0).
+            scheme - ROWS or RANK.
+            bands - The first row of each shard for ROWS, by default bands of
+                about the same number of cells (see rowbands).
+            cells_per_degree - The resolution of the grid.
+
+        Raises ValueError for an unknown scheme, no shards, or bands that do
+        not start at row 0 and increase, one per shard.
+        """
+        if scheme not in SCHEMES:
+            raise ValueError('Unknown shard scheme %s' % scheme)
+        if not shards:
+            raise ValueError('No shards')
+        if scheme == ROWS:
+            if bands is None:
+                bands = rowbands(len(shards), cells_per_degree)
+            if len(bands) != len(shards) or bands[0] != 0 or \
+                    [x for x, y in zip(bands, bands[1:]) if x >= y]:
+                raise ValueError('Bad row bands %s for %s shards' % (bands, len(shards)))
+        self.shards = list(shards)
+        self.scheme = scheme
+        self.bands = bands
+        self.cells_per_degree = cells_per_degree
+
+    @classmethod
+    def single(cls, url):
+        """Returns a ShardMap of one database."""
+        return cls([url])
+
+    def shard(self, key):
+        """Returns the index of the shard of the cell with the given key."""
+        if len(self.shards) == 1:
+            return 0
+        x_index, y_index = [int(x) for x in key.split('-')]
+        if self.scheme == ROWS:
+            return bisect.bisect_right(self.bands, y_index) - 1
+        rank = rowoffsets(self.cells_per_degree)[y_index] + x_index
+        return hashrank(rank, len(self.shards))
+
+    def route(self, keys):
+        """Returns a dictionary of shard index to the list of the given cell keys in it."""
+        routed = {}
+        for key in keys:
+            routed.setdefault(self.shard(key), []).append(key)
+        return routed
+
+    def rangeshards(self, row_range):
+        """Returns the sorted indexes of the shards holding cells of a (y, x0, x1) row range."""
+        y_index, x0, x1 = row_range
+        if self.scheme == ROWS or len(self.shards) == 1:
+            return [self.shard('%s-%s' % (x0, y_index))]
+        if x1 - x0 + 1 >= len(self.shards) * 4:
+            # Hashed ranks spread a range this long across every shard.
+            return range(len(self.shards))
+        return sorted(set([self.shard('%s-%s' % (x, y_index)) for x in range(x0, x1 + 1)]))
+
+    def viewurl(self, index, design, view):
+        """Returns the URL of a view of a design document in a shard."""
+        return '%s/_design/%s/_view/%s' % (self.shards[index].rstrip('/'), design, view)
+
+    def todict(self):
+        """Returns the map as a dictionary for JSON."""
+        mapping = {'scheme': self.scheme, 'shards': self.shards,
+                   'cells_per_degree': self.cells_per_degree}
+        if self.scheme == ROWS:
+            mapping['bands'] = self.bands
+        return mapping
+
+    @classmethod
+    def fromdict(cls, mapping):
+        """Returns a ShardMap of a dictionary (see todict)."""
+        return cls(mapping['shards'], mapping.get('scheme', ROWS), mapping.get('bands'),
+                   mapping.get('cells_per_degree', CELLS_PER_DEGREE))
+
+    def save(self, filename):
+        """Writes the map to a JSON file."""
+        f = open(filename, 'w')
+        f.write(json.dumps(self.todict(), indent=4))
+        f.close()
+
+    @classmethod
+    def load(cls, filename):
+        """Returns a ShardMap read from a JSON file."""
+        f = open(filename, 'r')
+        try:
+            return cls.fromdict(json.loads(f.read()))
+        finally:
+            f.close()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# Copyright 2011 Jante LLC and University of Kansas
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele, Dave Vieglais, and John Wieczorek"
+
+"""
+This module includes WSGI middleware that records a sample of requests with
+Appstats. The stock middleware records a call stack for every RPC of every
+request, takes a memcache lock, and saves the full record to memcache.
+
+Here, every request keeps only the name and timing of its RPCs in memory.
+One in SAMPLE_RATE requests, and any request taking at least SLOW_MS, is
+saved as a summary, which is what the Appstats console lists. Call stacks,
+the CGI environment and the full record are only kept for admin requests
+with the DETAILS_PARAM query parameter set to 'details'.
+"""
+
+import cgi
+import logging
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext.appstats import datamodel_pb
+from google.appengine.ext.appstats import recording
+
+# Save 1 in SAMPLE_RATE requests (1 saves every request, 0 none):
+SAMPLE_RATE = 100
+
+# Always save requests that take at least this many milliseconds (None disables):
+SLOW_MS = 1000
+
+# The query parameter an admin sets to 'details' to record call stacks:
+DETAILS_PARAM = 'appstats'
+
+# Recording levels:
+TIMINGS = 0  # RPC names and timings, saved if slow
+SUMMARY = 1  # and request and response summaries, saved as a summary
+DETAILS = 2  # and call stacks, saved in full
+
+class SampledRecorder(recording.Recorder):
+    """An Appstats Recorder that records RPCs at a level (see TIMINGS, SUMMARY, DETAILS)."""
+
+    def __init__(self, env, level):
+        recording.Recorder.__init__(self, env)
+        self.level = level
+
+    def get_call_stack(self, trace):
+        if self.level == DETAILS:
+            recording.Recorder.get_call_stack(self, trace)
+
+    def record_rpc_request(self, service, call, request, response, rpc):
+        if self.level != TIMINGS:
+            recording.Recorder.record_rpc_request(
+                self, service, call, request, response, rpc)
+            return
+        trace = datamodel_pb.IndividualRpcStatsProto()
+        trace.set_service_call_name('%s.%s' % (service, call))
+        trace.set_start_offset_milliseconds(
+            int(1000 * (time.time() - self.start_timestamp)))
+        if rpc is not None:
+            self.pending[rpc] = len(self.traces)
+        self.traces.append(trace)
+
+    def record_rpc_response(self, service, call, request, response, rpc):
+        index = None
+        if self.level == TIMINGS and rpc is not None:
+            index = self.pending.pop(rpc, None)
+        if index is None:
+            recording.Recorder.record_rpc_response(
+                self, service, call, request, response, rpc)
+            return
+        trace = self.traces[index]
+        trace.set_api_mcycles(rpc.cpu_usage_mcycles)
+        trace.set_duration_milliseconds(
+            int(1000 * (time.time() - self.start_timestamp)) -
+            trace.start_offset_milliseconds())
+
+    def elapsed(self):
+        """Returns the milliseconds from the start of the request to its status."""
+        return 1000 * (self.end_timestamp - self.start_timestamp)
+
+    def _save(self):
+        """Saves the summary to memcache, and the full record if recording details."""
+        if self.level == DETAILS:
+            return recording.Recorder._save(self)
+        part = self.get_summary_proto_encoded()
+        key = recording.make_key(self.start_timestamp)
+        if not memcache.set(key + recording.config.PART_SUFFIX, part,
+                            time=36*3600,
+                            namespace=recording.config.KEY_NAMESPACE):
+            logging.warn('Memcache set() error: %s', key)
+        return key, len(part), 0
+
+def recordlevel(env):
+    """Returns the recording level of a request given its WSGI environment."""
+    if env.get('USER_IS_ADMIN') == '1' and \
+            DETAILS_PARAM in env.get('QUERY_STRING', ''):
+        params = cgi.parse_qs(env.get('QUERY_STRING', ''))
+        if params.get(DETAILS_PARAM, [None])[0] == 'details':
+            return DETAILS
+    if SAMPLE_RATE and random.random() * SAMPLE_RATE < 1:
+        return SUMMARY
+    return TIMINGS
+
+def start_recording(env):
+    """Sets the Appstats recorder of a request, unless the request is filtered out."""
+    recording.recorder = None
+    if not recording.config.should_record(env):
+        return
+    recording.recorder = SampledRecorder(env, recordlevel(env))
+
+def end_recording(status):
+    """Saves the Appstats recorder of a request if sampled or slow, and clears it."""
+    rec = recording.recorder
+    recording.recorder = None
+    if rec is None:
+        return
+    rec.record_http_status(status)
+    if rec.level == TIMINGS and (SLOW_MS is None or rec.elapsed() < SLOW_MS):
+        return
+    rec.save()
+
+def sampled_middleware(app):
+    """Returns WSGI middleware that records a sample of requests to an app with Appstats."""
+
+    def sampled_wrapper(environ, start_response):
+        start_recording(environ)
+        saved_status = [None]
+
+        def sampled_start_response(status, headers, exc_info=None):
+            saved_status.append(status)
+            return start_response(status, headers, exc_info)
+
+        try:
+            result = app(environ, sampled_start_response)
+        except Exception:
+            end_recording(500)
+            raise
+        if result is not None:
+            for value in result:
+                yield value
+        status = saved_status[-1]
+        if status is not None:
+            status = status[:3]
+        end_recording(status)
+
+    return sampled_wrapper
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# Copyright 2011 Jante LLC and University of Kansas
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele, Dave Vieglais, and John Wieczorek"
+
+"""
+This module includes per-request statistics of the keys served by each cache
+tier, and counters and histograms aggregated from a sample of requests. The
+aggregates are plain dictionaries of counter name to count, so that they can
+be added to shared counters (e.g., memcache offsets) and reported from them.
+"""
+
+import bisect
+import random
+
+# Upper bounds of the latency histogram buckets in milliseconds:
+LATENCY_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Upper bounds of the response size histogram buckets in bytes:
+SIZE_BOUNDS = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22)
+
+def bucket(bounds, value):
+    """Returns the index of the histogram bucket of a value, len(bounds) if over the last bound."""
+    return bisect.bisect_left(bounds, value)
+
+def histogram(counters, name, bounds):
+    """Returns a dictionary of bucket upper bound (or 'inf') to count for a histogram counter."""
+    labels = [str(x) for x in bounds] + ['inf']
+    return dict([(labels[i], counters.get('%s.%s' % (name, i), 0)) \
+                     for i in range(len(labels))])
+
+class RequestStats(object):
+    """The keys served and time taken by each cache tier for one request."""
+
+    def __init__(self, sample_rate=0):
+        """Constructs a RequestStats.
+
+        Arguments:
+            sample_rate - Sample 1 in sample_rate requests for aggregation,
+                or none if 0.
+        """
+        self.tiers = []
+        self.size = None
+        self.ms = None
+        # Keys neither found nor confirmed missing, e.g., because a backend failed:
+        self.unresolved = 0
+        self.sampled = bool(sample_rate) and random.random() * sample_rate < 1
+
+    def add(self, tier, hits, keys, ms=None, detail=None):
+        """Adds the number of hits of a number of keys looked up in a tier, and the time taken."""
+        self.tiers.append((tier, hits, keys, ms, detail))
+
+    def summary(self, start=0):
+        """Returns the tiers, from the start index of those added, as a string for the log."""
+        parts = []
+        for tier, hits, keys, ms, detail in self.tiers[start:]:
+            part = '%s %s/%s' % (tier, hits, keys)
+            if detail:
+                part += ' ' + detail
+            if ms is not None:
+                part += ' in %.1f ms' % ms
+            parts.append(part)
+        return ', '.join(parts)
+
+class TierStats(object):
+    """Counters and histograms aggregated from sampled RequestStats.
+
+    For each tier, there are counters of hits and keys looked up, and a
+    latency histogram. There are also histograms of request latency and
+    response size, and a counter of requests.
+    """
+
+    def __init__(self, tiers):
+        """Constructs a TierStats.
+
+        Arguments:
+            tiers - The names of the tiers.
+        """
+        self.tiers = tuple(tiers)
+        self.clear()
+
+    def clear(self):
+        """Resets the counters."""
+        self.counters = {}
+
+    def increment(self, name, delta=1):
+        """Adds a delta to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + delta
+
+    def record(self, stats):
+        """Adds a RequestStats to the counters."""
+        self.increment('requests')
+        for tier, hits, keys, ms, detail in stats.tiers:
+            self.increment('%s.hits' % tier, hits)
+            self.increment('%s.keys' % tier, keys)
+            if ms is not None:
+                self.increment('%s.ms.%s' % (tier, bucket(LATENCY_BOUNDS, ms)))
+        if stats.ms is not None:
+            self.increment('request.ms.%s' % bucket(LATENCY_BOUNDS, stats.ms))
+        if stats.size is not None:
+            self.increment('size.%s' % bucket(SIZE_BOUNDS, stats.size))
+
+    def flush(self):
+        """Returns the counters and resets them."""
+        counters = self.counters
+        self.clear()
+        return counters
+
+    def names(self):
+        """Returns the names of all of the counters."""
+        names = ['requests']
+        for tier in self.tiers:
+            names.extend(['%s.hits' % tier, '%s.keys' % tier])
+            names.extend(['%s.ms.%s' % (tier, i) for i in range(len(LATENCY_BOUNDS) + 1)])
+        names.extend(['request.ms.%s' % i for i in range(len(LATENCY_BOUNDS) + 1)])
+        names.extend(['size.%s' % i for i in range(len(SIZE_BOUNDS) + 1)])
+        return names
+
+    def report(self, counters):
+        """Returns a dictionary report of counters, such as those of this object (see names)."""
+        tiers = {}
+        for tier in self.tiers:
+            tiers[tier] = {
+                'hits': counters.get('%s.hits' % tier, 0),
+                'keys': counters.get('%s.keys' % tier, 0),
+                'latency_ms': histogram(counters, '%s.ms' % tier, LATENCY_BOUNDS)
+                }
+        return {
+            'requests': counters.get('requests', 0),
+            'tiers': tiers,
+            'latency_ms': histogram(counters, 'request.ms', LATENCY_BOUNDS),
+            'response_bytes': histogram(counters, 'size', SIZE_BOUNDS)
+            }
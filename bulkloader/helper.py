@@ -37,13 +37,6 @@ def to_json():
     return wrapper
 
 
-def within_list(within):
-    def wrapper(scaledval, bulkload_state):
-        '''Returns a list of values before and after the scaledvalue.'''
-        x = int(scaledval)
-        return range(x - within, x + within + 1)
-    return wrapper
-
 def to_list(fn):
     def wrapper(value):
         '''Evualuates the CSV value as a list and returns it. 
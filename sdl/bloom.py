@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Copyright 2011 Jante LLC and University of Kansas
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele, Dave Vieglais, and John Wieczorek"
+
+"""
+This module includes a Bloom filter of cell keys. The loader builds it from
+the keys of the cells in CouchDB, and the API uses it to answer requests for
+cells that have no data (e.g., ocean cells) without touching storage.
+"""
+
+import array
+import hashlib
+import math
+import struct
+
+"""The header of a serialized BloomFilter: the number of bits and of hashes."""
+HEADER = '<QI'
+
+class BloomFilter(object):
+    """A Bloom filter over string keys backed by a byte array."""
+
+    def __init__(self, bits, hashes, data=None):
+        """Constructs a BloomFilter.
+
+        Arguments:
+            bits - The number of bits in the filter.
+            hashes - The number of hash functions.
+            data - Optional serialized bytes of the bit array.
+        """
+        self.bits = bits
+        self.hashes = hashes
+        self.array = array.array('B')
+        if data:
+            self.array.fromstring(data)
+        else:
+            self.array.fromstring('\0' * ((bits + 7) / 8))
+
+    @classmethod
+    def forcapacity(cls, capacity, error_rate=0.01):
+        """Returns an empty BloomFilter sized for a number of keys and error rate."""
+        capacity = max(capacity, 1)
+        bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hashes = max(int(round(math.log(2) * bits / capacity)), 1)
+        return cls(bits, hashes)
+
+    def _indexes(self, key):
+        # Double hashing: the i-th index is h1 + i * h2 modulo the number of bits.
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def add(self, key):
+        """Adds a key to the filter."""
+        for i in self._indexes(key):
+            self.array[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, key):
+        for i in self._indexes(key):
+            if not self.array[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def tostring(self):
+        """Returns the filter serialized as a string."""
+        return struct.pack(HEADER, self.bits, self.hashes) + self.array.tostring()
+
+    @classmethod
+    def fromstring(cls, s):
+        """Returns a BloomFilter deserialized from a string."""
+        size = struct.calcsize(HEADER)
+        bits, hashes = struct.unpack(HEADER, s[:size])
+        return cls(bits, hashes, s[size:])
+
+    def save(self, filename):
+        """Writes the filter to a file."""
+        f = open(filename, 'wb')
+        f.write(self.tostring())
+        f.close()
+
+    @classmethod
+    def load(cls, filename):
+        """Returns a BloomFilter read from a file."""
+        f = open(filename, 'rb')
+        try:
+            return cls.fromstring(f.read())
+        finally:
+            f.close()
@@ -21,29 +21,119 @@ import time
 import math
 from optparse import OptionParser
 import httplib
+import itertools
 import json
 import simplejson
 import couchdb
+import urlparse
+from gziputil import gunzip, gzipchunks, gzipstring, ratio
 from rmg import *
 
+"""The number of bytes buffered before a chunk is sent in a streamed request body."""
+CHUNK_SIZE = 65536
+
+"""The maximum number of pre-encoded JSON strings kept by a BulkDocsEncoder."""
+MAX_FRAGMENTS = 100000
+
+def readBody(s):
+    """Returns the body of an HTTPResponse object, gunzipped if necessary."""
+    body = s.read()
+    if s.getheader('Content-Encoding') == 'gzip':
+        compressed = len(body)
+        body = gunzip(body)
+        logging.info('Response gunzipped from %s to %s bytes (ratio %.2f)' \
+            % (compressed, len(body), ratio(len(body), compressed)))
+    return body
+
 def prettyPrint(s):
     """Prettyprints the json response of an HTTPResponse object"""
 
     # HTTPResponse instance -> Python object -> str
-    print simplejson.dumps(json.loads(s.read()), sort_keys=True, indent=4)
+    print simplejson.dumps(json.loads(readBody(s)), sort_keys=True, indent=4)
 
 def getJson(s):
     """Prettyprints the json response of an HTTPResponse object"""
 
     # HTTPResponse instance -> Python object -> str
-    return json.loads(s.read())
+    return json.loads(readBody(s))
+
+class BulkDocsEncoder(object):
+    """Incrementally encodes documents into a _bulk_docs JSON request body.
+
+    Strings that repeat across cell documents, such as variable names, values 
+    and the coordinates shared by cells in the same row, are encoded once and 
+    reused for every document that contains them.
+    """
+
+    def __init__(self, chunksize=CHUNK_SIZE):
+        self.chunksize = chunksize
+        self._fragments = {}
+
+    def _string(self, s):
+        encoded = self._fragments.get(s)
+        if encoded is None:
+            encoded = json.dumps(s)
+            if len(self._fragments) >= MAX_FRAGMENTS:
+                self._fragments.clear()
+            self._fragments[s] = encoded
+        return encoded
+
+    def encode(self, value):
+        """Returns the JSON encoding of a document or one of its values."""
+        if isinstance(value, basestring):
+            return self._string(value)
+        if isinstance(value, dict):
+            return '{%s}' % ','.join(['%s:%s' % (self._string(k), self.encode(v)) \
+                                          for k, v in value.iteritems()])
+        if isinstance(value, (list, tuple)):
+            return '[%s]' % ','.join([self.encode(x) for x in value])
+        return json.dumps(value)
+
+    def iterencode(self, docs):
+        """Yields the request body for docs in chunks of about chunksize bytes.
+
+        Arguments:
+            docs - An iterable of documents, consumed one at a time.
+        """
+        buf = ['{"docs":[']
+        size = len(buf[0])
+        separator = ''
+        for doc in docs:
+            encoded = self.encode(doc)
+            buf.append(separator)
+            buf.append(encoded)
+            size += len(encoded) + 1
+            separator = ','
+            if size >= self.chunksize:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        buf.append(']}')
+        yield ''.join(buf)
 
 class Couch:
     """Basic wrapper class for operations on a couchDB"""
 
-    def __init__(self, host, port=5984, options=None):
+    def __init__(self, host, port=5984, options=None, compress_threshold=None):
+        """Constructs a Couch.
+
+        Arguments:
+            host - The CouchDB host name.
+            port - The CouchDB port.
+            compress_threshold - The request body size in bytes at or above which 
+                bodies are gzip encoded and gzip responses are accepted. None 
+                disables compression.
+        """
         self.host = host
         self.port = port
+        self.compress_threshold = compress_threshold
+
+    @classmethod
+    def fromurl(cls, url, compress_threshold=None):
+        """Returns a Couch for a server URL (e.g., http://eighty.berkeley.edu:5984)."""
+        parsed = urlparse.urlparse(url)
+        return cls(parsed.hostname, parsed.port or 5984, 
+                   compress_threshold=compress_threshold)
 
     def connect(self):
         return httplib.HTTPConnection(self.host, self.port) # No close()
@@ -108,17 +198,81 @@ class Couch:
         r = self.delete(''.join(['/', dbName, '/', docId, '?rev=', rev_id]))
         prettyPrint(r)
 
+    def getRev(self, dbName, docId):
+        """Returns the current revision of a document, or None if it doesn't exist."""
+        c = self.connect()
+        c.request('HEAD', ''.join(['/', dbName, '/', docId]))
+        r = c.getresponse()
+        r.read()
+        if r.status != 200:
+            return None
+        return r.getheader('ETag').strip('"')
+
+    def bulkDocs(self, dbName, docs):
+        """Streams documents to _bulk_docs and returns the per-document results.
+
+        The request body is encoded as docs are consumed and sent with chunked 
+        transfer encoding, so the full batch is never held in memory as JSON.
+
+        Arguments:
+            dbName - The database name.
+            docs - An iterable of documents (e.g., a generator).
+        """
+        chunks = BulkDocsEncoder().iterencode(docs)
+        first = chunks.next()
+        compress = self.compress_threshold is not None \
+            and len(first) >= self.compress_threshold
+        c = self.connect()
+        c.putrequest('POST', ''.join(['/', dbName, '/_bulk_docs']))
+        c.putheader('Content-Type', 'application/json')
+        c.putheader('Transfer-Encoding', 'chunked')
+        if compress:
+            c.putheader('Content-Encoding', 'gzip')
+            c.putheader('Accept-Encoding', 'gzip')
+        c.endheaders()
+        size = {'raw': 0, 'sent': 0}
+        def counted(chunks):
+            for chunk in chunks:
+                size['raw'] += len(chunk)
+                yield chunk
+        body = counted(itertools.chain([first], chunks))
+        if compress:
+            body = gzipchunks(body)
+        for chunk in body:
+            if chunk:
+                c.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+                size['sent'] += len(chunk)
+        c.send('0\r\n\r\n')
+        if compress:
+            logging.info('_bulk_docs body gzipped from %s to %s bytes (ratio %.2f)' \
+                % (size['raw'], size['sent'], ratio(size['raw'], size['sent'])))
+        r = c.getresponse()
+        if r.status not in (200, 201):
+            raise httplib.HTTPException('_bulk_docs to %s failed with status %s: %s' \
+                % (dbName, r.status, readBody(r)))
+        return getJson(r)
+
     # Basic http methods
 
     def get(self, uri):
         c = self.connect()
         headers = {"Accept": "application/json"}
+        if self.compress_threshold is not None:
+            headers["Accept-Encoding"] = "gzip"
         c.request("GET", uri, None, headers)
         return c.getresponse()
 
     def post(self, uri, body):
         c = self.connect()
         headers = {"Content-type": "application/json"}
+        if self.compress_threshold is not None:
+            headers["Accept-Encoding"] = "gzip"
+            if len(body) >= self.compress_threshold:
+                compressed = gzipstring(body)
+                logging.info('POST body gzipped from %s to %s bytes (ratio %.2f)' \
+                    % (len(body), len(compressed), ratio(len(body), len(compressed))))
+                headers["Content-Encoding"] = "gzip"
+                body = compressed
         c.request('POST', uri, body, headers)
         return c.getresponse()
 
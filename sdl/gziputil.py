@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+# Copyright 2011 Jante LLC and University of Kansas
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele, Dave Vieglais, and John Wieczorek"
+
+"""
+This module includes the gzip encoding of HTTP bodies shared by the loader's
+CouchDB client (couchutil) and the API's CouchDB requests and responses.
+"""
+
+import zlib
+
+"""The zlib window bits value that selects the gzip container format."""
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+"""The default compression level."""
+GZIP_LEVEL = 6
+
+def compressor(level=GZIP_LEVEL):
+    """Returns a zlib compression object that writes the gzip container format."""
+    return zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+def gzipchunks(chunks, level=GZIP_LEVEL):
+    """Yields gzip compressed data for an iterable of string chunks."""
+    c = compressor(level)
+    for chunk in chunks:
+        compressed = c.compress(chunk)
+        if compressed:
+            yield compressed
+    yield c.flush()
+
+def gzipstring(data, level=GZIP_LEVEL):
+    """Returns a string gzip compressed."""
+    return ''.join(gzipchunks([data], level))
+
+def gunzip(data):
+    """Returns a gzip compressed string decompressed."""
+    return zlib.decompress(data, GZIP_WBITS)
+
+def ratio(size, compressed):
+    """Returns the compression ratio of a size in bytes to its compressed size."""
+    return float(size) / max(compressed, 1)
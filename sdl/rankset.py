@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# Copyright 2011 Jante LLC and University of Kansas
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele, Dave Vieglais, and John Wieczorek"
+
+"""
+This module includes a run-length compressed bitset of cell ranks. Cells with
+similar environmental values are spatially clustered, so the cells of a value
+bin form long runs of consecutive ranks in RMG row order, and set operations
+work run by run rather than cell by cell.
+"""
+
+import array
+import bisect
+import sys
+import zlib
+
+class RankSet(object):
+    """A set of non-negative integer ranks stored as sorted, disjoint runs.
+
+    A run is a (start, end) tuple of the ranks start through end - 1.
+    Adjacent runs are always merged.
+    """
+
+    def __init__(self, runs=None):
+        """Constructs a RankSet.
+
+        Arguments:
+            runs - Optional sorted, disjoint list of (start, end) runs.
+        """
+        self.runs = []
+        if runs:
+            for start, end in runs:
+                self.addrange(start, end)
+
+    def add(self, rank):
+        """Adds a rank that is not less than any rank in the set."""
+        self.addrange(rank, rank + 1)
+
+    def addrange(self, start, end):
+        """Adds the ranks start through end - 1, none less than any rank in the set."""
+        if start >= end:
+            return
+        runs = self.runs
+        if runs and runs[-1][1] >= start:
+            if end > runs[-1][1]:
+                runs[-1] = (runs[-1][0], end)
+        else:
+            runs.append((start, end))
+
+    def __len__(self):
+        return sum([end - start for start, end in self.runs])
+
+    def __nonzero__(self):
+        return len(self.runs) > 0
+
+    def __iter__(self):
+        for start, end in self.runs:
+            for rank in xrange(start, end):
+                yield rank
+
+    def __contains__(self, rank):
+        i = bisect.bisect_right(self.runs, (rank, sys.maxint)) - 1
+        return i >= 0 and self.runs[i][0] <= rank < self.runs[i][1]
+
+    def __eq__(self, other):
+        return isinstance(other, RankSet) and self.runs == other.runs
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __or__(self, other):
+        result = RankSet()
+        a = self.runs
+        b = other.runs
+        i = j = 0
+        while i < len(a) or j < len(b):
+            if j >= len(b) or (i < len(a) and a[i][0] <= b[j][0]):
+                run = a[i]
+                i += 1
+            else:
+                run = b[j]
+                j += 1
+            runs = result.runs
+            if runs and runs[-1][1] >= run[0]:
+                if run[1] > runs[-1][1]:
+                    runs[-1] = (runs[-1][0], run[1])
+            else:
+                runs.append(run)
+        return result
+
+    def __and__(self, other):
+        result = RankSet()
+        a = self.runs
+        b = other.runs
+        i = j = 0
+        while i < len(a) and j < len(b):
+            start = max(a[i][0], b[j][0])
+            end = min(a[i][1], b[j][1])
+            if start < end:
+                result.runs.append((start, end))
+            if a[i][1] < b[j][1]:
+                i += 1
+            else:
+                j += 1
+        return result
+
+    def __sub__(self, other):
+        result = RankSet()
+        b = other.runs
+        j = 0
+        for start, end in self.runs:
+            while j < len(b) and b[j][1] <= start:
+                j += 1
+            k = j
+            while k < len(b) and b[k][0] < end:
+                if b[k][0] > start:
+                    result.runs.append((start, b[k][0]))
+                start = max(start, b[k][1])
+                k += 1
+            if start < end:
+                result.runs.append((start, end))
+        return result
+
+    def tostring(self):
+        """Returns the set serialized as zlib compressed gaps and run lengths."""
+        values = array.array('I')
+        previous = 0
+        for start, end in self.runs:
+            values.append(start - previous)
+            values.append(end - start)
+            previous = end
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return zlib.compress(values.tostring())
+
+    @classmethod
+    def fromstring(cls, s):
+        """Returns a RankSet deserialized from a string (see tostring)."""
+        values = array.array('I')
+        values.fromstring(zlib.decompress(s))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        result = cls()
+        previous = 0
+        for i in xrange(0, len(values), 2):
+            start = previous + values[i]
+            previous = start + values[i + 1]
+            result.runs.append((start, previous))
+        return result
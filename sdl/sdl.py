@@ -21,19 +21,117 @@ This module includes classes and a command line interface for bulkloading
 WorldClim environment variables to CouchDB using the Rectangular Mesh Grid (RMG).
 """
 
+import base64
+import bloom
 import csv
 import time
 import couchdb
+import couchutil
+import hashlib
+import heapq
+import httplib
+import json
 import logging
 import math
 from optparse import OptionParser
 import os
 import random
+from rankset import RankSet
 import shapefile
+from shardmap import ShardMap, splitshard
 import shlex
+import socket
+import spillqueue
 import subprocess
+import threading
 from rmg import *
 
+"""The number of times a document that failed in a bulk upload is retried on its own."""
+RETRY_ATTEMPTS = 3
+
+"""The delay in seconds before the second individual attempt, doubled for each attempt after it."""
+RETRY_DELAY = 0.5
+
+"""The file in the workspace to which documents that could not be uploaded are appended."""
+REJECT_FILE = 'rejects.json'
+
+"""The number of value bins per variable in the envelope index."""
+ENVELOPE_BINS = 64
+
+"""The number of consecutive cell ranks covered by one envelope index document."""
+ENVELOPE_CHUNK_RANKS = 1 << 20
+
+"""
+The design document of the views queried by the API: cells is keyed by cell key,
+and rows is keyed by [y, x] so that a run of cells in an RMG row is a key range.
+The hashes view, keyed by cell key, is queried by reloads for stored revisions.
+"""
+API_DESIGN = {
+    '_id': '_design/api',
+    'language': 'javascript',
+    'views': {
+        'cells': {
+            'map': 'function(doc) { if (doc.coords) { '
+                   'emit(doc._id, {rev: doc._rev, coords: doc.coords, varvals: doc.vars}); } }'
+            },
+        'rows': {
+            'map': 'function(doc) { if (doc.coords) { var xy = doc._id.split("-"); '
+                   'emit([parseInt(xy[1], 10), parseInt(xy[0], 10)], '
+                   '{rev: doc._rev, coords: doc.coords, varvals: doc.vars}); } }'
+            },
+        'hashes': {
+            'map': 'function(doc) { if (doc.coords) { '
+                   'emit(doc._id, {rev: doc._rev, hash: doc.hash}); } }'
+            }
+        }
+    }
+
+def putdesign(cdb):
+    """Creates or updates the API design document in CouchDB."""
+    design = dict(API_DESIGN)
+    existing = cdb.get(design['_id'])
+    if existing:
+        design['_rev'] = existing['_rev']
+    cdb[design['_id']] = design
+
+def getshards(options):
+    """Returns the ShardMap of the cell databases, from the shards file if given.
+
+    Without a shards file, cells are in the one database at -u and -d.
+    """
+    if options.shards:
+        return ShardMap.load(options.shards)
+    return ShardMap.single('%s/%s' % (options.couchurl.rstrip('/'), options.database))
+
+def sharddb(url):
+    """Returns the couchdb.Database of a shard URL."""
+    server, database = splitshard(url)
+    return couchdb.Server(server)[database]
+
+def parallel(calls):
+    """Runs callables in threads, one per callable, and returns their results in order.
+
+    Raises the first exception raised by a callable after all have finished.
+    """
+    if len(calls) == 1:
+        return [calls[0]()]
+    results = [None] * len(calls)
+    errors = []
+    def run(i):
+        try:
+            results[i] = calls[i]()
+        except Exception, e:
+            logging.exception('Shard call failed')
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
 def maketile(options):
     key = options.key
     nw = map(float, options.nwcorner.split(','))
@@ -68,6 +166,174 @@ def translatevariable(varname, varval):
     newval = truncate(newval,0)
     return newval
 
+def cellhash(cell):
+    """Returns a stable SHA-1 hex digest of the coords and vars of a cell document."""
+    content = json.dumps([cell.get('coords'), cell.get('vars')], sort_keys=True)
+    return hashlib.sha1(content).hexdigest()
+
+def getrevisions(cdb, cellkeys, pagesize=1000):
+    """Returns a dictionary of cell key to (rev, hash) for cells already in CouchDB.
+
+    The revisions and hashes are read from the hashes view (see API_DESIGN), 
+    so stored documents are not fetched. Missing or deleted documents have no 
+    row, and can be written without a _rev.
+
+    Arguments:
+        cdb - The couchdb.Database to query.
+        cellkeys - The cell keys (document ids) to look up.
+        pagesize - The number of keys sent per view request.
+    """
+    revisions = {}
+    cellkeys = list(cellkeys)
+    for start in range(0, len(cellkeys), pagesize):
+        page = cellkeys[start:start + pagesize]
+        for row in cdb.view('api/hashes', keys=page):
+            revisions[row.key] = (row.value.get('rev'), row.value.get('hash'))
+    return revisions
+
+def getcellkeys(cdb, pagesize=10000):
+    """Iterates over the keys of all cell documents in CouchDB, a page at a time.
+
+    Arguments:
+        cdb - The couchdb.Database to query.
+        pagesize - The number of rows requested from _all_docs at a time.
+    """
+    startkey = None
+    while True:
+        if startkey is None:
+            rows = list(cdb.view('_all_docs', limit=pagesize + 1))
+        else:
+            rows = list(cdb.view('_all_docs', startkey=startkey, limit=pagesize + 1))
+        for row in rows[:pagesize]:
+            if not row.id.startswith('_design/'):
+                yield row.id
+        if len(rows) <= pagesize:
+            return
+        startkey = rows[pagesize].id
+
+def buildbloom(cdbs, error_rate):
+    """Returns a BloomFilter of the keys of all cell documents in the CouchDB shards."""
+    t0 = time.time()
+    count = sum([x.info()['doc_count'] for x in cdbs])
+    cellfilter = bloom.BloomFilter.forcapacity(count, error_rate)
+    for cdb in cdbs:
+        for cellkey in getcellkeys(cdb):
+            cellfilter.add(cellkey)
+    logging.info('Bloom filter of %s cell keys (%s bits, %s hashes) built in %s' \
+        % (count, cellfilter.bits, cellfilter.hashes, time.time()-t0))
+    return cellfilter
+
+def getcellvars(cdb, pagesize=1000):
+    """Iterates over (cell key, vars) of all cells in CouchDB in rank order, a page at a time.
+
+    Arguments:
+        cdb - The couchdb.Database to query.
+        pagesize - The number of rows requested from the rows view at a time.
+    """
+    startkey = None
+    while True:
+        if startkey is None:
+            rows = list(cdb.view('api/rows', limit=pagesize + 1))
+        else:
+            rows = list(cdb.view('api/rows', startkey=startkey, limit=pagesize + 1))
+        for row in rows[:pagesize]:
+            yield row.id, row.value.get('varvals')
+        if len(rows) <= pagesize:
+            return
+        startkey = rows[pagesize].key
+
+def getrankedvars(cdbs, cells_per_degree):
+    """Iterates over (rank, cell key, vars) of all cells in the CouchDB shards in rank order."""
+    ranked = [((cellrank(x, cells_per_degree), x, y) for x, y in getcellvars(cdb)) \
+                  for cdb in cdbs]
+    if len(ranked) == 1:
+        return ranked[0]
+    return heapq.merge(*ranked)
+
+def envelopebins(histogram, bins):
+    """Returns a list of [min, max] value bins of about equal cell counts.
+
+    Arguments:
+        histogram - A dictionary of value to cell count.
+        bins - The maximum number of bins.
+    """
+    total = sum(histogram.values())
+    result = []
+    count = 0
+    for value in sorted(histogram.keys()):
+        if not result or (len(result) < bins and count >= total * len(result) / float(bins)):
+            result.append([value, value])
+        else:
+            result[-1][1] = value
+        count += histogram[value]
+    return result
+
+def buildenvelope(cdbs, edb, cells_per_degree, bins=ENVELOPE_BINS, chunk_ranks=ENVELOPE_CHUNK_RANKS):
+    """Builds the envelope index of the cells in the CouchDB shards in an empty database.
+
+    The index has a 'bins' document holding the [min, max] value bins of each
+    variable, and a document per variable and chunk of chunk_ranks cell ranks 
+    holding the base64 encoded RankSet of the cells in each bin. Cells are 
+    read twice in rank order: once for value histograms, and once to build 
+    the RankSets a chunk at a time.
+
+    Arguments:
+        cdbs - The couchdb.Database of cells of each shard.
+        edb - The empty couchdb.Database for the index.
+        cells_per_degree - The resolution of the grid.
+        bins - The maximum number of value bins per variable.
+        chunk_ranks - The number of cell ranks per index document.
+    """
+    t0 = time.time()
+    histograms = {}
+    for rank, cellkey, varvals in getrankedvars(cdbs, cells_per_degree):
+        for name, value in varvals.iteritems():
+            if value is not None:
+                histogram = histograms.setdefault(name, {})
+                value = float(value)
+                histogram[value] = histogram.get(value, 0) + 1
+    variables = {}
+    binindexes = {}
+    for name, histogram in histograms.iteritems():
+        variables[name] = envelopebins(histogram, bins)
+        binindexes[name] = {}
+        for i, (low, high) in enumerate(variables[name]):
+            for value in histogram.keys():
+                if low <= value <= high:
+                    binindexes[name][value] = i
+    edb['bins'] = {'chunk_ranks': chunk_ranks, 'variables': variables}
+    t1 = time.time()
+    logging.info('Envelope bins of %s variables computed in %s' % (len(variables), t1-t0))
+
+    def flush(chunk, ranksets):
+        docs = {}
+        for (name, i), ranks in ranksets.iteritems():
+            doc = docs.setdefault(name, {'_id': '%s-%08d' % (name, chunk), 'bins': {}})
+            doc['bins'][str(i)] = base64.b64encode(ranks.tostring())
+        edb.update(docs.values())
+
+    chunk = None
+    ranksets = {}
+    chunks = 0
+    for rank, cellkey, varvals in getrankedvars(cdbs, cells_per_degree):
+        if rank / chunk_ranks != chunk:
+            if ranksets:
+                flush(chunk, ranksets)
+                chunks += 1
+            chunk = rank / chunk_ranks
+            ranksets = {}
+        for name, value in varvals.iteritems():
+            if value is not None:
+                i = binindexes[name][float(value)]
+                ranks = ranksets.get((name, i))
+                if ranks is None:
+                    ranks = ranksets[(name, i)] = RankSet()
+                ranks.add(rank)
+    if ranksets:
+        flush(chunk, ranksets)
+        chunks += 1
+    logging.info('Envelope index of %s chunks built in %s' % (chunks, time.time()-t1))
+
 class Variable(object):
     """An environmental variable backed by a .bil and a .hdr file."""
 
@@ -136,7 +402,7 @@ class Tile(object):
     def __str__(self):
         return str(self.__dict__)
 
-    def _clip2intersect2couchdb(self, cells, options, batchnum):
+    def _clip2intersect2couchdb(self, cells, options, batchnum, queue=None):
         t0 = time.time()
         filename = os.path.join(os.path.splitext(self.filename)[0], '%s' % batchnum)
         logging.info('Preparing shapefile %s in _clip2intersect2couchdb().' % (filename) )
@@ -150,7 +416,7 @@ class Tile(object):
         logging.info('Shapefile %s prepared in %s' % (filename, t1-t0))
         clippedfile = Tile.clip2cell('%s.shp' % filename, self.filename)
         csvfile = Tile.intersect(clippedfile, options)
-        Tile.csv2couch(csvfile, options)
+        Tile.csv2couch(csvfile, options, queue)
 
     def polygon(self):
         """Returns a polygon (list of Points) for the Tile."""
@@ -161,33 +427,196 @@ class Tile(object):
         return [(w, n), (w, s), (e, s), (e, n), (w, n)]
 
     @classmethod
-    def csv2couch(cls, csvfile, options):
-        """Loads values from csv file to couchdb."""
+    def celldocs(cls, cellvars, cells_per_degree, existing=None, unchanged=None):
+        """Yields cell documents, building each one only as it is consumed.
+
+        Arguments:
+            cellvars - A dictionary of cell key to a dictionary of variable values.
+            cells_per_degree - The resolution of the grid.
+            existing - A dictionary of cell key to (rev, hash) for stored cells.
+            unchanged - An optional list to which keys of skipped cells are appended.
+        """
+        existing = existing or {}
+        for cellkey, varvals in cellvars.iteritems():
+            doc = {
+                '_id': cellkey, 
+                'coords': getpolygon(cellkey, cells_per_degree),
+                'vars': varvals
+                }
+            doc['hash'] = cellhash(doc)
+            if existing.has_key(cellkey):
+                rev, storedhash = existing.get(cellkey)
+                if storedhash == doc.get('hash'):
+                    if unchanged is not None:
+                        unchanged.append(cellkey)
+                    continue
+                doc['_rev'] = rev
+            yield doc
+
+    @classmethod
+    def spillqueue(cls, options):
+        """Returns a SpillQueue in the workspace that drains to the CouchDB shards."""
+        shards = getshards(options)
+        def upload(docs):
+            def reread(cellkeys):
+                return [doc for doc in docs if doc['_id'] in cellkeys]
+            if len(shards.shards) == 1:
+                routed = {0: docs}
+            else:
+                # A segment is read once per shard rather than held in memory:
+                routed = dict([(i, Tile.sharddocs(shards, i, docs)) \
+                                   for i in range(len(shards.shards))])
+            Tile.shardupload(shards, options, routed, reread)
+        return spillqueue.SpillQueue(os.path.join(options.workspace, 'spill'), upload)
+
+    @classmethod
+    def sharddocs(cls, shards, index, docs):
+        """Yields the documents of a shard."""
+        for doc in docs:
+            if shards.shard(doc['_id']) == index:
+                yield doc
+
+    @classmethod
+    def shardupload(cls, shards, options, routed, reread):
+        """Uploads documents to their shards concurrently (see bulkupload).
+
+        Arguments:
+            shards - The ShardMap of the cell databases.
+            options - The command line options.
+            routed - A dictionary of shard index to an iterable of its documents.
+            reread - A function returning the documents for a set of cell keys.
+
+        Returns:
+            A tuple of the total counts of ok, retried and rejected documents.
+        """
+        def upload(index):
+            server, database = splitshard(shards.shards[index])
+            couch = couchutil.Couch.fromurl(server, options.compress_threshold)
+            return lambda: Tile.bulkupload(couch, database, options, routed[index], reread)
+        counts = parallel([upload(x) for x in sorted(routed.keys())])
+        return tuple([sum(x) for x in zip(*counts)]) or (0, 0, 0)
+
+    @classmethod
+    def bulkupload(cls, couch, database, options, docs, reread, attempts=RETRY_ATTEMPTS,
+                   delay=RETRY_DELAY):
+        """Uploads documents and retries failed ones individually with fresh revisions.
+
+        Individual attempts back off exponentially, and a transport error 
+        (e.g., a dropped connection) fails only the attempt. Documents that 
+        still fail after all attempts are appended with their errors to the 
+        reject file in the workspace.
+
+        Arguments:
+            couch - The couchutil.Couch to upload to.
+            database - The name of the database to upload to.
+            options - The command line options.
+            docs - An iterable of documents.
+            reread - A function returning the documents for a set of cell keys.
+            attempts - The number of individual attempts for a failed document.
+            delay - The delay in seconds before the second individual attempt.
+
+        Returns:
+            A tuple of the counts of ok, retried and rejected documents.
+        """
+        results = couch.bulkDocs(database, docs)
+        failed = {}
+        for result in results:
+            if result.has_key('error'):
+                failed[result.get('id')] = result
+        ok = len(results) - len(failed)
+        retried = 0
+        rejected = 0
+        if failed:
+            for doc in reread(set(failed.keys())):
+                cellkey = doc['_id']
+                for attempt in range(attempts):
+                    if attempt > 0:
+                        time.sleep(delay * 2 ** (attempt - 1))
+                    try:
+                        rev = couch.getRev(database, cellkey)
+                        if rev:
+                            doc['_rev'] = rev
+                        elif doc.has_key('_rev'):
+                            del doc['_rev']
+                        result = couch.bulkDocs(database, [doc])[0]
+                    except (httplib.HTTPException, socket.error), e:
+                        result = {'id': cellkey, 'error': 'transport', 'reason': str(e)}
+                    if not result.has_key('error'):
+                        break
+                    failed[cellkey] = result
+                if result.has_key('error'):
+                    Tile.reject(options, doc, result)
+                    rejected += 1
+                else:
+                    retried += 1
+        logging.info('Batch of %s documents: %s ok, %s retried, %s rejected' \
+            % (len(results), ok, retried, rejected))
+        return (ok, retried, rejected)
+
+    @classmethod
+    def reject(cls, options, doc, result):
+        """Appends a document that could not be uploaded to the reject file."""
+        rejectfile = os.path.join(options.workspace, REJECT_FILE)
+        logging.error('Rejecting document %s (%s: %s), see %s' \
+            % (doc['_id'], result.get('error'), result.get('reason'), rejectfile))
+        f = open(rejectfile, 'a')
+        f.write(json.dumps({'doc': doc, 
+                            'error': result.get('error'), 
+                            'reason': result.get('reason')}))
+        f.write('\n')
+        f.close()
+
+    @classmethod
+    def csv2couch(cls, csvfile, options, queue=None):
+        """Loads values from csv file to couchdb, or to queue if one is given."""
         t0 = time.time()
         logging.info('Beginning csv2couch(), preparing cells for bulkloading from %s.' % (csvfile) )
-        server = couchdb.Server(options.couchurl)
-        cdb = server[options.database]
+        shards = getshards(options)
         cells_per_degree = float(options.cells_per_degree)
         dr = csv.DictReader(open(csvfile, 'r'))
-        cells = {}
+        cellvars = {}
         for row in dr:
             cellkey = row.get('CellKey')
-            if not cells.has_key(cellkey):
-                cells[cellkey] = {
-                    '_id': cellkey, 
-                    'coords': getpolygon(cellkey, cells_per_degree),
-                    'vars': {}
-                    }            
+            if not cellvars.has_key(cellkey):
+                cellvars[cellkey] = {}
             varname = row.get('RID').split('_')[0]
             # the following dependent on running starspan with --stats %s avg
             varval = row.get('avg_Band1')
             # the following need for Worldclim because of the -9999 NODATA value.
-            cells.get(cellkey).get('vars')[varname] = translatevariable(varname, varval)
+            cellvars.get(cellkey)[varname] = translatevariable(varname, varval)
         t1 = time.time()
-        logging.info('%s cells prepared for upload in %s' % (len(cells), t1-t0))
-        cdb.update(cells.values())
+        logging.info('%s cells prepared for upload in %s' % (len(cellvars), t1-t0))
+        routed = shards.route(cellvars.keys())
+        existing = {}
+        if options.reload:
+            revisions = parallel([(lambda x=x: getrevisions(sharddb(shards.shards[x]), routed[x])) \
+                                      for x in sorted(routed.keys())])
+            for x in revisions:
+                existing.update(x)
+            logging.info('%s existing cells checked in %s' % (len(existing), time.time()-t1))
+            t1 = time.time()
+        unchanged = []
+        docs = Tile.celldocs(cellvars, cells_per_degree, existing, unchanged)
+        if queue:
+            segment = queue.append(docs)
+            t2 = time.time()
+            logging.info('%s documents spilled to segment %s in %s, %s unchanged cells skipped' \
+                % (len(cellvars)-len(unchanged), segment, t2-t1, len(unchanged)))
+            return
+        def reread(cellkeys):
+            subset = dict([(x, cellvars.get(x)) for x in cellkeys])
+            return Tile.celldocs(subset, cells_per_degree)
+        if len(routed) > 1:
+            # Each shard builds its documents as it uploads them:
+            sharded = dict([(x, Tile.celldocs(dict([(y, cellvars.get(y)) for y in keys]),
+                                              cells_per_degree, existing, unchanged)) \
+                                for x, keys in routed.iteritems()])
+        else:
+            sharded = dict([(x, docs) for x in routed.keys()])
+        ok, retried, rejected = Tile.shardupload(shards, options, sharded, reread)
         t2 = time.time()
-        logging.info('%s documents uploaded in %s' % (len(cells), t2-t1))
+        logging.info('%s documents uploaded in %s, %s unchanged cells skipped' \
+            % (ok + retried, t2-t1, len(unchanged)))
 
     @classmethod
     def intersect(cls, shapefile, options):      
@@ -233,17 +662,27 @@ class Tile(object):
         cells_per_degree = float(options.cells_per_degree)
         cells = []
         count = 0
+        queue = None
+        if options.spill:
+            queue = Tile.spillqueue(options)
+            queue.start()
         for cell in self.getcells():
             cells.append(cell)
             count += 1
             if count >= batchsize:
-                self._clip2intersect2couchdb(cells, options, batchnum)
+                self._clip2intersect2couchdb(cells, options, batchnum, queue)
                 count = 0
                 cells = []
                 batchnum += 1
                 continue
         if count > 0:
-            self._clip2intersect2couchdb(cells, options, batchnum)
+            self._clip2intersect2couchdb(cells, options, batchnum, queue)
+        if queue:
+            logging.info('Waiting for the spill queue to drain.')
+            queue.close()
+            if queue.dead():
+                logging.error('Segments %s failed to upload, run the drain command to retry them.' \
+                    % queue.dead())
         t1 = time.time()
         logging.info('Total elapsed time to bulkload2couchdb(): %s' % (t1-t0))
     
@@ -402,6 +841,50 @@ def _getoptions():
                       dest="logfile",
                       help="The name of the log file",
                       default=None)
+    parser.add_option("-r", 
+                      "--reload", 
+                      dest="reload",
+                      action="store_true",
+                      help="Only upload new or changed cells, with their current revisions",
+                      default=False)
+    parser.add_option("-z", 
+                      "--compress-threshold", 
+                      dest="compress_threshold",
+                      type="int",
+                      help="Gzip CouchDB request bodies of at least this many bytes",
+                      default=None)
+    parser.add_option("-s", 
+                      "--spill", 
+                      dest="spill",
+                      action="store_true",
+                      help="Spill batches to the workspace and upload them in the background",
+                      default=False)
+    parser.add_option("-o", 
+                      "--outfile", 
+                      dest="outfile",
+                      help="The output file (e.g., of the bloom command)",
+                      default=None)
+    parser.add_option("-e", 
+                      "--error-rate", 
+                      dest="error_rate",
+                      help="The false positive rate of the bloom command filter (default 0.01)",
+                      default=0.01)
+    parser.add_option("-m", 
+                      "--shards", 
+                      dest="shards",
+                      help="The JSON map of the CouchDB databases cells are sharded across",
+                      default=None)
+    parser.add_option("-i", 
+                      "--shard-count", 
+                      dest="shard_count",
+                      type="int",
+                      help="The number of shards of the shardmap command (default 2)",
+                      default=2)
+    parser.add_option("-j", 
+                      "--scheme", 
+                      dest="scheme",
+                      help="The shardmap command scheme, rows or rank (default rows)",
+                      default='rows')
     return parser.parse_args()[0]
 
 if __name__ == '__main__':
@@ -435,6 +918,48 @@ if __name__ == '__main__':
         load(options, clipped)    
         logging.info('Finished command load.')
 
+    if command == 'drain':
+        queue = Tile.spillqueue(options)
+        requeued = queue.requeue()
+        if requeued:
+            logging.info('Requeued %s dead segments.' % requeued)
+        queue.drain()
+        logging.info('Finished command drain.')
+
+    if command == 'shardmap':
+        servers = [x.rstrip('/') for x in options.couchurl.split(',')]
+        count = int(options.shard_count)
+        shards = ['%s/%s-%d' % (servers[i % len(servers)], options.database, i) \
+                      for i in range(count)]
+        cells_per_degree = float(options.cells_per_degree or CELLS_PER_DEGREE)
+        ShardMap(shards, options.scheme, cells_per_degree=cells_per_degree).save(options.outfile)
+        logging.info('Finished command shardmap, saved to %s.' % (options.outfile))
+
+    if command == 'bloom':
+        cdbs = [sharddb(x) for x in getshards(options).shards]
+        cellfilter = buildbloom(cdbs, float(options.error_rate))
+        cellfilter.save(options.outfile)
+        logging.info('Finished command bloom, saved to %s.' % (options.outfile))
+
+    if command == 'design':
+        for url in getshards(options).shards:
+            server, database = splitshard(url)
+            server = couchdb.Server(server)
+            if database not in server:
+                server.create(database)
+            putdesign(server[database])
+        logging.info('Finished command design.')
+
+    if command == 'envelope':
+        cdbs = [sharddb(x) for x in getshards(options).shards]
+        server = couchdb.Server(options.couchurl)
+        name = '%s-envelope' % options.database
+        if name in server:
+            del server[name]
+        edb = server.create(name)
+        buildenvelope(cdbs, edb, float(options.cells_per_degree))
+        logging.info('Finished command envelope, built in %s.' % (name))
+
     if command == 'getworldclimtile':
         varset = ['tmean','tmin','tmax','prec','alt','bio']
         for var in varset:
@@ -459,6 +984,27 @@ if __name__ == '__main__':
 #Command line to load tile 37:
 # ./sdl.py -c load -v /home/tuco/Data/SDL/worldclim/37 -w /home/tuco/SDL/workspace -u http://eighty.berkeley.edu:5984 -d worldclim-rmg -g /home/tuco/SDL/Spatial-Data-Library/data/gadm/Terrestrial-10min-buffered_00833.shp -k 37 -f 30,0 -t 60,-30 -n 120 -b 25000 &
 
+#Command line to reload tile 37 after a fix, skipping unchanged cells (needs the hashes view of the design command):
+# ./sdl.py -c load -r -v /home/tuco/Data/SDL/worldclim/37 -w /home/tuco/SDL/workspace -u http://eighty.berkeley.edu:5984 -d worldclim-rmg -g /home/tuco/SDL/Spatial-Data-Library/data/gadm/Terrestrial-10min-buffered_00833.shp -k 37 -f 30,0 -t 60,-30 -n 120 -b 25000 &
+
+#Command line to upload batches left in the spill queue of an interrupted load, and dead segments:
+# ./sdl.py -c drain -w /home/tuco/SDL/workspace -u http://eighty.berkeley.edu:5984 -d worldclim-rmg
+
+#Command line to create or update the views queried by the API:
+# ./sdl.py -c design -w /home/tuco/SDL/workspace -u http://eighty.berkeley.edu:5984 -d worldclim-rmg
+
+#Command line to rebuild the envelope index of value ranges queried by /api/cells/envelope:
+# ./sdl.py -c envelope -w /home/tuco/SDL/workspace -u http://eighty.berkeley.edu:5984 -d worldclim-rmg -n 120
+
+#Command line to build the Bloom filter of loaded cell keys deployed with the API:
+# ./sdl.py -c bloom -w /home/tuco/SDL/workspace -u http://eighty.berkeley.edu:5984 -d worldclim-rmg -o /home/tuco/SDL/Spatial-Data-Library/app/cellkeys.bloom
+
+#Command line to map cells to 4 databases by bands of rows, on two servers:
+# ./sdl.py -c shardmap -w /home/tuco/SDL/workspace -u http://eighty.berkeley.edu:5984,http://eightyone.berkeley.edu:5984 -d worldclim-rmg -i 4 -j rows -n 120 -o /home/tuco/SDL/Spatial-Data-Library/app/shards.json
+
+#Command line to load tile 37 into the shards of the map (also pass -m to design, bloom and envelope):
+# ./sdl.py -c load -m /home/tuco/SDL/Spatial-Data-Library/app/shards.json -v /home/tuco/Data/SDL/worldclim/37 -w /home/tuco/SDL/workspace -u http://eighty.berkeley.edu:5984 -d worldclim-rmg -g /home/tuco/SDL/Spatial-Data-Library/data/gadm/Terrestrial-10min-buffered_00833.shp -k 37 -f 30,0 -t 60,-30 -n 120 -b 25000 &
+
 #Command line to load tile 12 with logging:
 # ./sdl.py -c load -v /home/tuco/Data/SDL/worldclim/12 -w /home/tuco/SDL/workspace -u http://eighty.berkeley.edu:5984 -d worldclim-rmg -g /home/tuco/SDL/Spatial-Data-Library/data/gadm/Terrestrial-10min-buffered_00833.shp -k 12 -f -120,60 -t -90,30 -n 120 -b 25000 > /home/tuco/SDL/workspace/tile12load.log &
 
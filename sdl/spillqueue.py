@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+# Copyright 2011 Jante LLC and University of Kansas
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele, Dave Vieglais, and John Wieczorek"
+
+"""
+This module includes a durable queue that spills ready-to-upload document
+batches to segment files in the workspace, so that clipping and starspan
+statistics can run ahead of a slow or briefly unavailable CouchDB.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+"""The delay in seconds before the first retry of a failed segment upload."""
+INITIAL_DELAY = 1.0
+
+"""The maximum delay in seconds between retries of a failed segment upload."""
+MAX_DELAY = 300.0
+
+"""The number of upload attempts of a segment before it is moved to the dead directory."""
+MAX_ATTEMPTS = 10
+
+"""The subdirectory of segments that failed every upload attempt."""
+DEAD_DIRECTORY = 'dead'
+
+class Segment(object):
+    """The documents in a segment file, re-read each time they are iterated."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        f = open(self.path, 'r')
+        try:
+            for line in f:
+                yield json.loads(line)
+        finally:
+            f.close()
+
+class SpillQueue(object):
+    """A queue of document batches backed by segment files in a directory.
+
+    Each batch is written to its own segment file, one JSON document per line.
+    A background thread drains segments in order by passing their documents
+    to an upload function, retrying failures with exponential backoff. The
+    number of the last acknowledged segment is recorded in an 'ack' file, so
+    a restarted queue resumes draining after it.
+
+    A segment that fails max_attempts uploads (e.g., for a bad document or a 
+    missing database) is moved to the dead subdirectory and acknowledged, so 
+    that it does not block the segments after it. Dead segments are appended
+    to the queue again by requeue.
+    """
+
+    def __init__(self, directory, upload, initial_delay=INITIAL_DELAY, max_delay=MAX_DELAY,
+                 max_attempts=MAX_ATTEMPTS):
+        """Constructs a SpillQueue.
+
+        Arguments:
+            directory - The directory for segment files (created if missing).
+            upload - A function called with the Segment of documents to
+                upload. The segment is acknowledged when it returns and
+                retried when it raises.
+            initial_delay - The delay in seconds before the first retry.
+            max_delay - The maximum delay in seconds between retries.
+            max_attempts - The number of attempts before a segment is dead.
+        """
+        self.directory = directory
+        self.upload = upload
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._condition = threading.Condition()
+        self._closing = False
+        self._thread = None
+        self.acked = self._readack()
+        pending = self.pending()
+        if pending:
+            self._next = pending[-1] + 1
+            logging.info('Spill queue %s resuming with %s pending segments after segment %s.' \
+                % (directory, len(pending), self.acked))
+        else:
+            self._next = self.acked + 1
+
+    def _path(self, segment):
+        return os.path.join(self.directory, 'segment-%08d.json' % segment)
+
+    def _readack(self):
+        path = os.path.join(self.directory, 'ack')
+        if not os.path.exists(path):
+            return -1
+        return int(open(path, 'r').read().strip())
+
+    def _writeack(self, segment):
+        path = os.path.join(self.directory, 'ack')
+        f = open('%s.tmp' % path, 'w')
+        f.write('%s\n' % segment)
+        f.close()
+        os.rename('%s.tmp' % path, path)
+        self.acked = segment
+
+    def pending(self):
+        """Returns the sorted numbers of segments not yet acknowledged."""
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith('segment-') and name.endswith('.json'):
+                segment = int(name[len('segment-'):-len('.json')])
+                if segment > self.acked:
+                    segments.append(segment)
+                else:
+                    # Acknowledged before a restart but not yet removed.
+                    os.remove(os.path.join(self.directory, name))
+        segments.sort()
+        return segments
+
+    def append(self, docs):
+        """Writes an iterable of documents to a new segment and returns its number."""
+        self._condition.acquire()
+        try:
+            segment = self._next
+            self._next += 1
+        finally:
+            self._condition.release()
+        path = self._path(segment)
+        count = 0
+        f = open('%s.tmp' % path, 'w')
+        for doc in docs:
+            f.write(json.dumps(doc))
+            f.write('\n')
+            count += 1
+        f.close()
+        os.rename('%s.tmp' % path, path)
+        logging.info('Spilled %s documents to segment %s.' % (count, segment))
+        self._condition.acquire()
+        try:
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        return segment
+
+    def read(self, segment):
+        """Returns a Segment iterable over the documents in a segment."""
+        return Segment(self._path(segment))
+
+    def _deadpath(self, segment):
+        return os.path.join(self.directory, DEAD_DIRECTORY, 'segment-%08d.json' % segment)
+
+    def _drainsegment(self, segment):
+        delay = self.initial_delay
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                t0 = time.time()
+                self.upload(self.read(segment))
+                logging.info('Segment %s drained in %s after %s attempts.' \
+                    % (segment, time.time()-t0, attempt))
+                break
+            except Exception, e:
+                if attempt == self.max_attempts:
+                    deadpath = self._deadpath(segment)
+                    logging.error('Segment %s upload attempt %s failed (%s), moving it to %s.' \
+                        % (segment, attempt, e, deadpath))
+                    if not os.path.exists(os.path.dirname(deadpath)):
+                        os.makedirs(os.path.dirname(deadpath))
+                    os.rename(self._path(segment), deadpath)
+                    self._writeack(segment)
+                    return
+                logging.warning('Segment %s upload attempt %s failed (%s), retrying in %s s.' \
+                    % (segment, attempt, e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+        self._writeack(segment)
+        os.remove(self._path(segment))
+
+    def dead(self):
+        """Returns the sorted numbers of segments moved to the dead directory."""
+        directory = os.path.join(self.directory, DEAD_DIRECTORY)
+        if not os.path.exists(directory):
+            return []
+        return sorted([int(x[len('segment-'):-len('.json')]) for x in os.listdir(directory) \
+                           if x.startswith('segment-') and x.endswith('.json')])
+
+    def requeue(self):
+        """Appends the documents of dead segments to the queue again and returns their count."""
+        dead = self.dead()
+        for segment in dead:
+            self.append(Segment(self._deadpath(segment)))
+            os.remove(self._deadpath(segment))
+        return len(dead)
+
+    def drain(self):
+        """Uploads pending segments in order until none are left."""
+        pending = self.pending()
+        while pending:
+            for segment in pending:
+                self._drainsegment(segment)
+            pending = self.pending()
+
+    def _run(self):
+        while True:
+            self.drain()
+            self._condition.acquire()
+            try:
+                if self._closing and not self.pending():
+                    return
+                self._condition.wait(1.0)
+            finally:
+                self._condition.release()
+
+    def start(self):
+        """Starts draining segments in a background thread."""
+        self._thread = threading.Thread(target=self._run, name='SpillQueue')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def close(self):
+        """Waits until every appended segment has been acknowledged."""
+        self._condition.acquire()
+        try:
+            self._closing = True
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
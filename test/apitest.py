@@ -0,0 +1,559 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for functions of the API, with the SDK service stubs."""
+
+import base64
+import cgi
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import unittest
+
+SDK = '../lib/google_appengine'
+sys.path[:0] = ['../app', SDK, SDK + '/lib/webob', SDK + '/lib/simplejson',
+                SDK + '/lib/django', SDK + '/lib/yaml/lib']
+
+os.environ['APPLICATION_ID'] = 'geo-ds'
+
+from google.appengine.api import apiproxy_stub, apiproxy_stub_map, datastore_file_stub
+from google.appengine.api import memcache, urlfetch_service_pb
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.api.taskqueue import taskqueue_stub
+from google.appengine.runtime import apiproxy_errors
+
+import api
+from sdl import rmg, shardmap
+
+def setupstubs():
+    """Registers fresh datastore and memcache stubs."""
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', 
+        datastore_file_stub.DatastoreFileStub('geo-ds', None, None))
+    apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub('taskqueue', 
+        taskqueue_stub.TaskQueueServiceStub(root_path='../app'))
+
+class ParseKeysTest(unittest.TestCase):
+    def test_runs(self):
+        self.assertEqual(api.parsekeys('15:9-11, 5-5,'), 
+                         set(['9-15', '10-15', '11-15', '5-5']))
+        self.assertEqual(len(api.parsekeys('0:0-%s' % (api.MAX_RUN_CELLS - 1))), 
+                         api.MAX_RUN_CELLS)
+
+    def test_bad_runs(self):
+        for k in ('15:9', '15:a-b', '15:11-9', '-1:0-5', '15:-5-5'):
+            self.assertRaises(ValueError, api.parsekeys, k)
+
+    def test_max_run_cells(self):
+        self.assertRaises(ValueError, api.parsekeys, '0:0-%s' % api.MAX_RUN_CELLS)
+        # A reversed run cannot offset the cells of another:
+        self.assertRaises(ValueError, api.parsekeys, '0:1000000-0,0:0-1000000')
+        self.assertRaises(ValueError, api.parsekeys, '0:0-1000000,0:1000000-0')
+
+CELL = (1, u'1', '[]', ('5', '7'))
+
+class ResponseFormatsTest(unittest.TestCase):
+    def setUp(self):
+        self.items = [('3-4', (('bio1', 'name'), '1', '[[1, 2], [3, 4]]', ('1.5', '"a,b"'))),
+                      ('5-6', (('bio1',), '1', '[]', ('-2',)))]
+
+    def encode(self, fmt, variable_names=None, c=False, paged=False, cursor=None):
+        chunks = api.RESPONSE_FORMATS[fmt][1]
+        return ''.join(chunks(self.items, variable_names, c, paged, cursor))
+
+    def test_json(self):
+        self.assertEqual(api.simplejson.loads(self.encode('json')), 
+            [{'cell-key': '3-4', 'cell-values': {'bio1': 1.5, 'name': 'a,b'}},
+             {'cell-key': '5-6', 'cell-values': {'bio1': -2}}])
+        page = api.simplejson.loads(self.encode('json', ['name'], paged=True, cursor='c'))
+        self.assertEqual(page['cursor'], 'c')
+        self.assertEqual(page['cells'][1]['cell-values'], {'name': None})
+
+    def test_columnar(self):
+        self.assertEqual(api.simplejson.loads(self.encode('columnar', c=True)), 
+            {'cell-keys': ['3-4', '5-6'], 
+             'cell-values': {'bio1': [1.5, -2], 'name': ['a,b', None]},
+             'cell-coords': [[[1, 2], [3, 4]], []]})
+
+    def test_csv(self):
+        self.assertEqual(self.encode('csv', c=True), 
+            'cell-key,bio1,name,cell-coords\r\n'
+            '3-4,1.5,"a,b","[[1, 2], [3, 4]]"\r\n'
+            '5-6,-2,,"[]"\r\n')
+
+    def test_binary(self):
+        self.items = self.items[:1]
+        # NaN is left out, since the sign bit of float('nan') varies by platform:
+        self.assertEqual(self.encode('binary', ['bio1']),
+            'SDLC\x01\x00\x01\x00\x01\x00\x00\x00'
+            '\x04bio1'
+            '\x03\x00\x00\x00\x04\x00\x00\x00'
+            '\x00\x00\xc0\x3f')
+
+    def test_binary_round_trip(self):
+        data = self.encode('binary', c=True)
+        magic, version, flags, count, cells = struct.unpack_from(api.BINARY_HEADER, data)
+        self.assertEqual((magic, version, flags, count, cells), ('SDLC', 1, 1, 2, 2))
+        offset = struct.calcsize(api.BINARY_HEADER)
+        names = []
+        for i in range(count):
+            size = ord(data[offset])
+            names.append(data[offset + 1:offset + 1 + size])
+            offset += 1 + size
+        self.assertEqual(names, ['bio1', 'name'])
+        record = struct.Struct('<II2f10d')
+        rows = []
+        for i in range(cells):
+            rows.append(record.unpack_from(data, offset))
+            offset += record.size
+        self.assertEqual(offset, len(data))
+        self.assertEqual(rows[0][:3], (3, 4, 1.5))
+        self.assertEqual(rows[0][4:8], (1.0, 2.0, 3.0, 4.0))
+        self.assertEqual(rows[1][:3], (5, 6, -2.0))
+        # Missing values and vertices are NaN:
+        self.assertTrue(rows[0][3] != rows[0][3] and rows[1][3] != rows[1][3])
+        self.assertTrue(rows[0][8] != rows[0][8])
+
+class AnnotatePointsTest(unittest.TestCase):
+    def points(self, body):
+        return [x[1:] for x in api.AnnotateHandler.jsonpoints(body)]
+
+    def test_json_points(self):
+        self.assertEqual(self.points(' [[1, 2], ["a", 5], [1.5e1, -3, 4], null, [200, 0],[-1,-2]] '),
+            [(1.0, 2.0), (None, None), (None, None), (None, None), (None, None), (-1.0, -2.0)])
+        self.assertEqual(self.points('[]'), [])
+
+    def test_bad_json(self):
+        for body in ('', '{"a": 1}'):
+            self.assertRaises(ValueError, api.AnnotateHandler.jsonpoints, body)
+        for body in ('[1.2.3,5]', '[[1,2] [3,4]]', '[[1,2]] x', '[[1,2],'):
+            self.assertRaises(ValueError, self.points, body)
+
+    def test_csv_points(self):
+        header, points = api.AnnotateHandler.csvpoints('id,Lat,Lng\n1,2,3\n2,nan,1\n3,x,1\n4\n')
+        self.assertEqual(header, ['id', 'Lat', 'Lng'])
+        self.assertEqual([x[1:] for x in points],
+                         [(3.0, 2.0), (None, None), (None, None), (None, None)])
+
+class Handler(object):
+    """A webapp.RequestHandler with a buffered response."""
+
+    def __init__(self):
+        self.response = api.webapp.Response()
+
+class WriteChunksTest(unittest.TestCase):
+    def setUp(self):
+        self.chunks = ['%s,' % i for i in range(5000)]
+        self.size = api.RESPONSE_CHUNK_SIZE
+        api.RESPONSE_CHUNK_SIZE = 1000
+
+    def tearDown(self):
+        api.RESPONSE_CHUNK_SIZE = self.size
+
+    def test_plain(self):
+        handler = Handler()
+        size = api.writechunks(handler, iter(self.chunks), False)
+        self.assertEqual(handler.response.out.getvalue(), ''.join(self.chunks))
+        self.assertEqual(size, len(''.join(self.chunks)))
+        self.assertFalse(handler.response.headers.get('Content-Encoding'))
+
+    def test_gzipped(self):
+        handler = Handler()
+        size = api.writechunks(handler, iter(self.chunks), True)
+        body = handler.response.out.getvalue()
+        self.assertEqual(handler.response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(size, len(body))
+        self.assertEqual(api.gziputil.gunzip(body), ''.join(self.chunks))
+
+class CoalescedFetchTest(unittest.TestCase):
+    def setUp(self):
+        setupstubs()
+        api.DATASET_VERSION = None
+        self.fetches = []
+        self.fetchcells = api.CellValuesHandler.fetchcells
+        api.CellValuesHandler.fetchcells = classmethod(self.fetch)
+
+    def tearDown(self):
+        api.CellValuesHandler.fetchcells = self.fetchcells
+        api.MEMCACHE_LEASES = False
+
+    def fetch(self, cls, cell_keys, stats):
+        self.fetches.append(set(cell_keys))
+        if 'fail' in cell_keys:
+            raise RuntimeError('CouchDB unavailable')
+        fetched = dict.fromkeys(cell_keys, CELL)
+        api.cacheset(fetched)
+        return fetched
+
+    def test_no_leases_by_default(self):
+        self.assertFalse(api.MEMCACHE_LEASES)
+        cacheadd = api.cacheadd
+        api.cacheadd = None
+        try:
+            cells = api.CellValuesHandler.coalescedfetch(set(['1-2', '3-4']), None)
+        finally:
+            api.cacheadd = cacheadd
+        self.assertEqual(cells, {'1-2': CELL, '3-4': CELL})
+        self.assertEqual(self.fetches, [set(['1-2', '3-4'])])
+
+    def test_leases_released(self):
+        api.MEMCACHE_LEASES = True
+        cells = api.CellValuesHandler.coalescedfetch(set(['1-2', '3-4']), None)
+        self.assertEqual(cells, {'1-2': CELL, '3-4': CELL})
+        self.assertEqual(api.cacheget(['1-2', '3-4'], api.LEASE_PREFIX), {})
+
+    def test_wait_on_lease(self):
+        api.MEMCACHE_LEASES = True
+        # Another instance leases 3-4 and caches it while this one waits:
+        api.cacheadd({'3-4': 'other'}, api.LEASE_PREFIX, time=api.LEASE_TTL)
+        def other():
+            time.sleep(0.1)
+            api.cacheset({'3-4': CELL})
+            api.cachedelete(['3-4'], api.LEASE_PREFIX)
+        thread = threading.Thread(target=other)
+        thread.start()
+        stats = api.tierstats.RequestStats()
+        cells = api.CellValuesHandler.coalescedfetch(set(['1-2', '3-4']), stats)
+        thread.join()
+        self.assertEqual(cells, {'1-2': CELL, '3-4': CELL})
+        self.assertEqual(self.fetches, [set(['1-2'])])
+
+    def test_leases_released_on_error(self):
+        api.MEMCACHE_LEASES = True
+        self.assertRaises(RuntimeError, 
+            api.CellValuesHandler.coalescedfetch, set(['fail']), None)
+        self.assertEqual(api.cacheget(['fail'], api.LEASE_PREFIX), {})
+
+class BlockTierTest(unittest.TestCase):
+    def setUp(self):
+        setupstubs()
+        api.DATASET_VERSION = None
+        self.lookups = []
+        self.blocksfromds = api.CellValuesHandler.blocksfromds
+        api.CellValuesHandler.blocksfromds = classmethod(self.fromds)
+
+    def tearDown(self):
+        api.CellValuesHandler.blocksfromds = self.blocksfromds
+
+    def fromds(self, cls, block_keys):
+        self.lookups.append(sorted(block_keys))
+        return {}
+
+    def test_scattered_keys(self):
+        keys = set(['%s-0' % x for x in range(api.BLOCK_MIN_KEYS - 1)])
+        self.assertEqual(api.CellValuesHandler.fromblocks(keys), ({}, set()))
+        self.assertEqual(self.lookups, [])
+
+    def test_unbuilt_block_cached(self):
+        keys = set(['%s-0' % x for x in range(api.BLOCK_MIN_KEYS)])
+        for i in range(3):
+            self.assertEqual(api.CellValuesHandler.fromblocks(keys), ({}, set()))
+        self.assertEqual(self.lookups, [['0-0']])
+        # Built blocks are served:
+        block = api.cachepack.packblock({'1-0': CELL})
+        api.cacheset({'0-0': block}, api.BLOCK_PREFIX, True)
+        api.cachedelete(['0-0'], api.BLOCK_UNBUILT_PREFIX, True)
+        cells, absent = api.CellValuesHandler.fromblocks(keys)
+        self.assertEqual(cells, {'1-0': CELL})
+        self.assertEqual(absent, keys.difference(['1-0']))
+
+def queuedparams(queue_name):
+    """Returns the parameters of the tasks in a queue of the task queue stub."""
+    stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+    return [dict(cgi.parse_qsl(base64.b64decode(x['body']))) for x in stub.GetTasks(queue_name)]
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        setupstubs()
+        api.DATASET_VERSION = None
+        self.dense = ['%s-0' % x for x in range(api.BLOCK_MIN_KEYS)]
+
+    def test_sparse_cells_backfilled(self):
+        api.CellValuesHandler.backfill({'1-2': CELL}, ['1-2', '3-4'])
+        self.assertEqual(queuedparams(api.BACKFILL_QUEUE), [{'k': '1-2'}])
+        self.assertEqual(api.cacheget(['3-4']), {'3-4': api.MISSING})
+
+    def test_unbuilt_block_queued(self):
+        api.cacheset({'0-0': 1}, api.BLOCK_UNBUILT_PREFIX, True)
+        # A cell of another block is still backfilled:
+        keys = self.dense + ['1000-1000']
+        api.CellValuesHandler.backfill(dict.fromkeys(keys, CELL), keys)
+        self.assertEqual(queuedparams(api.BACKFILL_QUEUE), [{'b': '0-0'}, {'k': '1000-1000'}])
+
+    def test_built_block_not_queued(self):
+        # The block is not marked unbuilt, since getblocks found it, or never looked:
+        api.CellValuesHandler.backfill(dict.fromkeys(self.dense, CELL), self.dense)
+        params = queuedparams(api.BACKFILL_QUEUE)
+        self.assertEqual(len(params), 1)
+        self.assertEqual(sorted(params[0]['k'].split(',')), sorted(self.dense))
+
+class CouchStub(apiproxy_stub.APIProxyStub):
+    """A urlfetch stub that answers CouchDB cells and rows view queries from a dictionary of cells.
+
+    With a ShardMap, each shard database answers with its own cells, and 
+    queries of the shard URLs in down fail.
+    """
+
+    def __init__(self, varvals, shards=None):
+        apiproxy_stub.APIProxyStub.__init__(self, 'urlfetch')
+        self.varvals = varvals
+        self.shards = shards
+        self.down = set()
+        self.urls = []
+
+    def _Dynamic_Fetch(self, request, response):
+        url = request.url()
+        self.urls.append(url)
+        keys = self.varvals.keys()
+        if self.shards:
+            index = [i for i, x in enumerate(self.shards.shards) if url.startswith(x)][0]
+            if self.shards.shards[index] in self.down:
+                raise apiproxy_errors.ApplicationError(
+                    urlfetch_service_pb.URLFetchServiceError.FETCH_ERROR)
+            keys = [x for x in keys if self.shards.shard(x) == index]
+        if '?' in url:
+            query = dict(cgi.parse_qsl(url.split('?', 1)[1]))
+            start, end = [api.simplejson.loads(query[x]) for x in ('startkey', 'endkey')]
+            rowkeys = sorted([[int(y) for y in reversed(x.split('-'))] for x in keys])
+            rows = [{'key': x, 'value': self.value('%s-%s' % (x[1], x[0]))} \
+                        for x in rowkeys if start <= x <= end][:int(query['limit'])]
+        else:
+            requested = api.simplejson.loads(request.payload())['keys']
+            rows = [{'key': x, 'value': self.value(x)} for x in requested if x in keys]
+        response.set_statuscode(200)
+        response.set_content(api.simplejson.dumps({'rows': rows}))
+
+    def value(self, key):
+        return {'rev': '1', 'coords': [], 'varvals': self.varvals[key]}
+
+class BackfillHandlerTest(unittest.TestCase):
+    def setUp(self):
+        setupstubs()
+        api.DATASET_VERSION = None
+        api.LOCAL_CACHE.clear()
+        self.couch = CouchStub({'1-2': {'bio1': 5}, '3-4': {'bio1': 7}})
+        apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', self.couch)
+
+    def test_served_from_datastore(self):
+        keys = set(['1-2', '3-4', '5-6'])
+        cells = api.CellValuesHandler.getcells(keys)
+        self.assertEqual(sorted(cells.keys()), ['1-2', '3-4'])
+        params = queuedparams(api.BACKFILL_QUEUE)
+        self.assertEqual(len(params), 1)
+        self.assertEqual(sorted(params[0]['k'].split(',')), ['1-2', '3-4'])
+        handler = api.BackfillHandler()
+        handler.initialize(api.webapp.Request.blank('%s?k=%s' % (api.BACKFILL_URL, params[0]['k'])), 
+            api.webapp.Response())
+        handler.post()
+        self.assertEqual(api.CouchDbCell.all().count(), 2)
+        # After memcache is flushed, the next request is served from the datastore:
+        memcache.flush_all()
+        api.LOCAL_CACHE.clear()
+        api.DATASET_VERSION = None
+        queries = len(self.couch.urls)
+        stats = api.tierstats.RequestStats()
+        self.assertEqual(api.CellValuesHandler.getcells(set(['1-2', '3-4']), stats), cells)
+        self.assertEqual(len(self.couch.urls), queries)
+        self.assertTrue(('datastore', 2, 2) in [x[:3] for x in stats.tiers])
+
+class Response(api.webapp.Response):
+    """A webapp.Response that keeps its status code."""
+
+    def set_status(self, code, message=None):
+        self.status = code
+        api.webapp.Response.set_status(self, code, message)
+
+def call(handler_class, path, headers=None, method='GET'):
+    """Returns the Response of a handler to a request."""
+    request = api.webapp.Request.blank(path, headers=headers)
+    request.method = method
+    response = Response()
+    handler = handler_class()
+    handler.initialize(request, response)
+    getattr(handler, method.lower())()
+    return response
+
+class ValuesETagTest(unittest.TestCase):
+    def setUp(self):
+        setupstubs()
+        api.DATASET_VERSION = None
+        api.LOCAL_CACHE.clear()
+        apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', CouchStub({'1-2': {'bio1': 5}}))
+        self.path = '/api/cells/values?k=1-2'
+
+    def test_not_modified(self):
+        response = call(api.CellValuesHandler, self.path)
+        etag = response.headers['ETag']
+        self.assertEqual(response.status, 200)
+        response = call(api.CellValuesHandler, self.path, {'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.out.getvalue(), '')
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_version_bump(self):
+        etag = call(api.CellValuesHandler, self.path).headers['ETag']
+        call(api.InvalidateHandler, api.INVALIDATE_URL, method='POST')
+        response = call(api.CellValuesHandler, self.path, {'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_accept(self):
+        etag = call(api.CellValuesHandler, self.path).headers['ETag']
+        # The same URL negotiated as CSV is another representation:
+        headers = {'Accept': 'text/csv', 'If-None-Match': etag}
+        response = call(api.CellValuesHandler, self.path, headers)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['Content-Type'], 'text/csv')
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Vary'], 'Accept, Accept-Encoding')
+        headers['If-None-Match'] = response.headers['ETag']
+        self.assertEqual(call(api.CellValuesHandler, self.path, headers).status, 304)
+
+class ShardFailureTest(unittest.TestCase):
+    def setUp(self):
+        setupstubs()
+        api.DATASET_VERSION = None
+        api.LOCAL_CACHE.clear()
+        api.BLOCK_CACHE = False
+        api.COUCHDB_SHARDS = shardmap.ShardMap(['http://a:5984/cells-0', 
+            'http://b:5984/cells-1', 'http://c:5984/cells-2'], shardmap.RANK)
+        self.varvals = dict([('%s-%s' % (x, y), {'bio1': x}) \
+                                 for y in range(100, 110) for x in range(60)])
+        self.couch = CouchStub(self.varvals, api.COUCHDB_SHARDS)
+        apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', self.couch)
+        self.couchdbrpc = api.couchdbrpc
+        self.couchdbresponse = api.couchdbresponse
+
+    def tearDown(self):
+        api.BLOCK_CACHE = True
+        api.COUCHDB_SHARDS = None
+        api.couchdbrpc = self.couchdbrpc
+        api.couchdbresponse = self.couchdbresponse
+
+    def test_healthy_shards_served(self):
+        self.couch.down.add('http://b:5984/cells-1')
+        keys = set(['%s-100' % x for x in range(0, 60, 6)] + ['1-111'])
+        stats = api.tierstats.RequestStats()
+        cells = api.CellValuesHandler.getcells(keys, stats)
+        failed = set([x for x in keys if api.COUCHDB_SHARDS.shard(x) == 1])
+        self.assertTrue(failed)
+        self.assertEqual(set(cells.keys()), keys.difference(failed).difference(['1-111']))
+        self.assertEqual(stats.unresolved, len(failed))
+        # Keys of the failed shard are not cached as missing, unlike 1-111 of shard 0:
+        cached = api.cacheget(keys)
+        self.assertEqual([x for x in failed if x in cached], [])
+        self.assertEqual(cached['1-111'], api.MISSING)
+
+    def test_region_rpcs_capped(self):
+        counts = {'in_flight': 0, 'max': 0}
+        def couchdbrpc(*args, **kwargs):
+            counts['in_flight'] += 1
+            counts['max'] = max(counts['max'], counts['in_flight'])
+            return self.couchdbrpc(*args, **kwargs)
+        def couchdbresponse(rpc):
+            counts['in_flight'] -= 1
+            return self.couchdbresponse(rpc)
+        api.couchdbrpc = couchdbrpc
+        api.couchdbresponse = couchdbresponse
+        bbox = '-180,%s,%s,%s' % (rmg.RMGCell.north(110) + 1e-6, rmg.RMGCell.east(59, 109), 
+                                  rmg.RMGCell.north(100) - 1e-6)
+        response = call(api.RegionHandler, '/api/cells/region?bbox=%s' % bbox)
+        self.assertEqual(response.status, 200)
+        ranges = api.RegionHandler.getranges(bbox)
+        keys = [x for x in self.varvals \
+                    if [1 for y, x0, x1 in ranges if x.endswith('-%s' % y) and \
+                            x0 <= int(x.split('-')[0]) <= x1]]
+        cells = api.simplejson.loads(response.out.getvalue())['cells']
+        self.assertEqual(sorted([x['cell-key'] for x in cells]), sorted(keys))
+        # Each range is queried in all 3 shards, so 2 ranges are in flight at a time:
+        self.assertEqual(counts['max'], 6)
+        self.assertTrue(counts['max'] <= api.REGION_RANGE_RPCS)
+        self.couch.down.add('http://b:5984/cells-1')
+        self.assertEqual(call(api.RegionHandler, '/api/cells/region?bbox=%s' % bbox).status, 503)
+
+class PrefetchTest(unittest.TestCase):
+    def setUp(self):
+        setupstubs()
+        api.DATASET_VERSION = None
+        api.LOCAL_CACHE.clear()
+        api.PREFETCH_COUNTS.clear()
+
+    def test_prefetch_once(self):
+        prefetch = api.CellValuesHandler.prefetch(['1-1'])
+        api.CellValuesHandler.waitprefetch(prefetch)
+        tasks = apiproxy_stub_map.apiproxy.GetStub('taskqueue').GetTasks(api.PREFETCH_QUEUE)
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0]['url'], api.PREFETCH_URL)
+        self.assertEqual(api.PREFETCH_COUNTS, {'queued': len(prefetch[1])})
+        # Queued blocks are not queued again by this instance:
+        self.assertEqual(api.CellValuesHandler.prefetch(['1-1']), None)
+
+    def test_counts_flushed(self):
+        api.countprefetch({'hits': 2, 'misses': 0})
+        api.flushstats()
+        self.assertEqual(api.PREFETCH_COUNTS, {})
+        self.assertEqual(int(memcache.get(api.PREFETCH_STATS_PREFIX + 'hits')), 2)
+
+class DatasetVersionTest(unittest.TestCase):
+    def setUp(self):
+        setupstubs()
+        api.DATASET_VERSION = None
+
+    def test_reader_does_not_overwrite(self):
+        # The invalidator sets version 2 while a reader gets version 1 from 
+        # the datastore:
+        old = api.DatasetVersion(key_name=api.COUCHDB_DATABASE, version=1)
+        def get_by_key_name(cls, name):
+            memcache.set(api.VERSION_KEY, (2, {}), time=api.VERSION_CACHE_TTL)
+            return old
+        getter = api.DatasetVersion.get_by_key_name
+        api.DatasetVersion.get_by_key_name = classmethod(get_by_key_name)
+        try:
+            self.assertEqual(api.datasetversion(), (1, {}))
+        finally:
+            api.DatasetVersion.get_by_key_name = getter
+        api.DATASET_VERSION = None
+        self.assertEqual(api.datasetversion(), (2, {}))
+
+    def test_reader_caches(self):
+        self.assertEqual(api.datasetversion(), (1, {}))
+        self.assertEqual(memcache.get(api.VERSION_KEY), (1, {}))
+
+class CacheHeadersTest(unittest.TestCase):
+    def headers(self, path):
+        headers = {}
+        api.cacheheaders(headers, '"1"', api.webapp.Request.blank(path))
+        return headers
+
+    def test_format_parameter(self):
+        self.assertEqual(self.headers('/api/cells/values?k=1-1&f=csv'), 
+            {'ETag': '"1"', 'Cache-Control': 'public, max-age=%s' % api.VALUES_MAX_AGE,
+             'Vary': 'Accept-Encoding'})
+
+    def test_negotiated_format(self):
+        self.assertEqual(self.headers('/api/cells/values?k=1-1'), 
+            {'ETag': '"1"', 'Cache-Control': 'private, max-age=%s' % api.VALUES_MAX_AGE,
+             'Vary': 'Accept, Accept-Encoding'})
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
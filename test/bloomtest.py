@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for the BloomFilter class."""
+
+import logging
+import sys
+import unittest
+
+sys.path.insert(0, '../')
+
+from sdl.bloom import BloomFilter
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        f = BloomFilter.forcapacity(1000)
+        keys = ['%s-%s' % (x, x * 7) for x in range(1000)]
+        for key in keys:
+            f.add(key)
+        for key in keys:
+            self.assertTrue(key in f)
+
+    def test_error_rate(self):
+        f = BloomFilter.forcapacity(1000, 0.01)
+        for x in range(1000):
+            f.add('%s-1' % x)
+        false_positives = len([x for x in range(10000) if '%s-2' % x in f])
+        self.assertTrue(false_positives < 300)
+
+    def test_serialization(self):
+        f = BloomFilter.forcapacity(100)
+        f.add('9-15')
+        g = BloomFilter.fromstring(f.tostring())
+        self.assertEqual(g.bits, f.bits)
+        self.assertEqual(g.hashes, f.hashes)
+        self.assertTrue('9-15' in g)
+        self.assertTrue(u'9-15' in g)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
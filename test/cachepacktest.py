@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for cache packing functions."""
+
+import logging
+import sys
+import os
+import unittest
+
+sys.path.insert(0, '../app')
+
+from cachepack import *
+
+CELL = (1, u'1-2c4f', '[["-121.3", "34.7"]]', ('12', '-3', '"n/a"', 'null'))
+NAMED_CELL = ((u'bio1', u'bio2'), u'2-a', '[]', ('5', '7'))
+
+class CachePackTest(unittest.TestCase):
+    def test_cell(self):
+        for cell in (CELL, NAMED_CELL, ()):
+            self.assertEqual(unpackcell(packcell(cell)), cell)
+        self.assertEqual(packcell(CELL)[0], 'C')
+        packed = packcell(CELL, 10)
+        self.assertEqual(packed[0], 'Z')
+        self.assertEqual(unpackcell(packed), CELL)
+        self.assertEqual(unpackcell('x\x9c'), None)
+
+    def test_block(self):
+        cells = {'1-2': CELL, '2-2': NAMED_CELL}
+        self.assertEqual(unpackblock(packblock(cells)), cells)
+        self.assertEqual(unpackblock(packblock({})), {})
+        self.assertEqual(unpackblock(packcell(CELL)), None)
+
+    def test_chunk(self):
+        self.assertEqual(chunk('block:1-2', 'abc', 10), {'block:1-2': 'abc'})
+        value = 'abcdefghijklmnopqrstuvwxy'
+        entries = chunk('block:1-2', value, 10)
+        self.assertEqual(len(entries), 4)
+        header = entries['block:1-2']
+        self.assertEqual(chunkkeys('block:1-2', header), 
+                         ['block:1-2#0', 'block:1-2#1', 'block:1-2#2'])
+        self.assertEqual(chunkkeys('block:1-2', 'B...'), None)
+        self.assertEqual(unchunk('block:1-2', header, entries), value)
+        del entries['block:1-2#1']
+        self.assertEqual(unchunk('block:1-2', header, entries), None)
+        entries['block:1-2#1'] = 'XXXXXXXXXX'
+        self.assertEqual(unchunk('block:1-2', header, entries), None)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
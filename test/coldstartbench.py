@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""
+This module benchmarks the cold start of the API under the dev_appserver.
+
+Each run starts a dev_appserver on a copy of the app with an empty datastore,
+waits for it to accept connections, and times the first response to a URL, 
+which includes loading api.py, and then a second, warm, response. The 
+dev_appserver sandbox only imports modules under the app directory and the 
+SDK's own packages, so the copy includes the SDK's simplejson, which the 
+production runtime provides. The default
+request has no cell keys, so it is answered without the cell backends and
+times loading the API; a cell request times the whole first request, e.g.:
+
+    python coldstartbench.py -r 5 -u '/api/cells/values?k=26567-10800&v=bio1'
+"""
+
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+from optparse import OptionParser
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+APP_DIR = os.path.join(ROOT, 'app')
+DEV_APPSERVER = os.path.join(ROOT, 'lib', 'google_appengine', 'dev_appserver.py')
+SIMPLEJSON_DIR = os.path.join(ROOT, 'lib', 'google_appengine', 'lib', 'simplejson')
+
+def stageapp(directory):
+    """Copies the app into a directory with simplejson alongside it, and returns its path."""
+    app_dir = os.path.join(directory, 'app')
+    shutil.copytree(APP_DIR, app_dir)
+    if not os.path.exists(os.path.join(app_dir, 'simplejson')):
+        shutil.copytree(SIMPLEJSON_DIR, os.path.join(app_dir, 'simplejson'))
+    return app_dir
+
+def waitforport(port, timeout):
+    """Returns the seconds until a port accepts connections, or None if timed out."""
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        s = socket.socket()
+        try:
+            try:
+                s.connect(('127.0.0.1', port))
+                return time.time() - t0
+            except socket.error:
+                time.sleep(0.05)
+        finally:
+            s.close()
+    return None
+
+def timeget(url):
+    """Returns the seconds taken by a GET of a URL and its status."""
+    t0 = time.time()
+    try:
+        response = urllib2.urlopen(url)
+        response.read()
+        status = response.code
+    except urllib2.HTTPError, e:
+        status = e.code
+    return time.time() - t0, status
+
+def stop(server, timeout=5):
+    """Terminates a server process, and kills it if still running after timeout seconds."""
+    os.kill(server.pid, signal.SIGTERM)
+    t0 = time.time()
+    while server.poll() is None and time.time() - t0 < timeout:
+        time.sleep(0.1)
+    if server.poll() is None:
+        os.kill(server.pid, signal.SIGKILL)
+        server.wait()
+
+def coldstart(port, path, timeout):
+    """Returns the (startup, first, warm) seconds of one dev_appserver run."""
+    datastore = tempfile.mkdtemp()
+    args = [sys.executable, DEV_APPSERVER, '--port=%s' % port,
+            '--datastore_path=%s' % os.path.join(datastore, 'datastore'),
+            '--history_path=%s' % os.path.join(datastore, 'history'),
+            '--disable_task_running', stageapp(datastore)]
+    log = open(os.path.join(datastore, 'dev_appserver.log'), 'w')
+    server = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+    # Declines to check for SDK updates if asked:
+    server.stdin.write('n\n')
+    server.stdin.close()
+    try:
+        startup = waitforport(port, timeout)
+        if startup is None:
+            raise RuntimeError('dev_appserver did not start in %s seconds' % timeout)
+        url = 'http://127.0.0.1:%s%s' % (port, path)
+        first, status = timeget(url)
+        warm, status = timeget(url)
+        logging.info('Startup %.0f ms, first response %.0f ms, warm %.0f ms (status %s)' % \
+            (startup * 1000, first * 1000, warm * 1000, status))
+        return startup, first, warm
+    finally:
+        stop(server)
+        log.close()
+        shutil.rmtree(datastore, True)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option("-r", "--runs", dest="runs",
+                      help="Number of cold starts",
+                      default=5)
+    parser.add_option("-u", "--url", dest="url",
+                      help="Path and query of the first request",
+                      default='/api/cells/values')
+    parser.add_option("-p", "--port", dest="port",
+                      help="Port of the dev_appserver",
+                      default=8087)
+    parser.add_option("-t", "--timeout", dest="timeout",
+                      help="Seconds to wait for the dev_appserver to start",
+                      default=60)
+
+    (options, args) = parser.parse_args()
+    runs = [coldstart(int(options.port), options.url, float(options.timeout)) \
+                for i in range(int(options.runs))]
+    print 'Median of %s runs: startup %.0f ms, first response %.0f ms, warm %.0f ms' % \
+        (len(runs), median([x[0] for x in runs]) * 1000,
+         median([x[1] for x in runs]) * 1000, median([x[2] for x in runs]) * 1000)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for the streamed _bulk_docs requests of couchutil."""
+
+import json
+import logging
+import sys
+import unittest
+
+# couchutil imports its sibling modules (gziputil, rmg) by name:
+sys.path.insert(0, '../sdl')
+
+import couchutil
+from gziputil import gunzip
+
+def celldocs(n, start=0):
+    """Returns cell documents that share coordinates and variable names, as loaded cells do."""
+    return [{'_id': '%s-7' % i,
+             'coords': [['-121.5', '34.25'], ['-121.5', '34.2']],
+             'vars': {'bio1': str(i % 3), 'bio2': u'\xe9', 'alt': i * 0.5}} \
+                for i in range(start, start + n)]
+
+def compact(docs):
+    """Returns the _bulk_docs body of docs as encoded by json.dumps."""
+    return json.dumps({'docs': docs}, separators=(',', ':'))
+
+class Response(object):
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return default
+
+class Connection(object):
+    """An httplib.HTTPConnection that records a chunked request."""
+
+    def __init__(self):
+        self.headers = {}
+        self.sent = []
+
+    def putrequest(self, method, url):
+        self.method = method
+        self.url = url
+
+    def putheader(self, name, value):
+        self.headers[name] = value
+
+    def endheaders(self):
+        pass
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def body(self):
+        """Returns the request body with the chunked transfer encoding removed."""
+        data = ''.join(self.sent)
+        chunks = []
+        while True:
+            size, data = data.split('\r\n', 1)
+            size = int(size, 16)
+            if size == 0:
+                return ''.join(chunks)
+            chunks.append(data[:size])
+            data = data[size + 2:]
+
+    def getresponse(self):
+        docs = json.loads(self.decoded())['docs']
+        return Response(201, json.dumps([{'id': x['_id'], 'rev': '1-a'} for x in docs]))
+
+    def decoded(self):
+        body = self.body()
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gunzip(body)
+        return body
+
+class BulkDocsEncoderTest(unittest.TestCase):
+    def tearDown(self):
+        couchutil.MAX_FRAGMENTS = 100000
+
+    def test_matches_json(self):
+        encoder = couchutil.BulkDocsEncoder(chunksize=256)
+        docs = celldocs(20)
+        self.assertEqual(''.join(encoder.iterencode(docs)), compact(docs))
+        # Strings cached for the first batch are reused for the next:
+        cached = len(encoder._fragments)
+        self.assertTrue(encoder._fragments.has_key('coords'))
+        more = celldocs(5) + celldocs(5, 100)
+        self.assertEqual(''.join(encoder.iterencode(more)), compact(more))
+        self.assertEqual(len(encoder._fragments), cached + 5)
+
+    def test_chunks(self):
+        chunks = list(couchutil.BulkDocsEncoder(chunksize=256).iterencode(celldocs(20)))
+        self.assertTrue(len(chunks) > 2)
+        for chunk in chunks[:-1]:
+            self.assertTrue(len(chunk) >= 256)
+        self.assertEqual(''.join(couchutil.BulkDocsEncoder().iterencode([])), compact([]))
+
+    def test_max_fragments(self):
+        couchutil.MAX_FRAGMENTS = 10
+        encoder = couchutil.BulkDocsEncoder()
+        docs = celldocs(30)
+        self.assertEqual(''.join(encoder.iterencode(docs)), compact(docs))
+        self.assertTrue(len(encoder._fragments) <= 10)
+
+class BulkDocsTest(unittest.TestCase):
+    def bulkdocs(self, compress_threshold, docs):
+        couch = couchutil.Couch('localhost', compress_threshold=compress_threshold)
+        connection = Connection()
+        couch.connect = lambda: connection
+        results = couch.bulkDocs('cells', iter(docs))
+        self.assertEqual([x['id'] for x in results], [x['_id'] for x in docs])
+        self.assertEqual(connection.url, '/cells/_bulk_docs')
+        self.assertEqual(connection.headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(connection.decoded(), compact(docs))
+        return connection
+
+    def test_uncompressed(self):
+        connection = self.bulkdocs(None, celldocs(10))
+        self.assertFalse(connection.headers.has_key('Content-Encoding'))
+
+    def test_below_threshold(self):
+        connection = self.bulkdocs(1 << 20, celldocs(10))
+        self.assertFalse(connection.headers.has_key('Content-Encoding'))
+
+    def test_gzipped(self):
+        connection = self.bulkdocs(100, celldocs(500))
+        self.assertEqual(connection.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(len(connection.body()) < len(compact(celldocs(500))))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for the gzip encoding functions."""
+
+import gzip
+import logging
+import StringIO
+import sys
+import unittest
+
+sys.path.insert(0, '../')
+
+from sdl.gziputil import *
+
+class GzipUtilTest(unittest.TestCase):
+    def test_roundtrip(self):
+        data = '{"docs": [%s]}' % ','.join(['{"_id": "%s-7"}' % x for x in range(1000)])
+        compressed = gzipstring(data)
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(gunzip(compressed), data)
+        # The gzip container is readable by the gzip module:
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(compressed)).read(), data)
+
+    def test_chunks(self):
+        chunks = ['[', '"a"', ',', '"b"', ']']
+        self.assertEqual(gunzip(''.join(gzipchunks(chunks))), ''.join(chunks))
+        self.assertEqual(gunzip(''.join(gzipchunks([]))), '')
+
+    def test_ratio(self):
+        self.assertEqual(ratio(100, 25), 4.0)
+        self.assertEqual(ratio(100, 0), 100.0)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for the LRUCache class."""
+
+import logging
+import sys
+import os
+import time
+import unittest
+
+sys.path.insert(0, '../app')
+
+from lrucache import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+    def test_get_set(self):
+        cache = LRUCache(10, 10000, 60)
+        cache.set_multi({'1-1': 'a', '2-1': 'b'})
+        self.assertEqual(cache.get_multi(['1-1', '2-1', '3-1']), {'1-1': 'a', '2-1': 'b'})
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2, 10000, 60)
+        cache.set_multi({'1-1': 'a'})
+        cache.set_multi({'2-1': 'b'})
+        cache.get_multi(['1-1'])
+        cache.set_multi({'3-1': 'c'})
+        self.assertEqual(cache.get_multi(['1-1', '2-1', '3-1']), {'1-1': 'a', '3-1': 'c'})
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_byte_bound(self):
+        cache = LRUCache(100, 250, 60, sizeof=len)
+        cache.set_multi({'1-1': 'x' * 100})
+        cache.set_multi({'2-1': 'x' * 100})
+        self.assertEqual(cache.get_multi(['1-1', '2-1']).keys(), ['2-1'])
+        self.assertTrue(cache.bytes <= 250)
+
+    def test_expiry(self):
+        cache = LRUCache(10, 10000, -1)
+        cache.set_multi({'1-1': 'a'})
+        self.assertEqual(cache.get_multi(['1-1']), {})
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for the RankSet class."""
+
+import logging
+import random
+import sys
+import unittest
+
+sys.path.insert(0, '../')
+
+from sdl.rankset import RankSet
+
+def ranksetof(ranks):
+    result = RankSet()
+    for rank in sorted(ranks):
+        result.add(rank)
+    return result
+
+class RankSetTest(unittest.TestCase):
+    def test_runs(self):
+        ranks = ranksetof([1, 2, 3, 7, 8, 20])
+        self.assertEqual(ranks.runs, [(1, 4), (7, 9), (20, 21)])
+        self.assertEqual(len(ranks), 6)
+        self.assertEqual(list(ranks), [1, 2, 3, 7, 8, 20])
+        self.assertTrue(8 in ranks)
+        self.assertFalse(9 in ranks)
+        self.assertFalse(0 in ranks)
+
+    def test_set_operations(self):
+        r = random.Random(1)
+        for trial in range(20):
+            a = set([r.randint(0, 200) for i in range(100)])
+            b = set([r.randint(0, 200) for i in range(100)])
+            self.assertEqual(list(ranksetof(a) | ranksetof(b)), sorted(a | b))
+            self.assertEqual(list(ranksetof(a) & ranksetof(b)), sorted(a & b))
+            self.assertEqual(list(ranksetof(a) - ranksetof(b)), sorted(a - b))
+
+    def test_serialization(self):
+        ranks = RankSet([(5, 10), (1000, 5000), (592000000, 592000001)])
+        self.assertEqual(RankSet.fromstring(ranks.tostring()), ranks)
+        self.assertEqual(RankSet.fromstring(RankSet().tostring()), RankSet())
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
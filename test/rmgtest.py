@@ -170,6 +170,73 @@ class RMGTest(unittest.TestCase):
             polygon = RMGCell.polygon(key, cells_per_degree)
             print key+" "+str(polygon)
 
+    def test_bboxranges(self):
+        ranges = bboxranges(-1, -0.01, 1, 0.01)
+        self.assertEqual([x[0] for x in ranges], [10798, 10799, 10800, 10801])
+        for y_index, x0, x1 in ranges:
+            self.assertTrue(RMGCell.west(x0, y_index) <= -1 < RMGCell.east(x0, y_index))
+            self.assertTrue(RMGCell.west(x1, y_index) < 1 <= RMGCell.east(x1, y_index))
+        # Crossing lng = 180 gives the eastern and western ends of each row.
+        ranges = bboxranges(179.99, 0, -179.99, 0.01)
+        columns = rowcolumns(10798)
+        self.assertEqual(ranges[:2], [(10798, 0, 1), (10798, columns - 2, columns - 1)])
+        # Polar rows have a single cell.
+        self.assertEqual(bboxranges(-10, -90, 10, -89.995)[-1], (21599, 0, 0))
+
+    def test_polygonranges(self):
+        square = [(-1, -0.01), (1, -0.01), (1, 0.01), (-1, 0.01), (-1, -0.01)]
+        ranges = polygonranges([square])
+        self.assertEqual([x[0] for x in ranges], [10799, 10800])
+        for y_index, x0, x1 in ranges:
+            self.assertTrue(RMGCell.mid_lng(x0 - 1, y_index) < -1 <= RMGCell.mid_lng(x0, y_index))
+            self.assertTrue(RMGCell.mid_lng(x1, y_index) <= 1 < RMGCell.mid_lng(x1 + 1, y_index))
+        # A hole splits each row it crosses into two ranges.
+        hole = [(-0.5, -0.01), (0.5, -0.01), (0.5, 0.01), (-0.5, 0.01), (-0.5, -0.01)]
+        ranges = polygonranges([square, hole])
+        self.assertEqual(len(ranges), 4)
+        self.assertTrue(ranges[0][2] < ranges[1][1])
+
+    def test_pointkeys(self):
+        points = [(-121.3, 34.7), (39.12, -5.45), (179.999, 0.001), (-180, 90), (10, -89.999)]
+        keys = [RMGCell.key(lng, lat, 120.0) for lng, lat in points[:3]]
+        self.assertEqual(pointkeys(points)[:3], keys)
+        self.assertEqual(pointkeys(points)[3:], ['0-0', '0-21599'])
+
+    def test_rowoffsets(self):
+        # The precomputed row offsets match the computed ones.
+        offsets = loadrowoffsets(ROW_OFFSETS_FILE)
+        self.assertEqual(offsets, computerowoffsets())
+        self.assertEqual(loadrowoffsets(ROW_OFFSETS_FILE, 60), None)
+        self.assertEqual(rankkey(cellrank('26567-10800')), '26567-10800')
+        self.assertEqual(rankkey(cellrank('0-21599')), '0-21599')
+        for key in ('0-21600', '0--1', '-1-10800', '43200-10800'):
+            self.assertRaises(ValueError, cellrank, key)
+
+    def test_blocks(self):
+        self.assertEqual(blockkey('26567-10800'), '830-337')
+        ranges = blockranges('830-337')
+        self.assertEqual(len(ranges), 32)
+        self.assertEqual(ranges[0], (10784, 26560, 26591))
+        for y_index, x0, x1 in ranges:
+            self.assertEqual(blockkey('%s-%s' % (x1, y_index)), '830-337')
+        # The last block of a row is clipped to the row, and the last row has one cell.
+        columns = rowcolumns(21568)
+        ranges = blockranges('%s-674' % ((columns - 1) // 32))
+        self.assertEqual(ranges[0], (21568, (columns - 1) // 32 * 32, columns - 1))
+        self.assertEqual(blockranges('0-674')[-1], (21599, 0, 0))
+        self.assertTrue(rowcolumns(blockranges('1-674')[-1][0] + 1) <= 32)
+
+    def test_blockneighbours(self):
+        neighbours = blockneighbours('830-337')
+        self.assertEqual(len(neighbours), 8)
+        for key in ['829-336', '831-338', '829-337', '831-337']:
+            self.assertTrue(key in neighbours)
+        # Neighbours wrap around at the antimeridian, and the grid ends at the poles.
+        last = (rowcolumns(320) - 1) // 32
+        self.assertTrue('%s-10' % last in blockneighbours('0-10'))
+        self.assertEqual([x.split('-')[1] for x in blockneighbours('0-0')], ['1', '1', '1'])
+        self.assertFalse([x for x in blockneighbours('0-674') if x.endswith('-675')])
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     unittest.main()
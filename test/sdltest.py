@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for the CouchDB loader in sdl.py."""
+
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+# sdl.py imports its sibling modules (bloom, couchutil, rmg) by name:
+sys.path.insert(0, '../sdl')
+
+import sdl
+
+class Row(object):
+    """A couchdb.client.Row of a view."""
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+class HashesDb(object):
+    """A couchdb.Database with the hashes view of stored documents."""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.pages = []
+
+    def view(self, name, keys=None):
+        assert name == 'api/hashes'
+        self.pages.append(list(keys))
+        return [Row(x, {'rev': self.docs[x]['_rev'], 'hash': self.docs[x]['hash']}) \
+                    for x in keys if x in self.docs]
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.cellvars = {'1-1': {'bio1': 10}, '2-1': {'bio1': 20}, '3-1': {'bio1': 30}}
+        stored = dict([(x['_id'], x) for x in sdl.Tile.celldocs(self.cellvars, 120)])
+        stored['1-1']['_rev'] = '1-a'
+        stored['2-1']['_rev'] = '1-b'
+        self.cdb = HashesDb(dict([(x, stored[x]) for x in ('1-1', '2-1')]))
+
+    def test_cellhash(self):
+        doc = {'coords': [['1', '2']], 'vars': {'bio1': 1, 'bio2': 2}}
+        same = {'vars': {'bio2': 2, 'bio1': 1}, 'coords': [['1', '2']], '_rev': '1-a'}
+        self.assertEqual(sdl.cellhash(doc), sdl.cellhash(same))
+        self.assertNotEqual(sdl.cellhash(doc), sdl.cellhash({'coords': [['1', '2']], 'vars': {}}))
+
+    def test_getrevisions(self):
+        revisions = sdl.getrevisions(self.cdb, ['1-1', '2-1', '3-1'], pagesize=2)
+        self.assertEqual(sorted(revisions.keys()), ['1-1', '2-1'])
+        self.assertEqual(revisions['1-1'][0], '1-a')
+        self.assertEqual(len(self.cdb.pages), 2)
+
+    def test_unchanged_skipped(self):
+        self.cellvars['2-1'] = {'bio1': 21}
+        existing = sdl.getrevisions(self.cdb, self.cellvars.keys())
+        unchanged = []
+        docs = dict([(x['_id'], x) for x in \
+                         sdl.Tile.celldocs(self.cellvars, 120, existing, unchanged)])
+        self.assertEqual(unchanged, ['1-1'])
+        # The changed document is written over its stored revision:
+        self.assertEqual(sorted(docs.keys()), ['2-1', '3-1'])
+        self.assertEqual(docs['2-1']['_rev'], '1-b')
+        self.assertEqual(docs['2-1']['vars'], {'bio1': 21})
+        self.assertEqual(docs['2-1']['hash'], sdl.cellhash(docs['2-1']))
+        self.assertFalse(docs['3-1'].has_key('_rev'))
+
+class Options(object):
+    def __init__(self, workspace):
+        self.workspace = workspace
+
+class FlakyCouch(object):
+    """A couchutil.Couch whose _bulk_docs fails documents with conflicts a number of times."""
+
+    def __init__(self, conflicts, stored='1-a'):
+        self.conflicts = dict(conflicts)
+        self.stored = stored
+        self.uploaded = []
+
+    def getRev(self, database, docid):
+        return self.stored
+
+    def bulkDocs(self, database, docs):
+        results = []
+        for doc in docs:
+            self.uploaded.append((doc['_id'], doc.get('_rev')))
+            if self.conflicts.get(doc['_id']):
+                self.conflicts[doc['_id']] -= 1
+                results.append({'id': doc['_id'], 'error': 'conflict', 
+                                'reason': 'Document update conflict.'})
+            else:
+                results.append({'id': doc['_id'], 'rev': '2-b'})
+        return results
+
+class BulkUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.options = Options(self.workspace)
+        self.docs = [{'_id': '1-1', 'vars': {}}, {'_id': '2-1', 'vars': {}}]
+        self.sleeps = []
+        self.sleep = sdl.time.sleep
+        sdl.time.sleep = self.sleeps.append
+
+    def tearDown(self):
+        sdl.time.sleep = self.sleep
+        shutil.rmtree(self.workspace)
+
+    def reread(self, cellkeys):
+        return [x for x in self.docs if x['_id'] in cellkeys]
+
+    def rejects(self):
+        path = os.path.join(self.workspace, sdl.REJECT_FILE)
+        if not os.path.exists(path):
+            return []
+        return [json.loads(x) for x in open(path)]
+
+    def test_conflict_retried(self):
+        # Conflicts on the batch and the first individual attempt, then succeeds:
+        couch = FlakyCouch({'2-1': 2})
+        counts = sdl.Tile.bulkupload(couch, 'cells', self.options, self.docs, self.reread, 
+            attempts=3, delay=0.5)
+        self.assertEqual(counts, (1, 1, 0))
+        self.assertEqual(couch.uploaded, 
+            [('1-1', None), ('2-1', None), ('2-1', '1-a'), ('2-1', '1-a')])
+        self.assertEqual(self.sleeps, [0.5])
+        self.assertEqual(self.rejects(), [])
+
+    def test_new_document_retried_without_rev(self):
+        couch = FlakyCouch({'2-1': 1}, stored=None)
+        self.docs[1]['_rev'] = '1-old'
+        counts = sdl.Tile.bulkupload(couch, 'cells', self.options, self.docs, self.reread)
+        self.assertEqual(counts, (1, 1, 0))
+        self.assertEqual(couch.uploaded[-1], ('2-1', None))
+
+    def test_rejected(self):
+        couch = FlakyCouch({'2-1': 100})
+        counts = sdl.Tile.bulkupload(couch, 'cells', self.options, self.docs, self.reread, 
+            attempts=4, delay=0.5)
+        self.assertEqual(counts, (1, 0, 1))
+        self.assertEqual(self.sleeps, [0.5, 1.0, 2.0])
+        rejects = self.rejects()
+        self.assertEqual(len(rejects), 1)
+        self.assertEqual(rejects[0]['doc']['_id'], '2-1')
+        self.assertEqual(rejects[0]['error'], 'conflict')
+
+    def test_transport_error_retried(self):
+        couch = FlakyCouch({'2-1': 1})
+        bulkdocs = couch.bulkDocs
+        failures = [socket.error('Connection reset by peer')]
+        def flaky(database, docs):
+            if len(couch.uploaded) == 2 and failures:
+                raise failures.pop()
+            return bulkdocs(database, docs)
+        couch.bulkDocs = flaky
+        counts = sdl.Tile.bulkupload(couch, 'cells', self.options, self.docs, self.reread, 
+            attempts=3, delay=0.5)
+        self.assertEqual(counts, (1, 1, 0))
+        self.assertEqual(self.sleeps, [0.5])
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for the ShardMap class."""
+
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, '../')
+
+from sdl.rmg import rowoffsets
+from sdl.shardmap import *
+
+SHARDS = ['http://a:5984/worldclim-rmg-0', 'http://b:5984/worldclim-rmg-1',
+          'http://a:5984/worldclim-rmg-2']
+
+class ShardMapTest(unittest.TestCase):
+    def test_rows(self):
+        shards = ShardMap(SHARDS)
+        offsets = rowoffsets()
+        # Bands hold about the same number of cells.
+        self.assertEqual(shards.bands[0], 0)
+        for i, y_index in enumerate(shards.bands):
+            self.assertTrue(abs(offsets[y_index] - offsets[-1] * i / 3) < 43200)
+        self.assertEqual(shards.shard('0-0'), 0)
+        self.assertEqual(shards.shard('0-%s' % (shards.bands[1] - 1)), 0)
+        self.assertEqual(shards.shard('5-%s' % shards.bands[1]), 1)
+        self.assertEqual(shards.shard('0-21599'), 2)
+        self.assertEqual(shards.rangeshards((shards.bands[2], 0, 9000)), [2])
+        self.assertRaises(ValueError, ShardMap, SHARDS, ROWS, [0, 5])
+        self.assertRaises(ValueError, ShardMap, SHARDS, 'bogus')
+
+    def test_rank(self):
+        shards = ShardMap(SHARDS, RANK)
+        keys = ['%s-10800' % x for x in range(3000)]
+        routed = shards.route(keys)
+        self.assertEqual(sorted(routed.keys()), [0, 1, 2])
+        for i, subset in routed.iteritems():
+            self.assertTrue(900 < len(subset) < 1100)
+            for key in subset:
+                self.assertEqual(shards.shard(key), i)
+        self.assertEqual(shards.rangeshards((10800, 0, 2999)), [0, 1, 2])
+        self.assertEqual(shards.rangeshards((10800, 7, 7)), [shards.shard('7-10800')])
+
+    def test_save(self):
+        shards = ShardMap(SHARDS, RANK)
+        filename = tempfile.mktemp()
+        try:
+            shards.save(filename)
+            loaded = ShardMap.load(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(loaded.todict(), shards.todict())
+        single = ShardMap.single('http://a:5984/worldclim-rmg/')
+        self.assertEqual(single.shard('26567-10800'), 0)
+        self.assertEqual(single.viewurl(0, 'api', 'cells'),
+                         'http://a:5984/worldclim-rmg/_design/api/_view/cells')
+        self.assertEqual(splitshard(SHARDS[1]), ('http://b:5984', 'worldclim-rmg-1'))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for the SpillQueue class."""
+
+import logging
+import shutil
+import sys
+import os
+import tempfile
+import unittest
+
+sys.path.insert(0, '../')
+
+from sdl.spillqueue import SpillQueue
+
+class SpillQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.uploaded = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self, docs):
+        self.uploaded.append([doc['_id'] for doc in docs])
+
+    def test_drain_in_order(self):
+        queue = SpillQueue(self.directory, self.upload)
+        self.assertEqual(queue.append([{'_id': '1-1'}, {'_id': '2-1'}]), 0)
+        self.assertEqual(queue.append([{'_id': '3-1'}]), 1)
+        self.assertEqual(queue.pending(), [0, 1])
+        queue.drain()
+        self.assertEqual(self.uploaded, [['1-1', '2-1'], ['3-1']])
+        self.assertEqual(queue.pending(), [])
+        self.assertEqual(queue.acked, 1)
+
+    def test_resume_after_restart(self):
+        queue = SpillQueue(self.directory, self.upload)
+        queue.append([{'_id': '1-1'}])
+        queue.drain()
+        queue.append([{'_id': '2-1'}])
+        queue = SpillQueue(self.directory, self.upload)
+        self.assertEqual(queue.acked, 0)
+        self.assertEqual(queue.pending(), [1])
+        self.assertEqual(queue.append([{'_id': '3-1'}]), 2)
+        queue.drain()
+        self.assertEqual(self.uploaded, [['1-1'], ['2-1'], ['3-1']])
+
+    def test_retry_with_backoff(self):
+        failures = [IOError('sink unavailable')]
+        def upload(docs):
+            docs = list(docs)
+            if failures:
+                raise failures.pop()
+            self.upload(docs)
+        queue = SpillQueue(self.directory, upload, initial_delay=0.01)
+        queue.start()
+        queue.append([{'_id': '1-1'}])
+        queue.close()
+        self.assertEqual(self.uploaded, [['1-1']])
+        self.assertEqual(queue.pending(), [])
+
+    def test_dead_segment(self):
+        def upload(docs):
+            docs = list(docs)
+            if docs[0]['_id'] == '1-1':
+                raise IOError('bad document')
+            self.upload(docs)
+        queue = SpillQueue(self.directory, upload, initial_delay=0.01, max_attempts=3)
+        queue.start()
+        queue.append([{'_id': '1-1'}])
+        queue.append([{'_id': '2-1'}])
+        queue.close()
+        self.assertEqual(self.uploaded, [['2-1']])
+        self.assertEqual(queue.pending(), [])
+        self.assertEqual(queue.dead(), [0])
+        queue = SpillQueue(self.directory, self.upload)
+        self.assertEqual(queue.requeue(), 1)
+        self.assertEqual(queue.dead(), [])
+        queue.drain()
+        self.assertEqual(self.uploaded, [['2-1'], ['1-1']])
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# Copyright 2011 University of California at Berkeley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "Aaron Steele and John Wieczorek"
+
+"""This module provides unit testing for the tier statistics classes."""
+
+import logging
+import sys
+import os
+import unittest
+
+sys.path.insert(0, '../app')
+
+from tierstats import *
+
+class TierStatsTest(unittest.TestCase):
+    def test_summary(self):
+        stats = RequestStats()
+        self.assertFalse(stats.sampled)
+        stats.add('bloom', 2, 6, detail='absent')
+        stats.add('local', 1, 4, 0.25)
+        self.assertEqual(stats.summary(), 'bloom 2/6 absent, local 1/4 in 0.2 ms')
+        self.assertEqual(stats.summary(1), 'local 1/4 in 0.2 ms')
+        self.assertTrue(RequestStats(1).sampled)
+
+    def test_record(self):
+        aggregate = TierStats(('local', 'couchdb'))
+        stats = RequestStats()
+        stats.add('local', 1, 4, 0.5)
+        stats.add('couchdb', 3, 3, 30)
+        stats.ms = 40
+        stats.size = 2000
+        aggregate.record(stats)
+        aggregate.record(stats)
+        counters = aggregate.flush()
+        self.assertEqual(aggregate.counters, {})
+        self.assertTrue(set(counters.keys()).issubset(aggregate.names()))
+        report = aggregate.report(counters)
+        self.assertEqual(report['requests'], 2)
+        self.assertEqual(report['tiers']['local']['hits'], 2)
+        self.assertEqual(report['tiers']['local']['keys'], 8)
+        self.assertEqual(report['tiers']['local']['latency_ms']['1'], 2)
+        self.assertEqual(report['tiers']['couchdb']['latency_ms']['50'], 2)
+        self.assertEqual(report['latency_ms']['50'], 2)
+        self.assertEqual(report['response_bytes']['4096'], 2)
+        self.assertEqual(sum(report['response_bytes'].values()), 2)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()